@@ -0,0 +1,3912 @@
+# ============================================
+# DADOS DA OBRA
+# ============================================
+# Banco de dados, migrações, armazenamento das fotos, filas de trabalho e
+# ferramentas de manutenção, sem as páginas. O dashboard_obra.py importa
+# daqui; a linha de comando (`python dados_obra.py <comando>`) e os
+# processos dos pools não executam a interface.
+import streamlit as st
+import numpy as np
+import datetime
+from datetime import date, timedelta
+import sqlite3
+import hashlib
+import re
+import io
+import os
+import sys
+import time
+import argparse
+import json
+import secrets
+import shutil
+import subprocess
+import zipfile
+import tempfile
+import threading
+from contextlib import contextmanager, closing, ExitStack
+from collections import OrderedDict
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor, wait
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from PIL import Image
+import processamento_fotos
+import processamento_relatorios
+
+# ============================================
+# LIMITES CONFIGURÁVEIS
+# ============================================
+def configuracao_inteira(nome, padrao):
+    """Valor inteiro da variável de ambiente OBRA_<nome>, ou `padrao` se não existir.
+
+    Permite ajustar memória e trabalhadores ao servidor sem alterar o código,
+    por exemplo OBRA_MEMORIA_MINIATURAS=268435456.
+    """
+    valor = os.environ.get(f"OBRA_{nome}")
+    if valor is None or not valor.strip():
+        return padrao
+    try:
+        return int(valor)
+    except ValueError:
+        raise ValueError(f"OBRA_{nome} deve ser um número inteiro, não {valor!r}") from None
+
+# ============================================
+# MÉTRICAS DE DESEMPENHO
+# ============================================
+class MetricasDesempenho:
+    """Contadores de chamadas e tempo acumulado, partilhados por todo o processo"""
+
+    def __init__(self):
+        self._trava = threading.Lock()
+        self._contadores = {}
+
+    def registrar(self, nome, segundos=0.0):
+        with self._trava:
+            chamadas, total = self._contadores.get(nome, (0, 0.0))
+            self._contadores[nome] = (chamadas + 1, total + segundos)
+
+    @contextmanager
+    def medir(self, nome):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nome, time.perf_counter() - inicio)
+
+    def resumo(self):
+        with self._trava:
+            itens = sorted(self._contadores.items())
+        return [
+            {"Métrica": nome, "Chamadas": chamadas, "Tempo total (ms)": round(total * 1000, 2),
+             "Tempo médio (ms)": round(total * 1000 / chamadas, 3) if chamadas else 0.0}
+            for nome, (chamadas, total) in itens
+        ]
+
+@st.cache_resource
+def obter_metricas():
+    return MetricasDesempenho()
+
+metricas = obter_metricas()
+
+# ============================================
+# CONEXÕES COM O BANCO DE DADOS
+# ============================================
+CAMINHO_BANCO = 'controle_obra.db'
+
+class GerenciadorConexoes:
+    """Mantém uma conexão SQLite por thread, em modo WAL e com pragmas ajustados.
+
+    Cada sessão do Streamlit corre numa thread própria; com uma conexão por
+    thread as leituras do dashboard não ficam bloqueadas atrás das escritas
+    de outra sessão (o WAL permite leitores concorrentes com um escritor).
+    """
+
+    def __init__(self, caminho, busy_timeout_ms=5000):
+        self.caminho = caminho
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._pid = os.getpid()
+        # Trace callback das conexões abertas a partir daqui (verificação de planos)
+        self.rastreio = None
+
+    def conexao(self):
+        # Após um fork, o processo filho não pode reutilizar as conexões do pai
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._abrir()
+            self._local.conn = conn
+        return conn
+
+    def conexao_aberta(self):
+        """Conexão da thread atual, ou None se ainda não foi aberta (não abre uma)"""
+        if self._pid != os.getpid():
+            return None
+        return getattr(self._local, "conn", None)
+
+    def _abrir(self):
+        conn = sqlite3.connect(self.caminho, timeout=self.busy_timeout_ms / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        conn.execute("PRAGMA mmap_size=134217728")
+        if self.rastreio:
+            conn.set_trace_callback(self.rastreio)
+        return conn
+
+@st.cache_resource
+def obter_gerenciador_conexoes(caminho):
+    """Gerenciador de conexões partilhado por todas as sessões do processo"""
+    return GerenciadorConexoes(caminho)
+
+gerenciador_conexoes = obter_gerenciador_conexoes(CAMINHO_BANCO)
+
+def obter_conexao():
+    """Retorna a conexão da thread atual"""
+    return gerenciador_conexoes.conexao()
+
+_pos_commit = threading.local()
+
+@contextmanager
+def transacao():
+    """Executa um bloco de escrita numa transação BEGIN IMMEDIATE.
+
+    Chamadas aninhadas reutilizam a transação já aberta, de modo que apenas o
+    bloco mais externo faz commit (ou rollback em caso de erro). As funções
+    registadas com `apos_commit` correm logo depois do commit.
+    """
+    conn = obter_conexao()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    _pos_commit.funcoes = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        _pos_commit.funcoes = []
+        raise
+    else:
+        conn.commit()
+        funcoes, _pos_commit.funcoes = _pos_commit.funcoes, []
+        for funcao in funcoes:
+            funcao()
+
+def apos_commit(funcao):
+    """Agenda `funcao` para depois do commit da transação atual (ou executa já, fora de transação)"""
+    if obter_conexao().in_transaction:
+        if not hasattr(_pos_commit, "funcoes"):
+            _pos_commit.funcoes = []
+        _pos_commit.funcoes.append(funcao)
+    else:
+        funcao()
+
+def benchmark_conexoes(sessoes=8, operacoes=200, proporcao_escrita=0.2):
+    """Compara a vazão de sessões concorrentes com uma conexão global vs. uma por thread.
+
+    Usa um banco temporário para não tocar nos dados reais. Retorna um dicionário
+    com operações por segundo de cada modo.
+    """
+    resultados = {}
+    with tempfile.TemporaryDirectory() as pasta:
+        for modo in ("conexao_unica", "conexao_por_thread"):
+            caminho = os.path.join(pasta, f"{modo}.db")
+
+            if modo == "conexao_unica":
+                # Reproduz o comportamento antigo: uma conexão partilhada, sem WAL
+                unica = sqlite3.connect(caminho, check_same_thread=False)
+                unica.row_factory = sqlite3.Row
+                init_database(unica)
+                trava = threading.Lock()
+
+                @contextmanager
+                def conexao_da_sessao():
+                    with trava:
+                        yield unica
+            else:
+                gerenciador = GerenciadorConexoes(caminho)
+                init_database(gerenciador.conexao())
+
+                @contextmanager
+                def conexao_da_sessao():
+                    yield gerenciador.conexao()
+
+            passo_escrita = max(1, round(1 / proporcao_escrita)) if proporcao_escrita else 0
+
+            def sessao(indice):
+                for i in range(operacoes):
+                    with conexao_da_sessao() as conn:
+                        if passo_escrita and i % passo_escrita == 0:
+                            conn.execute("BEGIN IMMEDIATE")
+                            conn.execute(
+                                """INSERT INTO relatorios_diarios (data, projeto_id, usuario_id, atividades, status, produtividade)
+                                   VALUES (?, ?, ?, ?, ?, ?)""",
+                                (f"2025-01-{indice % 28 + 1:02d}", 1, 1, "Benchmark", "Em andamento", 50))
+                            conn.commit()
+                        else:
+                            conn.execute("""SELECT r.id, r.data, r.status, r.produtividade FROM relatorios_diarios r
+                                            WHERE r.projeto_id = ? ORDER BY r.data DESC LIMIT 50""", (1,)).fetchall()
+
+            threads = [threading.Thread(target=sessao, args=(i,)) for i in range(sessoes)]
+            inicio = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            duracao = time.perf_counter() - inicio
+            resultados[modo] = sessoes * operacoes / duracao
+
+            if modo == "conexao_unica":
+                unica.close()
+    return resultados
+
+# ============================================
+# MIGRAÇÕES DO SCHEMA
+# ============================================
+class Migracao:
+    """Passo de migração identificado pela versão (PRAGMA user_version) que produz.
+
+    Migrações normais correm numa única transação. As marcadas com
+    `em_lotes=True` devem usar `executar_em_lotes`, que faz commit a cada
+    lote para não segurar o bloqueio de escrita durante muito tempo.
+    """
+
+    def __init__(self, versao, descricao, aplicar, em_lotes=False):
+        self.versao = versao
+        self.descricao = descricao
+        self.aplicar = aplicar
+        self.em_lotes = em_lotes
+
+def coluna_existe(conn, tabela, coluna):
+    return any(linha["name"] == coluna for linha in conn.execute(f"PRAGMA table_info({tabela})"))
+
+def adicionar_coluna(conn, tabela, coluna, definicao):
+    """Adiciona uma coluna apenas se ainda não existir (bancos antigos divergem entre si)"""
+    if not coluna_existe(conn, tabela, coluna):
+        conn.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+
+def executar_em_lotes(conn, versao, tabela, processar_lote, tamanho_lote=500):
+    """Percorre `tabela` por id em lotes, com um commit por lote.
+
+    O último id processado fica em `migracoes_lotes`, de modo que uma
+    migração interrompida retoma de onde parou na próxima inicialização.
+    `processar_lote(conn, ids)` é chamado dentro da transação do lote; se
+    retornar uma função, ela corre depois do commit do lote (é aí que se
+    apagam arquivos, para um rollback não deixar linhas sem arquivo).
+
+    A versão do schema e o progresso são relidos depois do BEGIN IMMEDIATE
+    de cada lote: se outro processo já avançou (ou concluiu a migração),
+    os lotes dele não são repetidos. Sem mais lotes, a transação fica aberta
+    para `executar_migracoes` registar a versão sob o mesmo bloqueio.
+    """
+    while True:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            if versao_schema(conn) >= versao:
+                conn.rollback()
+                return
+            linha = conn.execute("SELECT ultimo_id FROM migracoes_lotes WHERE versao = ?", (versao,)).fetchone()
+            ultimo_id = linha["ultimo_id"] if linha else 0
+            ids = [r[0] for r in conn.execute(
+                f"SELECT id FROM {tabela} WHERE id > ? ORDER BY id LIMIT ?", (ultimo_id, tamanho_lote))]
+            if not ids:
+                return
+            apos_lote = processar_lote(conn, ids)
+            conn.execute("INSERT OR REPLACE INTO migracoes_lotes (versao, ultimo_id) VALUES (?, ?)", (versao, ids[-1]))
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        if apos_lote:
+            apos_lote()
+
+def _migracao_schema_base(conn):
+    c = conn.cursor()
+
+    # Tabela de usuários
+    c.execute("""CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, 
+        username TEXT UNIQUE NOT NULL, 
+        nome TEXT NOT NULL, 
+        email TEXT UNIQUE NOT NULL,
+        senha_hash TEXT NOT NULL, 
+        tipo TEXT NOT NULL, 
+        telefone TEXT, 
+        ativo INTEGER DEFAULT 1)""")
+    
+    # Tabela de projetos
+    c.execute("""CREATE TABLE IF NOT EXISTS projetos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, 
+        nome TEXT NOT NULL, 
+        descricao TEXT, 
+        localizacao TEXT, 
+        orcamento_total REAL,
+        data_inicio DATE, 
+        data_fim_previsto DATE, 
+        status TEXT DEFAULT 'Em andamento', 
+        responsavel_id INTEGER,
+        proprietario_id INTEGER,
+        FOREIGN KEY (responsavel_id) REFERENCES usuarios (id),
+        FOREIGN KEY (proprietario_id) REFERENCES usuarios (id))""")
+    
+    # Tabela de relatórios diários
+    c.execute("""CREATE TABLE IF NOT EXISTS relatorios_diarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, 
+        data DATE NOT NULL, 
+        projeto_id INTEGER NOT NULL, 
+        usuario_id INTEGER NOT NULL,
+        temperatura TEXT, 
+        atividades TEXT NOT NULL, 
+        equipe TEXT, 
+        equipamentos TEXT, 
+        ocorrencias TEXT,
+        plano_amanha TEXT, 
+        status TEXT, 
+        produtividade INTEGER, 
+        observacoes TEXT,
+        FOREIGN KEY (projeto_id) REFERENCES projetos (id), 
+        FOREIGN KEY (usuario_id) REFERENCES usuarios (id))""")
+    
+    # Tabela de fotos
+    c.execute("""CREATE TABLE IF NOT EXISTS fotos_obra (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, 
+        relatorio_id INTEGER NOT NULL, 
+        foto_path TEXT NOT NULL,
+        descricao TEXT, 
+        atividade_principal TEXT,
+        data_upload DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (relatorio_id) REFERENCES relatorios_diarios (id))""")
+
+    # Tabela de acesso de usuários a projetos
+    c.execute("""CREATE TABLE IF NOT EXISTS usuarios_projetos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        projeto_id INTEGER NOT NULL,
+        data_associacao DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (usuario_id) REFERENCES usuarios (id),
+        FOREIGN KEY (projeto_id) REFERENCES projetos (id),
+        UNIQUE(usuario_id, projeto_id))""")
+
+    # Colunas que faltam em bancos criados por versões anteriores
+    adicionar_coluna(conn, "projetos", "proprietario_id", "INTEGER")
+    adicionar_coluna(conn, "fotos_obra", "atividade_principal", "TEXT")
+
+    # Inserir usuários padrão se não existirem
+    c.execute("SELECT COUNT(*) FROM usuarios")
+    if c.fetchone()[0] == 0:
+        usuarios_padrao = [
+            ('fiscal', 'Fiscal da Obra', 'fiscal@obra.com', hashlib.sha256('fiscal123'.encode()).hexdigest(), 'fiscal', '+258840000000'),
+            ('proprietario1', 'João Silva', 'joao@obra.com', hashlib.sha256('joao123'.encode()).hexdigest(), 'proprietario', '+258841111111'),
+            ('proprietario2', 'Maria Santos', 'maria@obra.com', hashlib.sha256('maria123'.encode()).hexdigest(), 'proprietario', '+258842222222'),
+            ('proprietario3', 'Antonio Pereira', 'antonio@obra.com', hashlib.sha256('antonio123'.encode()).hexdigest(), 'proprietario', '+258843333333'),
+            ('admin', 'Administrador', 'admin@obra.com', hashlib.sha256('admin123'.encode()).hexdigest(), 'admin', '+258860000000')
+        ]
+        c.executemany("INSERT INTO usuarios (username,nome,email,senha_hash,tipo,telefone) VALUES (?,?,?,?,?,?)", usuarios_padrao)
+
+    # Inserir projeto padrão se não existir
+    c.execute("SELECT COUNT(*) FROM projetos")
+    if c.fetchone()[0] == 0:
+        projetos_padrao = [
+            ('Obra Xai-Xai', 'Requalificação com expansão', 'Xai-Xai, Gaza', 2500000.0, '2025-02-01', '2025-08-01', 1, 2),
+            ('Condomínio Maputo', 'Residencial de luxo', 'Maputo', 3500000.0, '2025-01-15', '2025-10-30', 1, 3),
+            ('Escola Gaza', 'Escola secundária', 'Gaza', 1800000.0, '2025-03-01', '2025-11-15', 1, 4)
+        ]
+        c.executemany("""INSERT INTO projetos (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id)
+                         VALUES (?,?,?,?,?,?,?,?)""", projetos_padrao)
+
+def _migracao_tabelas_financeiras(conn):
+    # Tabelas que só existiam em controle_obra.db / dashboard_obra_backup.py
+    conn.execute("""CREATE TABLE IF NOT EXISTS materiais (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        projeto_id INTEGER NOT NULL,
+        material TEXT NOT NULL,
+        quantidade REAL,
+        unidade TEXT,
+        custo_unitario REAL,
+        data_entrada DATE,
+        fornecedor TEXT,
+        FOREIGN KEY (projeto_id) REFERENCES projetos (id))""")
+    adicionar_coluna(conn, "materiais", "fornecedor", "TEXT")
+
+    conn.execute("""CREATE TABLE IF NOT EXISTS custos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        projeto_id INTEGER NOT NULL,
+        categoria TEXT NOT NULL,
+        descricao TEXT,
+        valor REAL NOT NULL,
+        data DATE,
+        comprovante_path TEXT,
+        FOREIGN KEY (projeto_id) REFERENCES projetos (id))""")
+
+    conn.execute("""CREATE TABLE IF NOT EXISTS alertas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        projeto_id INTEGER NOT NULL,
+        tipo TEXT NOT NULL,
+        mensagem TEXT NOT NULL,
+        data_criacao DATETIME DEFAULT CURRENT_TIMESTAMP,
+        lido INTEGER DEFAULT 0,
+        FOREIGN KEY (projeto_id) REFERENCES projetos (id))""")
+
+def _migracao_caminhos_fotos(conn):
+    # Fotos gravadas no Windows ficaram com "\" no caminho, que não abre noutros sistemas
+    def normalizar(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        conn.execute(f"UPDATE fotos_obra SET foto_path = REPLACE(foto_path, '\\', '/') WHERE id IN ({marcadores})", ids)
+
+    executar_em_lotes(conn, 3, "fotos_obra", normalizar)
+
+def _migracao_indices_consultas(conn):
+    # Relatórios por projeto ordenados por data (lista, dashboard, último relatório
+    # e a procura por (data, projeto_id) em salvar_relatorio); cobre as colunas lidas
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_relatorios_projeto_data
+        ON relatorios_diarios (projeto_id, data, usuario_id, status, produtividade)""")
+    # Mesma ordenação sem filtro de projeto (visão de administrador)
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_relatorios_data
+        ON relatorios_diarios (data, projeto_id, usuario_id, status, produtividade)""")
+    # Fotos de um relatório (galeria, contagens e exclusões)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_relatorio ON fotos_obra (relatorio_id, data_upload)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_relatorio_atividade ON fotos_obra (relatorio_id, atividade_principal)")
+    # Controle de acesso: quem tem acesso a um projeto e projetos por responsável/proprietário
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_projetos_projeto ON usuarios_projetos (projeto_id, usuario_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_projetos_responsavel ON projetos (responsavel_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_projetos_proprietario ON projetos (proprietario_id)")
+    # Listagens ordenadas
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_projetos_data_inicio ON projetos (data_inicio)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_projetos_nome ON projetos (nome)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_nome ON usuarios (nome)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_tipo ON usuarios (tipo, ativo, nome)")
+
+def _migracao_versoes_dados(conn):
+    # Contadores de alteração por tabela, usados como parte da chave do cache de consultas
+    conn.execute("""CREATE TABLE IF NOT EXISTS versoes_dados (
+        chave TEXT PRIMARY KEY,
+        versao INTEGER NOT NULL DEFAULT 0)""")
+    conn.executemany("INSERT OR IGNORE INTO versoes_dados (chave, versao) VALUES (?, 0)",
+                     [(chave,) for chave in CHAVES_VERSAO])
+
+def _migracao_tamanho_fotos(conn):
+    adicionar_coluna(conn, "fotos_obra", "tamanho_bytes", "INTEGER")
+
+    # Fotos antigas: tamanho lido do disco (NULL quando o arquivo já não existe)
+    def medir(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        linhas = conn.execute(f"SELECT id, foto_path FROM fotos_obra WHERE id IN ({marcadores})", ids).fetchall()
+        conn.executemany("UPDATE fotos_obra SET tamanho_bytes = ? WHERE id = ?",
+                         [(os.path.getsize(l["foto_path"]) if os.path.exists(l["foto_path"]) else None, l["id"])
+                          for l in linhas])
+
+    executar_em_lotes(conn, 6, "fotos_obra", medir)
+
+def _sql_contribuicao_relatorio(ref, sinal):
+    """Corpo de trigger que soma (sinal 1) ou retira (sinal -1) o relatório NEW/OLD do resumo do projeto"""
+    return f"""
+        INSERT OR IGNORE INTO projeto_resumo (projeto_id) VALUES ({ref}.projeto_id);
+        UPDATE projeto_resumo SET
+            total_relatorios = total_relatorios + ({sinal}),
+            soma_produtividade = soma_produtividade + ({sinal}) * COALESCE({ref}.produtividade, 0),
+            contagem_produtividade = contagem_produtividade + ({sinal}) * ({ref}.produtividade IS NOT NULL),
+            ultimo_relatorio_id = (SELECT id FROM relatorios_diarios WHERE projeto_id = {ref}.projeto_id
+                                   ORDER BY data DESC, id DESC LIMIT 1)
+        WHERE projeto_id = {ref}.projeto_id;
+        INSERT INTO projeto_resumo_status (projeto_id, status, total)
+            VALUES ({ref}.projeto_id, COALESCE(NULLIF({ref}.status, ''), 'Não informado'), {sinal})
+            ON CONFLICT (projeto_id, status) DO UPDATE SET total = total + ({sinal});
+        DELETE FROM projeto_resumo_status WHERE projeto_id = {ref}.projeto_id AND total <= 0;"""
+
+def _sql_contribuicao_foto(ref, sinal):
+    """Corpo de trigger que soma ou retira a foto NEW/OLD do resumo do projeto do seu relatório"""
+    return f"""
+        UPDATE projeto_resumo SET
+            total_fotos = total_fotos + ({sinal}),
+            bytes_fotos = bytes_fotos + ({sinal}) * COALESCE({ref}.tamanho_bytes, 0)
+        WHERE projeto_id = (SELECT projeto_id FROM relatorios_diarios WHERE id = {ref}.relatorio_id);"""
+
+def _migracao_resumo_projetos(conn):
+    # Totais por projeto mantidos por triggers, para os cards e a grelha de projetos
+    conn.execute("""CREATE TABLE IF NOT EXISTS projeto_resumo (
+        projeto_id INTEGER PRIMARY KEY,
+        total_relatorios INTEGER NOT NULL DEFAULT 0,
+        soma_produtividade INTEGER NOT NULL DEFAULT 0,
+        contagem_produtividade INTEGER NOT NULL DEFAULT 0,
+        total_fotos INTEGER NOT NULL DEFAULT 0,
+        bytes_fotos INTEGER NOT NULL DEFAULT 0,
+        ultimo_relatorio_id INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS projeto_resumo_status (
+        projeto_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (projeto_id, status)) WITHOUT ROWID""")
+
+    triggers = {
+        "trg_resumo_relatorio_insert": f"AFTER INSERT ON relatorios_diarios BEGIN {_sql_contribuicao_relatorio('NEW', 1)} END",
+        "trg_resumo_relatorio_update": f"""AFTER UPDATE OF projeto_id, data, status, produtividade ON relatorios_diarios BEGIN
+            {_sql_contribuicao_relatorio('OLD', -1)} {_sql_contribuicao_relatorio('NEW', 1)} END""",
+        "trg_resumo_relatorio_delete": f"AFTER DELETE ON relatorios_diarios BEGIN {_sql_contribuicao_relatorio('OLD', -1)} END",
+        "trg_resumo_foto_insert": f"AFTER INSERT ON fotos_obra BEGIN {_sql_contribuicao_foto('NEW', 1)} END",
+        "trg_resumo_foto_update": f"""AFTER UPDATE OF relatorio_id, tamanho_bytes ON fotos_obra BEGIN
+            {_sql_contribuicao_foto('OLD', -1)} {_sql_contribuicao_foto('NEW', 1)} END""",
+        "trg_resumo_foto_delete": f"AFTER DELETE ON fotos_obra BEGIN {_sql_contribuicao_foto('OLD', -1)} END",
+        "trg_resumo_projeto_insert": "AFTER INSERT ON projetos BEGIN INSERT OR IGNORE INTO projeto_resumo (projeto_id) VALUES (NEW.id); END",
+        "trg_resumo_projeto_delete": """AFTER DELETE ON projetos BEGIN
+            DELETE FROM projeto_resumo WHERE projeto_id = OLD.id;
+            DELETE FROM projeto_resumo_status WHERE projeto_id = OLD.id; END""",
+    }
+    for nome, definicao in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nome} {definicao}")
+
+    reconstruir_resumo_projetos(conn)
+
+def _migracao_atividades(conn):
+    # Atividades e subatividades normalizadas; relatorios_diarios.atividades fica como texto de exibição
+    conn.execute("""CREATE TABLE IF NOT EXISTS atividades (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        relatorio_id INTEGER NOT NULL,
+        ordem INTEGER NOT NULL,
+        titulo TEXT NOT NULL,
+        FOREIGN KEY (relatorio_id) REFERENCES relatorios_diarios (id))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS subatividades (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        atividade_id INTEGER NOT NULL,
+        ordem INTEGER NOT NULL,
+        nome TEXT NOT NULL,
+        feito INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (atividade_id) REFERENCES atividades (id))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_atividades_relatorio ON atividades (relatorio_id, ordem, titulo)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_atividades_titulo ON atividades (titulo, relatorio_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subatividades_atividade ON subatividades (atividade_id, ordem, nome, feito)")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS trg_atividades_relatorio_delete AFTER DELETE ON relatorios_diarios BEGIN
+        DELETE FROM subatividades WHERE atividade_id IN (SELECT id FROM atividades WHERE relatorio_id = OLD.id);
+        DELETE FROM atividades WHERE relatorio_id = OLD.id; END""")
+
+    # Relatórios existentes: o texto é parseado uma única vez; os gravados
+    # entretanto pela aplicação já têm atividades e são ignorados
+    def estruturar(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        linhas = conn.execute(f"""SELECT id, atividades FROM relatorios_diarios r
+                                  WHERE id IN ({marcadores})
+                                  AND NOT EXISTS (SELECT 1 FROM atividades a WHERE a.relatorio_id = r.id)""", ids).fetchall()
+        for linha in linhas:
+            gravar_atividades(conn, linha["id"], parse_atividades(linha["atividades"] or ""))
+
+    executar_em_lotes(conn, 8, "relatorios_diarios", estruturar)
+
+def _migracao_derivados_fotos(conn):
+    # Caminhos dos derivados (miniatura da grelha, média e zoom), gerados em segundo plano
+    for coluna in ("miniatura_path", "media_path", "zoom_path"):
+        adicionar_coluna(conn, "fotos_obra", coluna, "TEXT")
+
+def _migracao_armazenamento_conteudo(conn):
+    # Um registo por conteúdo (SHA-256) guardado em disco; `referencias` conta as
+    # linhas de fotos_obra que apontam para ele e é mantido pelos triggers
+    conn.execute("""CREATE TABLE IF NOT EXISTS arquivos_fotos (
+        hash TEXT PRIMARY KEY,
+        caminho TEXT NOT NULL,
+        tamanho_bytes INTEGER NOT NULL,
+        referencias INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID""")
+    adicionar_coluna(conn, "fotos_obra", "conteudo_hash", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_conteudo ON fotos_obra (conteudo_hash)")
+
+    triggers = {
+        "trg_arquivos_foto_insert": """AFTER INSERT ON fotos_obra WHEN NEW.conteudo_hash IS NOT NULL BEGIN
+            UPDATE arquivos_fotos SET referencias = referencias + 1 WHERE hash = NEW.conteudo_hash; END""",
+        "trg_arquivos_foto_update": """AFTER UPDATE OF conteudo_hash ON fotos_obra BEGIN
+            UPDATE arquivos_fotos SET referencias = referencias - 1 WHERE hash = OLD.conteudo_hash;
+            UPDATE arquivos_fotos SET referencias = referencias + 1 WHERE hash = NEW.conteudo_hash; END""",
+        "trg_arquivos_foto_delete": """AFTER DELETE ON fotos_obra WHEN OLD.conteudo_hash IS NOT NULL BEGIN
+            UPDATE arquivos_fotos SET referencias = referencias - 1 WHERE hash = OLD.conteudo_hash; END""",
+    }
+    for nome, definicao in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nome} {definicao}")
+
+    # Fotos antigas ficam no caminho atual; cópias do mesmo conteúdo passam a
+    # usar o arquivo (e os derivados) da primeira e os seus arquivos são apagados
+    # depois do commit do lote
+    def enderecar(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        linhas = conn.execute(f"""SELECT id, foto_path, miniatura_path, media_path, zoom_path FROM fotos_obra
+                                  WHERE id IN ({marcadores}) AND conteudo_hash IS NULL""", ids).fetchall()
+        redundantes = set()
+        for linha in linhas:
+            if not os.path.exists(linha["foto_path"]):
+                continue
+            conteudo_hash, tamanho = processamento_fotos.hash_do_arquivo(linha["foto_path"])
+            canonica = conn.execute("""SELECT foto_path, miniatura_path, media_path, zoom_path FROM fotos_obra
+                                       WHERE conteudo_hash = ? LIMIT 1""", (conteudo_hash,)).fetchone()
+            if canonica is None:
+                conn.execute("INSERT OR IGNORE INTO arquivos_fotos (hash, caminho, tamanho_bytes) VALUES (?, ?, ?)",
+                             (conteudo_hash, linha["foto_path"], tamanho))
+                conn.execute("UPDATE fotos_obra SET conteudo_hash = ? WHERE id = ?", (conteudo_hash, linha["id"]))
+            else:
+                redundantes.update(set(arquivos_da_foto(linha)) - set(arquivos_da_foto(canonica)))
+                conn.execute("""UPDATE fotos_obra SET conteudo_hash = ?, foto_path = ?, miniatura_path = ?, media_path = ?, zoom_path = ?
+                                WHERE id = ?""", (conteudo_hash, *canonica, linha["id"]))
+
+        def apagar_redundantes():
+            for caminho in redundantes:
+                if os.path.exists(caminho):
+                    os.remove(caminho)
+        return apagar_redundantes
+
+    executar_em_lotes(conn, 10, "fotos_obra", enderecar, tamanho_lote=100)
+
+def _migracao_originais_arquivados(conn):
+    # Arquivo enviado pelo usuário, guardado à parte quando a foto foi reduzida na entrada
+    adicionar_coluna(conn, "arquivos_fotos", "caminho_original", "TEXT")
+
+def _migracao_metadados_fotos(conn):
+    # Metadados EXIF em colunas, para filtrar a galeria por data de captura e área sem abrir arquivos
+    for coluna, definicao in (("data_captura", "TEXT"), ("latitude", "REAL"), ("longitude", "REAL"),
+                              ("camera", "TEXT"), ("largura", "INTEGER"), ("altura", "INTEGER")):
+        adicionar_coluna(conn, "fotos_obra", coluna, definicao)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_captura ON fotos_obra (data_captura)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_localizacao ON fotos_obra (latitude, longitude)")
+
+    # Fotos antigas: só o cabeçalho de cada arquivo é lido
+    def ler_metadados(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        linhas = conn.execute(f"SELECT id, foto_path FROM fotos_obra WHERE id IN ({marcadores})", ids).fetchall()
+        valores = []
+        for linha in linhas:
+            try:
+                metadados = processamento_fotos.extrair_metadados(linha["foto_path"])
+            except Exception:
+                continue
+            valores.append([*(metadados[coluna] for coluna in COLUNAS_METADADOS), linha["id"]])
+        conn.executemany(f"UPDATE fotos_obra SET {', '.join(f'{coluna} = ?' for coluna in COLUNAS_METADADOS)} WHERE id = ?",
+                         valores)
+
+    executar_em_lotes(conn, 12, "fotos_obra", ler_metadados)
+
+def _migracao_piramides_fotos(conn):
+    # Descritor .dzi da pirâmide de tiles usada pelo visor de zoom
+    adicionar_coluna(conn, "fotos_obra", "piramide_path", "TEXT")
+
+def _migracao_verificacao_armazenamento(conn):
+    # Índices para saber se um arquivo em disco é usado por alguma linha sem varrer as tabelas
+    for coluna in ("foto_path", "miniatura_path", "media_path", "zoom_path", "piramide_path"):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_fotos_{coluna} ON fotos_obra ({coluna})")
+    for coluna in ("caminho", "caminho_original"):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_arquivos_{coluna} ON arquivos_fotos ({coluna})")
+    # Onde parou cada fase da verificação, para a execução seguinte continuar
+    conn.execute("""CREATE TABLE IF NOT EXISTS verificacao_armazenamento (
+        fase TEXT PRIMARY KEY,
+        cursor TEXT NOT NULL DEFAULT '',
+        concluida INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID""")
+    # Arquivos sem referência encontrados em disco, apagados depois da carência
+    conn.execute("""CREATE TABLE IF NOT EXISTS arquivos_orfaos (
+        caminho TEXT PRIMARY KEY,
+        tamanho_bytes INTEGER NOT NULL,
+        detectado_em REAL NOT NULL) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orfaos_detectado ON arquivos_orfaos (detectado_em)")
+
+def _migracao_hash_perceptual(conn):
+    # dHash de 64 bits de cada foto, para encontrar fotos quase iguais
+    adicionar_coluna(conn, "fotos_obra", "hash_perceptual", "INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_hash_perceptual ON fotos_obra (hash_perceptual)")
+    # O hash dividido em 8 bandas de 8 bits: dois hashes a distância de Hamming
+    # até 7 têm pelo menos uma banda igual, e cada banda é uma procura no índice
+    conn.execute("""CREATE TABLE IF NOT EXISTS bandas_hash_fotos (
+        banda INTEGER NOT NULL,
+        valor INTEGER NOT NULL,
+        foto_id INTEGER NOT NULL,
+        PRIMARY KEY (banda, valor, foto_id)) WITHOUT ROWID""")
+
+    def bandas(ref):
+        return [(banda, f"({ref}.hash_perceptual >> {8 * banda}) & 255", f"{ref}.id") for banda in range(8)]
+    inserir = f"""INSERT INTO bandas_hash_fotos (banda, valor, foto_id)
+                  SELECT * FROM (VALUES {', '.join(f'({b}, {v}, {i})' for b, v, i in bandas('NEW'))})
+                  WHERE NEW.hash_perceptual IS NOT NULL;"""
+    apagar = f"""DELETE FROM bandas_hash_fotos
+                 WHERE {' OR '.join(f'(banda = {b} AND valor = {v} AND foto_id = {i})' for b, v, i in bandas('OLD'))};"""
+    triggers = {
+        "trg_bandas_hash_insert": f"AFTER INSERT ON fotos_obra BEGIN {inserir} END",
+        "trg_bandas_hash_update": f"AFTER UPDATE OF hash_perceptual ON fotos_obra BEGIN {apagar} {inserir} END",
+        "trg_bandas_hash_delete": f"AFTER DELETE ON fotos_obra WHEN OLD.hash_perceptual IS NOT NULL BEGIN {apagar} END",
+    }
+    for nome, definicao in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nome} {definicao}")
+
+    # Fotos antigas: cada uma é descodificada já reduzida (draft do JPEG)
+    def calcular(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        linhas = conn.execute(f"SELECT id, foto_path FROM fotos_obra WHERE id IN ({marcadores}) AND hash_perceptual IS NULL",
+                              ids).fetchall()
+        valores = []
+        for linha in linhas:
+            try:
+                valores.append((processamento_fotos.hash_perceptual(linha["foto_path"]), linha["id"]))
+            except Exception:
+                continue
+        conn.executemany("UPDATE fotos_obra SET hash_perceptual = ? WHERE id = ?", valores)
+
+    executar_em_lotes(conn, 15, "fotos_obra", calcular, tamanho_lote=100)
+
+def _migracao_armazenamento_frio(conn):
+    # Conteúdo movido para o armazenamento frio: `caminho` passa a apontar para o
+    # original no diretório frio e `caminho_reduzido` para a versão que fica no quente
+    adicionar_coluna(conn, "arquivos_fotos", "caminho_reduzido", "TEXT")
+    adicionar_coluna(conn, "arquivos_fotos", "movido_frio_em", "DATETIME")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_arquivos_caminho_reduzido ON arquivos_fotos (caminho_reduzido)")
+
+def _migracao_importacao_legado(conn):
+    # Progresso e correspondência de ids de cada banco antigo importado (origem = caminho do arquivo)
+    conn.execute("""CREATE TABLE IF NOT EXISTS importacao_legado (
+        origem TEXT NOT NULL,
+        tabela TEXT NOT NULL,
+        ultimo_id INTEGER NOT NULL,
+        PRIMARY KEY (origem, tabela)) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS mapa_legado (
+        origem TEXT NOT NULL,
+        tabela TEXT NOT NULL,
+        id_antigo INTEGER NOT NULL,
+        id_novo INTEGER NOT NULL,
+        PRIMARY KEY (origem, tabela, id_antigo)) WITHOUT ROWID""")
+
+def _migracao_revisao_relatorios(conn):
+    # Revisão de cada relatório, parte da chave do cache de PDFs
+    adicionar_coluna(conn, "relatorios_diarios", "revisao", "INTEGER NOT NULL DEFAULT 0")
+    triggers = {
+        "trg_revisao_projeto_nome": """AFTER UPDATE OF nome ON projetos WHEN NEW.nome IS NOT OLD.nome BEGIN
+            UPDATE relatorios_diarios SET revisao = revisao + 1 WHERE projeto_id = NEW.id; END""",
+        "trg_revisao_usuario_nome": """AFTER UPDATE OF nome ON usuarios WHEN NEW.nome IS NOT OLD.nome BEGIN
+            UPDATE relatorios_diarios SET revisao = revisao + 1 WHERE usuario_id = NEW.id; END""",
+    }
+    for nome, definicao in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nome} {definicao}")
+
+def _migracao_fila_pdfs(conn):
+    # Tarefas de geração de PDFs, que sobrevivem aos reinícios do servidor
+    conn.execute("""CREATE TABLE IF NOT EXISTS tarefas_pdf (
+        relatorio_id INTEGER NOT NULL,
+        revisao INTEGER NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'na_fila',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        erro TEXT,
+        criada_em DATETIME DEFAULT CURRENT_TIMESTAMP,
+        atualizada_em DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (relatorio_id, revisao)) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tarefas_pdf_estado ON tarefas_pdf (estado, criada_em, relatorio_id)")
+
+def _ligar_ou_copiar(origem, destino):
+    """Hard link de `origem` em `destino`; copia se o sistema de arquivos não permitir"""
+    try:
+        os.link(origem, destino)
+    except OSError:
+        shutil.copy2(origem, destino)
+
+def _migracao_nomes_piramides(conn):
+    # As pirâmides ficam em static/, servidas sem login, e o nome antigo (o da foto)
+    # era fácil de adivinhar: passam a ter um nome aleatório, como as novas. Sem os
+    # arquivos, a pirâmide é descartada e gerada de novo quando a foto for aberta.
+    # O lote liga os arquivos ao nome novo e só apaga os antigos depois do commit
+    def renomear(conn, ids):
+        marcadores = ",".join("?" * len(ids))
+        antigos = {linha["piramide_path"] for linha in conn.execute(
+            f"SELECT piramide_path FROM fotos_obra WHERE id IN ({marcadores}) AND piramide_path IS NOT NULL", ids)}
+        substituidos = []
+        for antigo in antigos:
+            if re.fullmatch(r"[0-9a-f]{32}\.dzi", os.path.basename(antigo)):
+                continue
+            novo = processamento_fotos.caminho_piramide(os.path.dirname(antigo))
+            try:
+                shutil.copytree(processamento_fotos.pasta_tiles(antigo), processamento_fotos.pasta_tiles(novo),
+                                copy_function=_ligar_ou_copiar)
+                _ligar_ou_copiar(antigo, novo)
+            except OSError:
+                shutil.rmtree(processamento_fotos.pasta_tiles(novo), ignore_errors=True)
+                novo = None
+            conn.execute("UPDATE fotos_obra SET piramide_path = ? WHERE piramide_path = ?", (novo, antigo))
+            substituidos.append(antigo)
+
+        def apagar_antigos():
+            for antigo in substituidos:
+                shutil.rmtree(processamento_fotos.pasta_tiles(antigo), ignore_errors=True)
+                if os.path.exists(antigo):
+                    os.remove(antigo)
+        return apagar_antigos
+
+    executar_em_lotes(conn, 21, "fotos_obra", renomear, tamanho_lote=100)
+
+def _migracao_indice_usuario_relatorios(conn):
+    # trg_revisao_usuario_nome procura os relatórios do usuário renomeado
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_relatorios_usuario ON relatorios_diarios (usuario_id)")
+
+MIGRACOES = [
+    Migracao(1, "Schema base e dados padrão", _migracao_schema_base),
+    Migracao(2, "Tabelas de materiais, custos e alertas", _migracao_tabelas_financeiras),
+    Migracao(3, "Normalizar separadores dos caminhos das fotos", _migracao_caminhos_fotos, em_lotes=True),
+    Migracao(4, "Índices das consultas de relatórios, fotos e acessos", _migracao_indices_consultas),
+    Migracao(5, "Contadores de alteração das tabelas", _migracao_versoes_dados),
+    Migracao(6, "Tamanho em bytes das fotos", _migracao_tamanho_fotos, em_lotes=True),
+    Migracao(7, "Resumo por projeto mantido por triggers", _migracao_resumo_projetos),
+    Migracao(8, "Atividades e subatividades em tabelas próprias", _migracao_atividades, em_lotes=True),
+    Migracao(9, "Derivados das fotos", _migracao_derivados_fotos),
+    Migracao(10, "Armazenamento das fotos por conteúdo", _migracao_armazenamento_conteudo, em_lotes=True),
+    Migracao(11, "Originais arquivados das fotos", _migracao_originais_arquivados),
+    Migracao(12, "Metadados EXIF das fotos", _migracao_metadados_fotos, em_lotes=True),
+    Migracao(13, "Pirâmides de zoom das fotos", _migracao_piramides_fotos),
+    Migracao(14, "Verificação do armazenamento das fotos", _migracao_verificacao_armazenamento),
+    Migracao(15, "Hash perceptual das fotos", _migracao_hash_perceptual, em_lotes=True),
+    Migracao(16, "Armazenamento frio das fotos", _migracao_armazenamento_frio),
+    Migracao(17, "Importação do banco antigo", _migracao_importacao_legado),
+    Migracao(18, "Revisão dos relatórios", _migracao_revisao_relatorios),
+    Migracao(19, "Fila de geração de PDFs", _migracao_fila_pdfs),
+    Migracao(20, "Índice dos relatórios por usuário", _migracao_indice_usuario_relatorios),
+    Migracao(21, "Nomes aleatórios das pirâmides de zoom", _migracao_nomes_piramides, em_lotes=True),
+]
+
+def versao_schema(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def executar_migracoes(conn):
+    """Aplica, por ordem, as migrações com versão acima do PRAGMA user_version.
+
+    Cada passo atualiza o user_version na mesma transação em que é aplicado,
+    e a versão é relida depois do BEGIN IMMEDIATE para que dois processos a
+    iniciar ao mesmo tempo não apliquem o mesmo passo duas vezes.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_migracoes (
+        versao INTEGER PRIMARY KEY,
+        descricao TEXT NOT NULL,
+        aplicada_em DATETIME DEFAULT CURRENT_TIMESTAMP,
+        duracao_ms REAL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS migracoes_lotes (
+        versao INTEGER PRIMARY KEY,
+        ultimo_id INTEGER NOT NULL)""")
+    conn.commit()
+
+    aplicadas = []
+    for migracao in sorted(MIGRACOES, key=lambda m: m.versao):
+        if versao_schema(conn) >= migracao.versao:
+            continue
+
+        inicio = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        if versao_schema(conn) >= migracao.versao:
+            conn.rollback()
+            continue
+        try:
+            migracao.aplicar(conn)
+            # Migrações em lotes fazem commit a cada lote; a versão volta a
+            # ser conferida sob um novo bloqueio antes de ser registada
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        if versao_schema(conn) >= migracao.versao:
+            conn.rollback()
+            continue
+
+        conn.execute(f"PRAGMA user_version = {int(migracao.versao)}")
+        conn.execute("INSERT OR REPLACE INTO schema_migracoes (versao, descricao, duracao_ms) VALUES (?, ?, ?)",
+                     (migracao.versao, migracao.descricao, (time.perf_counter() - inicio) * 1000))
+        conn.execute("DELETE FROM migracoes_lotes WHERE versao = ?", (migracao.versao,))
+        conn.commit()
+        aplicadas.append(migracao.versao)
+    return aplicadas
+
+# ============================================
+# RESUMO POR PROJETO
+# ============================================
+_CAMPOS_RESUMO = ("total_relatorios", "soma_produtividade", "contagem_produtividade",
+                  "total_fotos", "bytes_fotos", "ultimo_relatorio_id")
+
+def _calcular_resumo_projetos(conn):
+    """Resumo calculado do zero a partir das tabelas de relatórios e fotos"""
+    resumo = {}
+
+    def projeto(projeto_id):
+        return resumo.setdefault(projeto_id, {"total_relatorios": 0, "soma_produtividade": 0, "contagem_produtividade": 0,
+                                              "total_fotos": 0, "bytes_fotos": 0, "ultimo_relatorio_id": None})
+
+    for linha in conn.execute("SELECT id FROM projetos"):
+        projeto(linha["id"])
+    for linha in conn.execute("""SELECT projeto_id, COUNT(*) AS total, COALESCE(SUM(produtividade), 0) AS soma,
+                                        COUNT(produtividade) AS contagem
+                                 FROM relatorios_diarios GROUP BY projeto_id"""):
+        projeto(linha["projeto_id"]).update(total_relatorios=linha["total"], soma_produtividade=linha["soma"],
+                                            contagem_produtividade=linha["contagem"])
+    for linha in conn.execute("""SELECT r.projeto_id, COUNT(*) AS total, COALESCE(SUM(f.tamanho_bytes), 0) AS bytes
+                                 FROM fotos_obra f JOIN relatorios_diarios r ON f.relatorio_id = r.id
+                                 GROUP BY r.projeto_id"""):
+        projeto(linha["projeto_id"]).update(total_fotos=linha["total"], bytes_fotos=linha["bytes"])
+    for projeto_id, valores in resumo.items():
+        ultimo = conn.execute("""SELECT id FROM relatorios_diarios WHERE projeto_id = ?
+                                 ORDER BY data DESC, id DESC LIMIT 1""", (projeto_id,)).fetchone()
+        valores["ultimo_relatorio_id"] = ultimo["id"] if ultimo else None
+
+    status = {(linha["projeto_id"], linha["status"]): linha["total"] for linha in conn.execute(
+        """SELECT projeto_id, COALESCE(NULLIF(status, ''), 'Não informado') AS status, COUNT(*) AS total
+           FROM relatorios_diarios GROUP BY 1, 2""")}
+    return resumo, status
+
+def reconstruir_resumo_projetos(conn, apenas_verificar=False):
+    """Compara projeto_resumo/projeto_resumo_status com os valores calculados do zero.
+
+    Retorna a lista de divergências encontradas. Sem `apenas_verificar`, as
+    tabelas de resumo são regravadas com os valores calculados. Deve correr
+    dentro de uma transação de escrita.
+    """
+    esperado, esperado_status = _calcular_resumo_projetos(conn)
+    guardado = {linha["projeto_id"]: {campo: linha[campo] for campo in _CAMPOS_RESUMO}
+                for linha in conn.execute("SELECT * FROM projeto_resumo")}
+    guardado_status = {(linha["projeto_id"], linha["status"]): linha["total"]
+                       for linha in conn.execute("SELECT projeto_id, status, total FROM projeto_resumo_status")}
+
+    divergencias = []
+    for projeto_id in sorted(set(esperado) | set(guardado)):
+        for campo in _CAMPOS_RESUMO:
+            valor_guardado = guardado.get(projeto_id, {}).get(campo)
+            valor_esperado = esperado.get(projeto_id, {}).get(campo)
+            if valor_guardado != valor_esperado:
+                divergencias.append(f"Projeto {projeto_id}: {campo} = {valor_guardado}, esperado {valor_esperado}")
+    for projeto_id, status in sorted(set(esperado_status) | set(guardado_status)):
+        valor_guardado = guardado_status.get((projeto_id, status), 0)
+        valor_esperado = esperado_status.get((projeto_id, status), 0)
+        if valor_guardado != valor_esperado:
+            divergencias.append(f"Projeto {projeto_id}: status '{status}' = {valor_guardado}, esperado {valor_esperado}")
+
+    if divergencias and not apenas_verificar:
+        conn.execute("DELETE FROM projeto_resumo")
+        conn.execute("DELETE FROM projeto_resumo_status")
+        conn.executemany(f"INSERT INTO projeto_resumo (projeto_id, {', '.join(_CAMPOS_RESUMO)}) VALUES (?{', ?' * len(_CAMPOS_RESUMO)})",
+                         [(projeto_id, *(valores[campo] for campo in _CAMPOS_RESUMO)) for projeto_id, valores in esperado.items()])
+        conn.executemany("INSERT INTO projeto_resumo_status (projeto_id, status, total) VALUES (?, ?, ?)",
+                         [(projeto_id, status, total) for (projeto_id, status), total in esperado_status.items()])
+        marcar_alteracao("projeto_resumo", conn=conn)
+    return divergencias
+
+# ============================================
+# FUNÇÕES AUXILIARES - ATUALIZADA
+# ============================================
+def init_database(conn=None):
+    conn = conn or obter_conexao()
+    executar_migracoes(conn)
+    return conn
+
+class EstadoBanco:
+    """Estado da preparação do banco no processo atual"""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.schema_pronto = False
+        self.versao_schema = None
+        self.migracoes_aplicadas = []
+        self.preparado_em = None
+        self.duracao_preparo = None
+
+@st.cache_resource
+def preparar_banco(caminho):
+    """Cria o schema e os dados padrão uma única vez por processo.
+
+    O Streamlit reexecuta o script a cada interação; com o resultado em
+    cache_resource, os reruns seguintes não executam DDL, verificações de
+    dados padrão nem commits.
+    """
+    estado = EstadoBanco(caminho)
+    inicio = time.perf_counter()
+    conn = obter_gerenciador_conexoes(caminho).conexao()
+    with metricas.medir("banco.init_database"):
+        estado.migracoes_aplicadas = executar_migracoes(conn)
+    estado.versao_schema = versao_schema(conn)
+    estado.duracao_preparo = time.perf_counter() - inicio
+    estado.preparado_em = datetime.datetime.now()
+    estado.schema_pronto = True
+    return estado
+
+def usar_banco(caminho):
+    """Aponta as funções de acesso a dados para outro arquivo de banco e prepara o schema"""
+    global CAMINHO_BANCO, gerenciador_conexoes, contadores_alteracao
+    CAMINHO_BANCO = caminho
+    gerenciador_conexoes = obter_gerenciador_conexoes(caminho)
+    contadores_alteracao = obter_contadores_alteracao(caminho)
+    return preparar_banco(caminho)
+
+# ============================================
+# CACHE DE CONSULTAS
+# ============================================
+# Chaves da tabela versoes_dados: uma por tabela, mais "acessos" para as
+# associações de usuários a projetos (responsável, proprietário e usuarios_projetos).
+# As tabelas de resumo seguem as de relatórios e fotos pelos triggers;
+# "projeto_resumo" só muda quando o resumo é reconstruído.
+CHAVES_VERSAO = ("usuarios", "projetos", "usuarios_projetos", "relatorios_diarios", "fotos_obra", "acessos",
+                 "projeto_resumo")
+
+def marcar_alteracao(*chaves, conn=None):
+    """Incrementa os contadores de alteração dentro da transação de escrita atual.
+
+    O incremento é confirmado junto com os dados, por isso nenhuma leitura
+    vê dados novos com a versão antiga, mesmo quando a escrita vem de outro
+    processo (ferramentas de linha de comando). Depois do commit, a cópia
+    em memória dos contadores volta a ser lida do banco.
+
+    As migrações passam a sua `conn`, que pode ser de outro banco (benchmark,
+    verificação de planos): o incremento fica nessa transação e a conexão da
+    thread não é aberta nem tocada.
+    """
+    conn = conn or obter_conexao()
+    conn.executemany(
+        """INSERT INTO versoes_dados (chave, versao) VALUES (?, 1)
+           ON CONFLICT(chave) DO UPDATE SET versao = versao + 1""",
+        [(chave,) for chave in chaves])
+    # Commits de outras conexões já mudam o PRAGMA data_version lido pelos contadores
+    if conn is gerenciador_conexoes.conexao_aberta():
+        apos_commit(contadores_alteracao.invalidar)
+
+class ContadoresAlteracao:
+    """Cópia em memória da tabela versoes_dados, partilhada pelas threads do processo.
+
+    Só volta ao banco quando o PRAGMA data_version da conexão da thread muda
+    (houve um commit noutra conexão, deste ou de outro processo) ou depois de
+    um commit com `marcar_alteracao` neste processo. Os contadores só crescem,
+    por isso uma leitura mais antiga nunca substitui uma mais recente.
+    """
+
+    def __init__(self):
+        self._trava = threading.Lock()
+        self._versoes = {}
+        self._geracao = 0
+        self._carregada = -1
+        self._local = threading.local()
+
+    def invalidar(self):
+        with self._trava:
+            self._geracao += 1
+
+    def atuais(self, conn, chaves):
+        if conn.in_transaction:
+            # Dentro de uma escrita, as leituras veem os incrementos ainda por confirmar
+            versoes = {linha["chave"]: linha["versao"] for linha in conn.execute(
+                f"SELECT chave, versao FROM versoes_dados WHERE chave IN ({','.join('?' * len(chaves))})", chaves)}
+            return tuple(versoes.get(chave, 0) for chave in chaves)
+
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        with self._trava:
+            geracao = self._geracao
+            if (self._carregada == geracao and getattr(self._local, "conn", None) is conn
+                    and self._local.data_version == data_version):
+                return tuple(self._versoes.get(chave, 0) for chave in chaves)
+
+        lidas = conn.execute("SELECT chave, versao FROM versoes_dados").fetchall()
+        self._local.conn, self._local.data_version = conn, data_version
+        with self._trava:
+            for linha in lidas:
+                if linha["versao"] > self._versoes.get(linha["chave"], 0):
+                    self._versoes[linha["chave"]] = linha["versao"]
+            if self._geracao == geracao:
+                self._carregada = geracao
+            return tuple(self._versoes.get(chave, 0) for chave in chaves)
+
+@st.cache_resource
+def obter_contadores_alteracao(caminho):
+    return ContadoresAlteracao()
+
+contadores_alteracao = obter_contadores_alteracao(CAMINHO_BANCO)
+
+def versoes_atuais(*chaves):
+    """Versões atuais de `chaves`, na mesma ordem (0 para chaves ainda sem registro)"""
+    return contadores_alteracao.atuais(obter_conexao(), chaves)
+
+class CacheConsultas:
+    """Cache LRU dos resultados das funções obter_*, partilhado por todas as sessões"""
+
+    def __init__(self, max_entradas=1024):
+        self.max_entradas = max_entradas
+        self._trava = threading.Lock()
+        self._entradas = OrderedDict()
+        self._estatisticas = {}
+        self._local = threading.local()
+
+    @property
+    def ativo(self):
+        return not getattr(self._local, "ignorar", False)
+
+    @contextmanager
+    def ignorado(self):
+        """Executa as consultas da thread atual diretamente no banco"""
+        anterior = getattr(self._local, "ignorar", False)
+        self._local.ignorar = True
+        try:
+            yield
+        finally:
+            self._local.ignorar = anterior
+
+    def buscar(self, nome, chave):
+        with self._trava:
+            contagem = self._estatisticas.setdefault(nome, [0, 0])
+            if chave in self._entradas:
+                self._entradas.move_to_end(chave)
+                contagem[0] += 1
+                return True, self._entradas[chave]
+            contagem[1] += 1
+            return False, None
+
+    def guardar(self, chave, valor):
+        with self._trava:
+            self._entradas[chave] = valor
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def limpar(self):
+        with self._trava:
+            self._entradas.clear()
+            self._estatisticas.clear()
+
+    def resumo(self):
+        with self._trava:
+            itens = sorted(self._estatisticas.items())
+            entradas = len(self._entradas)
+        linhas = []
+        for nome, (acertos, falhas) in itens:
+            total = acertos + falhas
+            linhas.append({"Função": nome, "Acertos": acertos, "Falhas": falhas,
+                           "Taxa de acerto": f"{acertos / total:.0%}" if total else "-"})
+        return linhas, entradas
+
+@st.cache_resource
+def obter_cache_consultas():
+    return CacheConsultas()
+
+cache_consultas = obter_cache_consultas()
+
+def em_cache(*chaves):
+    """Decorador read-through: a chave inclui os argumentos e as versões de `chaves`"""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def envoltorio(*args, **kwargs):
+            if not cache_consultas.ativo:
+                return funcao(*args, **kwargs)
+
+            chave = (funcao.__name__, args, tuple(sorted(kwargs.items())), versoes_atuais(*chaves))
+            encontrado, valor = cache_consultas.buscar(funcao.__name__, chave)
+            if not encontrado:
+                valor = funcao(*args, **kwargs)
+                cache_consultas.guardar(chave, valor)
+            # Cópia da lista para que quem chama não altere o resultado guardado
+            return list(valor) if isinstance(valor, list) else valor
+        return envoltorio
+    return decorador
+
+# ============================================
+# CONTROLE DE ACESSO A PROJETOS
+# ============================================
+def resolver_projetos_visiveis(usuario_id):
+    """Projetos associados ao usuário ou dos quais é responsável/proprietário"""
+    c = obter_conexao().cursor()
+    c.execute("""
+        SELECT projeto_id FROM usuarios_projetos WHERE usuario_id = ?
+        UNION
+        SELECT id FROM projetos WHERE responsavel_id = ? OR proprietario_id = ?
+    """, (usuario_id, usuario_id, usuario_id))
+    return frozenset(linha[0] for linha in c.fetchall())
+
+def projetos_visiveis(usuario_id, usuario_tipo=None):
+    """Conjunto de projetos visíveis, resolvido uma vez por sessão.
+
+    Retorna None para administradores (sem restrição). O resultado fica em
+    st.session_state junto com a versão de "acessos", que é incrementada
+    sempre que associações, responsáveis ou proprietários mudam.
+    """
+    if usuario_tipo == "admin":
+        return None
+
+    versao, = versoes_atuais("acessos")
+    em_sessao = get_script_run_ctx() is not None
+    if em_sessao:
+        guardado = st.session_state.get("_projetos_visiveis")
+        if guardado and guardado[0] == usuario_id and guardado[1] == versao:
+            return guardado[2]
+
+    ids = resolver_projetos_visiveis(usuario_id)
+    if em_sessao:
+        st.session_state["_projetos_visiveis"] = (usuario_id, versao, ids)
+    return ids
+
+def invalidar_acessos():
+    """Força a nova resolução dos projetos visíveis (chamar dentro da transação de escrita)"""
+    marcar_alteracao("acessos")
+
+def filtro_projetos(coluna, ids):
+    """Condição SQL (com parâmetros ligados) que restringe `coluna` a `ids`"""
+    if not ids:
+        return "0", []
+    return f"{coluna} IN ({','.join('?' * len(ids))})", sorted(ids)
+
+def verificar_login(username, password):
+    c = obter_conexao().cursor()
+    hash_senha = hashlib.sha256(password.encode()).hexdigest()
+    c.execute("SELECT id,username,nome,tipo FROM usuarios WHERE username=? AND senha_hash=? AND ativo=1", (username, hash_senha))
+    return c.fetchone()
+
+@em_cache("projetos", "usuarios")
+def obter_projetos():
+    c = obter_conexao().cursor()
+    c.execute("""SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
+                 FROM projetos p 
+                 LEFT JOIN usuarios u ON p.responsavel_id = u.id
+                 LEFT JOIN usuarios up ON p.proprietario_id = up.id
+                 ORDER BY p.data_inicio DESC""")
+    return c.fetchall()
+
+@em_cache("projetos", "usuarios", "acessos")
+def obter_projetos_por_usuario(usuario_id, usuario_tipo):
+    """Obtém projetos que um usuário tem acesso"""
+    c = obter_conexao().cursor()
+    
+    if usuario_tipo == 'admin':
+        # Admin vê todos os projetos
+        c.execute("""
+            SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
+            FROM projetos p 
+            LEFT JOIN usuarios u ON p.responsavel_id = u.id
+            LEFT JOIN usuarios up ON p.proprietario_id = up.id
+            ORDER BY p.data_inicio DESC
+        """)
+    elif usuario_tipo == 'fiscal':
+        # Fiscal vê todos os projetos
+        c.execute("""
+            SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
+            FROM projetos p 
+            LEFT JOIN usuarios u ON p.responsavel_id = u.id
+            LEFT JOIN usuarios up ON p.proprietario_id = up.id
+            ORDER BY p.data_inicio DESC
+        """)
+    else:
+        # Proprietário vê apenas seus projetos
+        condicao, params = filtro_projetos("p.id", projetos_visiveis(usuario_id, usuario_tipo))
+        c.execute(f"""
+            SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
+            FROM projetos p 
+            LEFT JOIN usuarios u ON p.responsavel_id = u.id
+            LEFT JOIN usuarios up ON p.proprietario_id = up.id
+            WHERE {condicao}
+            ORDER BY p.data_inicio DESC
+        """, params)
+    
+    return c.fetchall()
+
+@em_cache("usuarios")
+def obter_usuarios():
+    c = obter_conexao().cursor()
+    c.execute("SELECT * FROM usuarios ORDER BY nome")
+    return c.fetchall()
+
+@em_cache("usuarios")
+def obter_usuarios_por_tipo(tipo):
+    """Obtém usuários por tipo específico"""
+    c = obter_conexao().cursor()
+    c.execute("SELECT * FROM usuarios WHERE tipo = ? AND ativo = 1 ORDER BY nome", (tipo,))
+    return c.fetchall()
+
+@em_cache("usuarios", "usuarios_projetos")
+def obter_usuarios_por_projeto(projeto_id):
+    """Obtém usuários que têm acesso a um projeto específico"""
+    c = obter_conexao().cursor()
+    c.execute("""
+        SELECT u.* FROM usuarios u
+        JOIN usuarios_projetos up ON u.id = up.usuario_id
+        WHERE up.projeto_id = ?
+        ORDER BY u.nome
+    """, (projeto_id,))
+    return c.fetchall()
+
+def adicionar_usuario(username, nome, email, senha, tipo, telefone):
+    try:
+        senha_hash = hashlib.sha256(senha.encode()).hexdigest()
+        with transacao() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO usuarios (username, nome, email, senha_hash, tipo, telefone)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (username, nome, email, senha_hash, tipo, telefone))
+            marcar_alteracao("usuarios")
+            return c.lastrowid
+    except sqlite3.IntegrityError as e:
+        raise Exception(f"Erro: {str(e)}")
+
+def atualizar_usuario(usuario_id, username, nome, email, tipo, telefone, ativo):
+    try:
+        with transacao() as conn:
+            conn.execute("""
+                UPDATE usuarios 
+                SET username=?, nome=?, email=?, tipo=?, telefone=?, ativo=?
+                WHERE id=?
+            """, (username, nome, email, tipo, telefone, ativo, usuario_id))
+            marcar_alteracao("usuarios")
+        return True
+    except sqlite3.IntegrityError as e:
+        raise Exception(f"Erro: {str(e)}")
+
+def adicionar_projeto(nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id):
+    try:
+        with transacao() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO projetos (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id))
+            projeto_id = c.lastrowid
+            
+            # Associar automaticamente o proprietário ao projeto
+            if proprietario_id:
+                associar_usuario_projeto(proprietario_id, projeto_id)
+            marcar_alteracao("projetos")
+            invalidar_acessos()
+        
+        return projeto_id
+    except Exception as e:
+        raise Exception(f"Erro: {str(e)}")
+
+def atualizar_projeto(projeto_id, nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, status, responsavel_id, proprietario_id):
+    try:
+        with transacao() as conn:
+            conn.execute("""
+                UPDATE projetos 
+                SET nome=?, descricao=?, localizacao=?, orcamento_total=?, data_inicio=?, data_fim_previsto=?, status=?, responsavel_id=?, proprietario_id=?
+                WHERE id=?
+            """, (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, status, responsavel_id, proprietario_id, projeto_id))
+            marcar_alteracao("projetos")
+            invalidar_acessos()
+        return True
+    except Exception as e:
+        raise Exception(f"Erro: {str(e)}")
+
+def excluir_projeto(projeto_id):
+    """Exclui um projeto e todos os dados relacionados"""
+    try:
+        with transacao() as conn:
+            c = conn.cursor()
+            # Excluir dados relacionados (arquivos das fotos só quando deixam de ter referências)
+            c.execute("DELETE FROM usuarios_projetos WHERE projeto_id = ?", (projeto_id,))
+            excluir_fotos(conn, "relatorio_id IN (SELECT id FROM relatorios_diarios WHERE projeto_id = ?)", (projeto_id,))
+            c.execute("DELETE FROM relatorios_diarios WHERE projeto_id = ?", (projeto_id,))
+            c.execute("DELETE FROM projetos WHERE id = ?", (projeto_id,))
+            marcar_alteracao("projetos", "usuarios_projetos", "relatorios_diarios", "fotos_obra")
+            invalidar_acessos()
+        
+        return True
+    except Exception as e:
+        raise Exception(f"Erro ao excluir projeto: {str(e)}")
+
+def associar_usuario_projeto(usuario_id, projeto_id):
+    """Associa um usuário a um projeto"""
+    try:
+        with transacao() as conn:
+            conn.execute("""
+                INSERT OR IGNORE INTO usuarios_projetos (usuario_id, projeto_id)
+                VALUES (?, ?)
+            """, (usuario_id, projeto_id))
+            marcar_alteracao("usuarios_projetos")
+            invalidar_acessos()
+        return True
+    except Exception as e:
+        raise Exception(f"Erro: {str(e)}")
+
+def desassociar_usuario_projeto(usuario_id, projeto_id):
+    """Remove a associação de um usuário com um projeto"""
+    try:
+        with transacao() as conn:
+            conn.execute("DELETE FROM usuarios_projetos WHERE usuario_id=? AND projeto_id=?", (usuario_id, projeto_id))
+            marcar_alteracao("usuarios_projetos")
+            invalidar_acessos()
+        return True
+    except Exception as e:
+        raise Exception(f"Erro: {str(e)}")
+
+@em_cache("projetos", "acessos")
+def obter_projetos_disponiveis_usuario(usuario_id):
+    """Obtém projetos disponíveis para um usuário (que ainda não tem acesso)"""
+    c = obter_conexao().cursor()
+    condicao, params = filtro_projetos("p.id", resolver_projetos_visiveis(usuario_id))
+    c.execute(f"""
+        SELECT p.* FROM projetos p
+        WHERE NOT ({condicao})
+        ORDER BY p.nome
+    """, params)
+    return c.fetchall()
+
+@em_cache("relatorios_diarios", "projetos", "usuarios", "acessos")
+def obter_relatorios_usuario(usuario_id, admin=False, projeto_id=None):
+    c = obter_conexao().cursor()
+    
+    # Se for admin, mostra todos os relatórios
+    if admin:
+        query = """SELECT r.id, r.data, p.nome AS projeto_nome, u.nome AS usuario_nome, r.status, r.produtividade
+                   FROM relatorios_diarios r
+                   JOIN projetos p ON r.projeto_id = p.id
+                   JOIN usuarios u ON r.usuario_id = u.id"""
+        params = []
+    else:
+        # Para não-admins, mostra apenas relatórios de projetos que têm acesso
+        condicao, params = filtro_projetos("r.projeto_id", projetos_visiveis(usuario_id))
+        query = f"""SELECT r.id, r.data, p.nome AS projeto_nome, u.nome AS usuario_nome, r.status, r.produtividade
+                   FROM relatorios_diarios r
+                   JOIN projetos p ON r.projeto_id = p.id
+                   JOIN usuarios u ON r.usuario_id = u.id
+                   WHERE {condicao}"""
+    
+    if projeto_id and projeto_id != 0:
+        where_clause = " AND" if not admin else " WHERE"
+        query += f" {where_clause} r.projeto_id = ?"
+        params.append(projeto_id)
+    
+    query += " ORDER BY r.data DESC"
+    c.execute(query, params)
+    return c.fetchall()
+
+@em_cache("fotos_obra")
+def obter_fotos_por_relatorio(relatorio_id):
+    """Obtém todas as fotos de um relatório específico"""
+    c = obter_conexao().cursor()
+    c.execute("""
+        SELECT * FROM fotos_obra 
+        WHERE relatorio_id = ?
+        ORDER BY data_upload DESC
+    """, (relatorio_id,))
+    return c.fetchall()
+
+FOTOS_POR_PAGINA = 24
+
+@em_cache("fotos_obra", "relatorios_diarios", "projetos", "acessos")
+def obter_pagina_fotos(usuario_id, usuario_tipo, projeto_id=None, atividade=None, data_inicio=None, data_fim=None,
+                       depois_de=None, limite=FOTOS_POR_PAGINA, captura_inicio=None, captura_fim=None, area=None):
+    """Uma página de fotos, da mais recente para a mais antiga (paginação por chave).
+
+    `data_inicio`/`data_fim` filtram pela data do relatório e `captura_inicio`/
+    `captura_fim` pela data de captura (EXIF); `area` é a caixa
+    (lat_min, lat_max, lon_min, lon_max) onde a foto foi tirada.
+    `depois_de` é o cursor (data, id) da última foto da página anterior.
+    Retorna (fotos, cursor_seguinte), com cursor_seguinte None na última
+    página. Todos os filtros são aplicados no SQL, por isso o custo depende
+    do tamanho da página e não do número de fotos.
+    """
+    c = obter_conexao().cursor()
+
+    condicoes = []
+    params = []
+    if projeto_id and projeto_id != 0:
+        condicoes.append("r.projeto_id = ?")
+        params.append(projeto_id)
+    elif usuario_tipo != "admin":
+        condicao, ids = filtro_projetos("r.projeto_id", projetos_visiveis(usuario_id, usuario_tipo))
+        condicoes.append(condicao)
+        params.extend(ids)
+    if atividade:
+        condicoes.append("COALESCE(NULLIF(f.atividade_principal, ''), 'Sem atividade') = ?")
+        params.append(atividade)
+    if data_inicio:
+        condicoes.append("r.data >= ?")
+        params.append(str(data_inicio))
+    if data_fim:
+        condicoes.append("r.data <= ?")
+        params.append(str(data_fim))
+    if captura_inicio:
+        condicoes.append("f.data_captura >= ?")
+        params.append(str(captura_inicio))
+    if captura_fim:
+        condicoes.append("f.data_captura <= ?")
+        params.append(f"{captura_fim} 23:59:59")
+    if area:
+        condicoes.append("f.latitude BETWEEN ? AND ? AND f.longitude BETWEEN ? AND ?")
+        params.extend(area)
+    if depois_de:
+        # O "r.data <= ?" redundante permite ao SQLite usar o índice por data
+        condicoes.append("r.data <= ? AND (r.data, f.id) < (?, ?)")
+        params.extend([depois_de[0], depois_de[0], depois_de[1]])
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    c.execute(f"""SELECT f.id, f.relatorio_id, f.foto_path, f.descricao, f.data_upload,
+                         f.miniatura_path, f.media_path, f.piramide_path,
+                         f.data_captura, f.latitude, f.longitude, f.camera, f.hash_perceptual,
+                         COALESCE(NULLIF(f.atividade_principal, ''), 'Sem atividade') AS atividade_agrupada,
+                         r.data, r.projeto_id, p.nome AS projeto_nome,
+                         CASE WHEN a.caminho_reduzido IS NOT NULL THEN a.caminho END AS caminho_frio
+                  FROM fotos_obra f
+                  JOIN relatorios_diarios r ON f.relatorio_id = r.id
+                  JOIN projetos p ON r.projeto_id = p.id
+                  LEFT JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+                  {where}
+                  ORDER BY r.data DESC, f.id DESC
+                  LIMIT ?""", params + [limite + 1])
+    fotos = c.fetchall()
+
+    cursor_seguinte = None
+    if len(fotos) > limite:
+        fotos = fotos[:limite]
+        cursor_seguinte = (fotos[-1]["data"], fotos[-1]["id"])
+    return fotos, cursor_seguinte
+
+@em_cache("fotos_obra", "relatorios_diarios", "projetos", "acessos")
+def contar_fotos_por_atividade(projeto_id=None, usuario_id=None, usuario_tipo=None):
+    """Conta fotos por atividade principal"""
+    c = obter_conexao().cursor()
+    
+    query = """
+        SELECT 
+            COALESCE(NULLIF(f.atividade_principal, ''), 'Sem atividade') as atividade,
+            COUNT(*) as total_fotos
+        FROM fotos_obra f
+        JOIN relatorios_diarios r ON f.relatorio_id = r.id
+        JOIN projetos p ON r.projeto_id = p.id
+    """
+    
+    params = []
+    
+    if projeto_id and projeto_id != 0:
+        query += " WHERE r.projeto_id = ?"
+        params.append(projeto_id)
+    elif usuario_tipo != "admin":
+        condicao, ids = filtro_projetos("r.projeto_id", projetos_visiveis(usuario_id, usuario_tipo))
+        query += f" WHERE {condicao}"
+        params.extend(ids)
+    
+    query += " GROUP BY atividade ORDER BY total_fotos DESC"
+    
+    c.execute(query, params)
+    return c.fetchall()
+
+@em_cache("relatorios_diarios", "projetos", "usuarios", "acessos")
+def obter_ultimo_relatorio(projeto_id=None, usuario_id=None, usuario_tipo=None):
+    """Obtém o último relatório registrado"""
+    c = obter_conexao().cursor()
+    
+    query = """
+        SELECT r.*, p.nome as projeto_nome, u.nome as usuario_nome
+        FROM relatorios_diarios r
+        JOIN projetos p ON r.projeto_id = p.id
+        JOIN usuarios u ON r.usuario_id = u.id
+    """
+    
+    params = []
+    
+    if projeto_id and projeto_id != 0:
+        query += " WHERE r.projeto_id = ?"
+        params.append(projeto_id)
+    elif usuario_tipo != "admin":
+        condicao, ids = filtro_projetos("r.projeto_id", projetos_visiveis(usuario_id, usuario_tipo))
+        query += f" WHERE {condicao}"
+        params.extend(ids)
+    
+    query += " ORDER BY r.data DESC LIMIT 1"
+
+    c.execute(query, params)
+    return c.fetchone()
+
+@em_cache("relatorios_diarios", "fotos_obra", "projeto_resumo", "acessos")
+def obter_agregados_relatorios(usuario_id, usuario_tipo, projeto_id=None):
+    """Resumo dos relatórios visíveis calculado no banco.
+
+    Retorna um dicionário com o total de relatórios, a produtividade média,
+    a data do último relatório, o total de fotos, a contagem por status e a
+    série diária de produtividade média. Os totais vêm de projeto_resumo
+    (uma linha por projeto); só a série diária agrupa os relatórios.
+    """
+    c = obter_conexao().cursor()
+
+    def filtro(coluna):
+        condicoes = []
+        params = []
+        if usuario_tipo != "admin":
+            condicao, ids = filtro_projetos(coluna, projetos_visiveis(usuario_id, usuario_tipo))
+            condicoes.append(condicao)
+            params.extend(ids)
+        if projeto_id and projeto_id != 0:
+            condicoes.append(f"{coluna} = ?")
+            params.append(projeto_id)
+        return (f"WHERE {' AND '.join(condicoes)}" if condicoes else ""), params
+
+    where, params = filtro("projeto_id")
+    where_resumo, params_resumo = filtro("pr.projeto_id")
+
+    c.execute(f"""SELECT COALESCE(SUM(pr.total_relatorios), 0) AS total,
+                         SUM(pr.soma_produtividade) * 1.0 / NULLIF(SUM(pr.contagem_produtividade), 0) AS media,
+                         COALESCE(SUM(pr.total_fotos), 0) AS total_fotos,
+                         MAX(r.data) AS ultima_data
+                  FROM projeto_resumo pr
+                  LEFT JOIN relatorios_diarios r ON r.id = pr.ultimo_relatorio_id
+                  {where_resumo}""", params_resumo)
+    totais = c.fetchone()
+
+    c.execute(f"""SELECT status, SUM(total) AS total
+                  FROM projeto_resumo_status {where}
+                  GROUP BY status ORDER BY total DESC""", params)
+    por_status = c.fetchall()
+
+    c.execute(f"""SELECT data, AVG(produtividade) AS produtividade
+                  FROM relatorios_diarios {where}
+                  GROUP BY data ORDER BY data""", params)
+    serie_diaria = c.fetchall()
+
+    return {
+        "total": totais["total"],
+        "produtividade_media": totais["media"] or 0,
+        "total_fotos": totais["total_fotos"],
+        "ultima_data": totais["ultima_data"],
+        "por_status": por_status,
+        "serie_diaria": serie_diaria,
+    }
+
+@em_cache("relatorios_diarios", "fotos_obra", "projeto_resumo", "acessos")
+def obter_resumo_projetos(usuario_id, usuario_tipo):
+    """Linha de projeto_resumo de cada projeto visível, indexada pelo id do projeto"""
+    c = obter_conexao().cursor()
+    query = """SELECT pr.*, r.data AS ultima_data
+               FROM projeto_resumo pr
+               LEFT JOIN relatorios_diarios r ON r.id = pr.ultimo_relatorio_id"""
+    params = []
+    if usuario_tipo != "admin":
+        condicao, params = filtro_projetos("pr.projeto_id", projetos_visiveis(usuario_id, usuario_tipo))
+        query += f" WHERE {condicao}"
+    c.execute(query, params)
+    return {linha["projeto_id"]: linha for linha in c.fetchall()}
+
+@em_cache("relatorios_diarios", "acessos")
+def obter_historico_atividades(usuario_id, usuario_tipo, projeto_id=None, limite=20):
+    """Atividades mais recentes agregadas por título: relatórios, subatividades e conclusão"""
+    c = obter_conexao().cursor()
+    condicoes = []
+    params = []
+    if usuario_tipo != "admin":
+        condicao, ids = filtro_projetos("r.projeto_id", projetos_visiveis(usuario_id, usuario_tipo))
+        condicoes.append(condicao)
+        params.extend(ids)
+    if projeto_id and projeto_id != 0:
+        condicoes.append("r.projeto_id = ?")
+        params.append(projeto_id)
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    c.execute(f"""SELECT a.titulo, COUNT(DISTINCT a.relatorio_id) AS relatorios, MAX(r.data) AS ultima_data,
+                         COUNT(s.id) AS subatividades, COALESCE(SUM(s.feito), 0) AS concluidas
+                  FROM relatorios_diarios r
+                  JOIN atividades a ON a.relatorio_id = r.id
+                  LEFT JOIN subatividades s ON s.atividade_id = a.id
+                  {where}
+                  GROUP BY a.titulo
+                  ORDER BY ultima_data DESC, relatorios DESC
+                  LIMIT ?""", params + [limite])
+    return c.fetchall()
+
+@em_cache("relatorios_diarios")
+def carregar_relatorio(rel_id):
+    c = obter_conexao().cursor()
+    c.execute("SELECT * FROM relatorios_diarios WHERE id = ?", (rel_id,))
+    return c.fetchone()
+
+def apagar_relatorio(rel_id):
+    with transacao() as conn:
+        c = conn.cursor()
+        excluir_fotos(conn, "relatorio_id = ?", (rel_id,))
+        c.execute("DELETE FROM relatorios_diarios WHERE id = ?", (rel_id,))
+        c.execute("DELETE FROM tarefas_pdf WHERE relatorio_id = ?", (rel_id,))
+        marcar_alteracao("relatorios_diarios", "fotos_obra")
+        apos_commit(functools.partial(cache_pdfs.descartar, rel_id))
+
+def salvar_relatorio(data, projeto_id, usuario_id, lista_atividades=None, **dados):
+    """Grava (ou atualiza) o relatório do dia e as suas atividades.
+
+    `lista_atividades` é a estrutura do formulário ([{"titulo", "subs": [{"nome", "feito"}]}]);
+    sem ela, as atividades são obtidas do texto em `dados["atividades"]`.
+    """
+    if lista_atividades is None:
+        lista_atividades = parse_atividades(dados.get('atividades') or "")
+
+    with transacao() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM relatorios_diarios WHERE data=? AND projeto_id=?", (data, projeto_id))
+        existente = c.fetchone()
+        produtividade = int(dados.get('produtividade', 0))
+        
+        if existente:
+            c.execute("""UPDATE relatorios_diarios SET temperatura=?, atividades=?, equipe=?, equipamentos=?, ocorrencias=?,
+                      plano_amanha=?, status=?, produtividade=?, observacoes=?, revisao=revisao+1 WHERE id=?""",
+                      (dados.get('temperatura'), dados.get('atividades'), dados.get('equipe'), dados.get('equipamentos'),
+                       dados.get('ocorrencias'), dados.get('plano_amanha'), dados.get('status'),
+                       produtividade, dados.get('observacoes'), existente['id']))
+            rel_id = existente['id']
+        else:
+            c.execute("""INSERT INTO relatorios_diarios (data,projeto_id,usuario_id,temperatura,atividades,equipe,equipamentos,ocorrencias,
+                      plano_amanha,status,produtividade,observacoes) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)""",
+                      (data, projeto_id, usuario_id, dados.get('temperatura'), dados.get('atividades'), dados.get('equipe'),
+                       dados.get('equipamentos'), dados.get('ocorrencias'), dados.get('plano_amanha'),
+                       dados.get('status'), produtividade, dados.get('observacoes')))
+            rel_id = c.lastrowid
+        gravar_atividades(conn, rel_id, lista_atividades)
+        marcar_alteracao("relatorios_diarios")
+    
+    return rel_id
+
+def gravar_atividades(conn, relatorio_id, lista_atividades):
+    """Substitui as atividades do relatório (chamar dentro da transação de escrita)"""
+    conn.execute("DELETE FROM subatividades WHERE atividade_id IN (SELECT id FROM atividades WHERE relatorio_id = ?)", (relatorio_id,))
+    conn.execute("DELETE FROM atividades WHERE relatorio_id = ?", (relatorio_id,))
+
+    subatividades = []
+    for ordem, atividade in enumerate(lista_atividades):
+        c = conn.execute("INSERT INTO atividades (relatorio_id, ordem, titulo) VALUES (?, ?, ?)",
+                         (relatorio_id, ordem, atividade["titulo"]))
+        subatividades.extend((c.lastrowid, ordem_sub, sub["nome"], int(bool(sub["feito"])))
+                             for ordem_sub, sub in enumerate(atividade["subs"]))
+    conn.executemany("INSERT INTO subatividades (atividade_id, ordem, nome, feito) VALUES (?, ?, ?, ?)", subatividades)
+
+def obter_atividades_relatorio(relatorio_id):
+    """Atividades do relatório na estrutura do formulário, lidas das tabelas normalizadas"""
+    c = obter_conexao().cursor()
+    c.execute("""SELECT a.id, a.titulo, s.nome, s.feito
+                 FROM atividades a
+                 LEFT JOIN subatividades s ON s.atividade_id = a.id
+                 WHERE a.relatorio_id = ?
+                 ORDER BY a.ordem, s.ordem""", (relatorio_id,))
+    atividades = {}
+    for linha in c.fetchall():
+        atividade = atividades.setdefault(linha["id"], {"titulo": linha["titulo"], "subs": []})
+        if linha["nome"] is not None:
+            atividade["subs"].append({"nome": linha["nome"], "feito": bool(linha["feito"])})
+    return list(atividades.values())
+
+# ============================================
+# FOTOS SEMELHANTES
+# ============================================
+# Fotos quase iguais (rajadas da mesma parede) têm hashes perceptuais a poucos
+# bits de distância. bandas_hash_fotos, mantida por triggers, guarda cada hash
+# partido em BANDAS_HASH bandas: pelo princípio da casa dos pombos, dois hashes
+# a distância menor que BANDAS_HASH partilham uma banda, por isso os candidatos
+# saem de BANDAS_HASH procuras no índice e só eles têm a distância calculada.
+BANDAS_HASH = 8  # fixo: é o número de bandas gravado pelos triggers da migração 15
+LIMIAR_SEMELHANCA = 6
+
+def distancia_hash(a, b):
+    """Distância de Hamming entre dois hashes perceptuais (inteiros de 64 bits com sinal)"""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+def procurar_semelhantes(conn, hash_perceptual, projeto_id, limiar=LIMIAR_SEMELHANCA):
+    """Fotos do projeto a distância até `limiar` (< BANDAS_HASH) de `hash_perceptual`.
+    Retorna as linhas ordenadas da mais parecida para a menos parecida"""
+    condicoes = " OR ".join("(b.banda = ? AND b.valor = ?)" for _ in range(BANDAS_HASH))
+    params = [valor for banda in range(BANDAS_HASH) for valor in (banda, (hash_perceptual >> (8 * banda)) & 255)]
+    linhas = conn.execute(f"""SELECT DISTINCT f.id, f.foto_path, f.miniatura_path, f.descricao, f.hash_perceptual, r.data
+                              FROM bandas_hash_fotos b
+                              JOIN fotos_obra f ON f.id = b.foto_id
+                              JOIN relatorios_diarios r ON r.id = f.relatorio_id
+                              WHERE ({condicoes}) AND r.projeto_id = ?""", params + [projeto_id]).fetchall()
+    distancias = {linha["id"]: distancia_hash(hash_perceptual, linha["hash_perceptual"]) for linha in linhas}
+    return sorted((linha for linha in linhas if distancias[linha["id"]] <= limiar), key=lambda linha: distancias[linha["id"]])
+
+@em_cache("fotos_obra", "relatorios_diarios")
+def obter_fotos_semelhantes(foto_id, limiar=LIMIAR_SEMELHANCA):
+    """Outras fotos do mesmo projeto quase iguais a `foto_id`"""
+    conn = obter_conexao()
+    foto = conn.execute("""SELECT f.hash_perceptual, r.projeto_id FROM fotos_obra f
+                           JOIN relatorios_diarios r ON r.id = f.relatorio_id WHERE f.id = ?""", (foto_id,)).fetchone()
+    if not foto or foto["hash_perceptual"] is None:
+        return []
+    return [linha for linha in procurar_semelhantes(conn, foto["hash_perceptual"], foto["projeto_id"], limiar)
+            if linha["id"] != foto_id]
+
+def agrupar_semelhantes(fotos, limiar=LIMIAR_SEMELHANCA):
+    """Agrupa uma página de fotos: cada foto junta-se ao primeiro grupo cuja foto
+    representante está a até `limiar` bits. Retorna [(representante, [semelhantes])]"""
+    grupos = []
+    for foto in fotos:
+        for representante, semelhantes in grupos:
+            if (foto["hash_perceptual"] is not None and representante["hash_perceptual"] is not None
+                    and distancia_hash(foto["hash_perceptual"], representante["hash_perceptual"]) <= limiar):
+                semelhantes.append(foto)
+                break
+        else:
+            grupos.append((foto, []))
+    return grupos
+
+# ============================================
+# ARMAZENAMENTO DAS FOTOS
+# ============================================
+# As fotos são endereçadas pelo conteúdo: <DIRETORIO_FOTOS>/ab/cd/<sha256>.jpg.
+# A mesma foto enviada várias vezes é guardada uma só vez; arquivos_fotos conta
+# as linhas de fotos_obra que usam cada arquivo e ele só é apagado sem referências.
+# Na entrada, fotos grandes são reduzidas a LADO_MAXIMO_FOTOS e regravadas em JPEG;
+# com ARQUIVAR_ORIGINAIS o arquivo enviado fica também em DIRETORIO_ORIGINAIS.
+DIRETORIO_FOTOS = "fotos_obra"
+DIRETORIO_ORIGINAIS = "fotos_obra/originais"
+LADO_MAXIMO_FOTOS = 2560
+QUALIDADE_FOTOS = 85
+ARQUIVAR_ORIGINAIS = False
+EXTENSOES_FORMATO = {"JPEG": ".jpg", "PNG": ".png"}
+COLUNAS_METADADOS = ("data_captura", "latitude", "longitude", "camera", "largura", "altura")
+TAMANHO_BLOCO = 1024 * 1024
+
+def caminho_por_conteudo(conteudo_hash, diretorio=DIRETORIO_FOTOS, extensao=".jpg"):
+    """Caminho repartido em dois níveis pelos primeiros caracteres do hash"""
+    return os.path.join(diretorio, conteudo_hash[:2], conteudo_hash[2:4], f"{conteudo_hash}{extensao}").replace("\\", "/")
+
+def blocos_da_foto(foto):
+    """Conteúdo de uma foto do envio, em blocos, lido de foto["arquivo"] (file-like, p.ex. UploadedFile) ou de foto["bytes"]"""
+    if "arquivo" in foto:
+        arquivo = foto["arquivo"]
+        arquivo.seek(0)
+        yield from iter(lambda: arquivo.read(TAMANHO_BLOCO), b"")
+    else:
+        dados = memoryview(foto["bytes"])
+        for inicio in range(0, len(dados), TAMANHO_BLOCO):
+            yield dados[inicio:inicio + TAMANHO_BLOCO]
+
+def excluir_fotos(conn, condicao, parametros):
+    """Apaga as linhas de fotos_obra que satisfazem `condicao` (dentro da transação de escrita).
+
+    Os arquivos só são removidos quando o conteúdo deixa de ter referências
+    (ou, em fotos antigas sem hash, sempre), e só depois do commit, com
+    `apagar_sem_referencias`: se a transação for desfeita, nada é apagado.
+    Retorna o número de arquivos agendados para remoção.
+    """
+    linhas = conn.execute(f"""SELECT id, foto_path, conteudo_hash, miniatura_path, media_path, zoom_path, piramide_path
+                              FROM fotos_obra WHERE {condicao}""", parametros).fetchall()
+    if not linhas:
+        return 0
+    conn.execute(f"DELETE FROM fotos_obra WHERE {condicao}", parametros)
+
+    hashes = list({linha["conteudo_hash"] for linha in linhas if linha["conteudo_hash"]})
+    liberados = set()
+    if hashes:
+        marcadores = ",".join("?" * len(hashes))
+        liberados = {r["hash"]: (r["caminho"], r["caminho_original"]) for r in conn.execute(
+            f"SELECT hash, caminho, caminho_original FROM arquivos_fotos WHERE hash IN ({marcadores}) AND referencias <= 0", hashes)}
+        conn.execute(f"DELETE FROM arquivos_fotos WHERE hash IN ({marcadores}) AND referencias <= 0", hashes)
+
+    arquivos = {caminho for linha in linhas
+                if not linha["conteudo_hash"] or linha["conteudo_hash"] in liberados
+                for caminho in arquivos_da_foto(linha)}
+    # O conteúdo em si (no armazenamento frio, se foi movido) e o original enviado
+    arquivos.update(caminho for caminhos in liberados.values() for caminho in caminhos if caminho)
+
+    apos_commit(functools.partial(apagar_sem_referencias, arquivos))
+    return len(arquivos)
+
+@contextmanager
+def envio_fotos(fotos, diretorio=DIRETORIO_FOTOS, ignorar_semelhantes=False):
+    """Prepara os arquivos das fotos antes de abrir a transação.
+
+    `fotos` é uma lista de dicionários com "arquivo" (file-like) ou "bytes",
+    "descricao", "atividade_principal" e, opcional, "data_upload" (a da
+    importação do banco antigo; sem ela fica a hora atual). Cada foto é copiada em blocos para
+    um arquivo temporário e normalizada no pool (redução, orientação, hash,
+    metadados EXIF).
+    Produz a função `registrar(conn, relatorio_id)`, que dentro da transação
+    move cada arquivo para o seu caminho por conteúdo (ou o descarta, se o
+    conteúdo já estiver guardado) e insere todas as linhas de fotos_obra com
+    um único executemany. Se a transação falhar, os arquivos são apagados;
+    depois do commit ficam, mesmo que um gancho `apos_commit` falhe.
+    Com `ignorar_semelhantes`, fotos quase iguais a outra do projeto (ou a uma
+    anterior do mesmo envio) não são guardadas e ficam com foto["ignorada"] = True.
+    """
+    brutos = []
+    preparadas = []
+    definitivos = []
+    confirmado = False
+
+    def confirmar():
+        nonlocal confirmado
+        confirmado = True
+
+    def registrar(conn, relatorio_id):
+        # Registado antes do agendamento dos derivados, que pode falhar depois do commit
+        apos_commit(confirmar)
+        ultimo_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM fotos_obra").fetchone()[0]
+        projeto_id = conn.execute("SELECT projeto_id FROM relatorios_diarios WHERE id = ?", (relatorio_id,)).fetchone()[0]
+        linhas = []
+        for foto, bruto, preparada in zip(fotos, brutos, preparadas):
+            if ignorar_semelhantes and (
+                    procurar_semelhantes(conn, preparada["hash_perceptual"], projeto_id)
+                    or any(distancia_hash(preparada["hash_perceptual"], linha[6]) <= LIMIAR_SEMELHANCA for linha in linhas)):
+                foto["ignorada"] = True
+                continue
+            conteudo_hash = preparada["hash"]
+            existente = conn.execute("SELECT COALESCE(caminho_reduzido, caminho) AS caminho FROM arquivos_fotos WHERE hash = ?",
+                                     (conteudo_hash,)).fetchone()
+            if existente:
+                caminho = existente["caminho"]
+            else:
+                caminho = caminho_por_conteudo(conteudo_hash, diretorio)
+                os.makedirs(os.path.dirname(caminho), exist_ok=True)
+                os.replace(preparada["caminho"], caminho)
+                definitivos.append(caminho)
+
+                original = None
+                if ARQUIVAR_ORIGINAIS and preparada["caminho"] != bruto:
+                    extensao = EXTENSOES_FORMATO.get(preparada["formato"], f".{str(preparada['formato']).lower()}")
+                    original = caminho_por_conteudo(conteudo_hash, DIRETORIO_ORIGINAIS, extensao)
+                    os.makedirs(os.path.dirname(original), exist_ok=True)
+                    os.replace(bruto, original)
+                    definitivos.append(original)
+                conn.execute("INSERT INTO arquivos_fotos (hash, caminho, tamanho_bytes, caminho_original) VALUES (?, ?, ?, ?)",
+                             (conteudo_hash, caminho, preparada["tamanho"], original))
+            linhas.append((relatorio_id, caminho, foto.get("descricao", ""), foto.get("atividade_principal", ""),
+                           preparada["tamanho"], conteudo_hash, preparada["hash_perceptual"],
+                           *(preparada["metadados"][coluna] for coluna in COLUNAS_METADADOS), foto.get("data_upload")))
+        conn.executemany(f"""INSERT INTO fotos_obra (relatorio_id, foto_path, descricao, atividade_principal, tamanho_bytes, conteudo_hash,
+                                                     hash_perceptual, {', '.join(COLUNAS_METADADOS)}, data_upload)
+                             VALUES ({','.join('?' * (7 + len(COLUNAS_METADADOS)))}, COALESCE(?, CURRENT_TIMESTAMP))""", linhas)
+        if linhas:
+            marcar_alteracao("fotos_obra")
+            # Conteúdo repetido reaproveita os derivados já gerados; só os restantes vão para o pool
+            conn.execute("""UPDATE fotos_obra SET (miniatura_path, media_path, piramide_path) = (
+                                SELECT o.miniatura_path, o.media_path, o.piramide_path FROM fotos_obra o
+                                WHERE o.conteudo_hash = fotos_obra.conteudo_hash AND o.miniatura_path IS NOT NULL LIMIT 1)
+                            WHERE relatorio_id = ? AND id > ?""", (relatorio_id, ultimo_id))
+            novas = conn.execute(f"""SELECT {COLUNAS_AGENDAMENTO} FROM fotos_obra f
+                                     LEFT JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+                                     WHERE f.relatorio_id = ? AND f.id > ?
+                                     AND (f.miniatura_path IS NULL OR f.piramide_path IS NULL)""",
+                                 (relatorio_id, ultimo_id)).fetchall()
+            apos_commit(functools.partial(agendar_derivados, novas))
+
+    def temporarios():
+        return brutos + [preparada["caminho"] for preparada in preparadas]
+
+    try:
+        if fotos:
+            os.makedirs(diretorio, exist_ok=True)
+        for foto in fotos:
+            with processamento_fotos.arquivo_temporario(diretorio, ".envio_", ".bruto") as (f, bruto):
+                for bloco in blocos_da_foto(foto):
+                    f.write(bloco)
+            brutos.append(bruto)
+
+        with metricas.medir("envio.normalizar_fotos"):
+            futuros = [obter_pool_entrada().submit(processamento_fotos.normalizar_foto, bruto, diretorio,
+                                                   LADO_MAXIMO_FOTOS, QUALIDADE_FOTOS) for bruto in brutos]
+            wait(futuros)
+            preparadas.extend(futuro.result() for futuro in futuros if not futuro.exception())
+            erros = [futuro.exception() for futuro in futuros if futuro.exception()]
+            if erros:
+                raise Exception(f"Erro ao processar foto: {erros[0]}")
+        yield registrar
+    except BaseException:
+        # Com o commit feito, os definitivos já são referenciados pelo banco
+        for caminho in temporarios() + ([] if confirmado else definitivos):
+            if os.path.exists(caminho):
+                os.remove(caminho)
+        raise
+    else:
+        # Sobram os temporários de conteúdo já guardado e os brutos não arquivados
+        for caminho in temporarios():
+            if os.path.exists(caminho):
+                os.remove(caminho)
+
+def salvar_relatorio_com_fotos(data, projeto_id, usuario_id, fotos, lista_atividades=None, ignorar_semelhantes=False, **dados):
+    """Grava o relatório e todas as suas fotos numa única transação (tudo ou nada)"""
+    with envio_fotos(fotos, ignorar_semelhantes=ignorar_semelhantes) as registrar_fotos, transacao() as conn:
+        rel_id = salvar_relatorio(data, projeto_id, usuario_id, lista_atividades, **dados)
+        registrar_fotos(conn, rel_id)
+    return rel_id
+
+def salvar_foto(relatorio_id, foto_bytes, descricao="", atividade_principal=""):
+    fotos = [{"bytes": foto_bytes, "descricao": descricao, "atividade_principal": atividade_principal}]
+    with envio_fotos(fotos) as registrar_fotos, transacao() as conn:
+        registrar_fotos(conn, relatorio_id)
+
+# ============================================
+# DERIVADOS DAS FOTOS
+# ============================================
+DIRETORIO_DERIVADOS = "fotos_obra/derivados"
+COLUNAS_DERIVADOS = {"pequena": "miniatura_path", "media": "media_path"}
+# Servido pelo Streamlit em app/static/ (server.enableStaticServing em .streamlit/config.toml)
+DIRETORIO_ESTATICO = "static"
+DIRETORIO_PIRAMIDES = f"{DIRETORIO_ESTATICO}/piramides"
+# Colunas que agendar_derivados precisa (fotos_obra f LEFT JOIN arquivos_fotos a);
+# a pirâmide usa a resolução total: o original arquivado quando existe, senão o
+# conteúdo guardado (que no armazenamento frio já não é o foto_path)
+COLUNAS_AGENDAMENTO = """f.id, f.foto_path, f.miniatura_path, f.piramide_path,
+                         COALESCE(a.caminho_original, a.caminho, f.foto_path) AS fonte_piramide"""
+
+def arquivos_da_foto(linha):
+    """Arquivos em disco de uma linha de fotos_obra: original, derivados e pirâmide já gerados
+    (zoom_path é o derivado de 2560 px que o visor usava antes das pirâmides)"""
+    colunas = ["foto_path", *COLUNAS_DERIVADOS.values(), "zoom_path", "piramide_path"]
+    return [linha[coluna] for coluna in colunas if coluna in linha.keys() and linha[coluna]]
+
+def apagar_arquivo(caminho):
+    """Remove um arquivo das fotos (um .dzi leva consigo a pasta dos tiles). Retorna True se removeu"""
+    try:
+        if caminho.endswith(".dzi"):
+            shutil.rmtree(processamento_fotos.pasta_tiles(caminho), ignore_errors=True)
+        os.remove(caminho)
+        return True
+    except OSError:
+        return False
+
+def apagar_sem_referencias(caminhos):
+    """Apaga os `caminhos` que continuam sem referência no banco. Retorna quantos removeu.
+
+    Corre depois do commit que os deixou sem referência. A verificação e a
+    remoção são feitas com o bloqueio de escrita: um envio do mesmo conteúdo
+    entretanto confirmado fica com o arquivo, e nenhum o pode registar a meio.
+    Com o banco ocupado, os arquivos ficam para o recolhedor de órfãos.
+    """
+    try:
+        with transacao() as conn:
+            referenciados = caminhos_referenciados(conn, caminhos)
+            return sum(apagar_arquivo(caminho) for caminho in caminhos if caminho not in referenciados)
+    except sqlite3.OperationalError:
+        return 0
+
+def leitura_sob_demanda(caminho):
+    """Callable para o `data` do st.download_button: o arquivo só é lido quando
+    o usuário clica, em vez de ir para a memória (e para o navegador) a cada render"""
+    def ler():
+        with open(caminho, "rb") as f:
+            return f.read()
+    return ler
+
+def criar_pool_processos(max_workers=None):
+    """Pool para trabalho pesado de CPU (imagens, PDFs).
+
+    Os processos são criados com spawn em todos os sistemas: um fork do
+    servidor do Streamlit, que tem várias threads, pode copiar para o filho
+    uma trava ocupada por outra thread e deixá-lo bloqueado. As tarefas são
+    funções de processamento_fotos e processamento_relatorios, módulos sem
+    Streamlit nem banco que o filho importa ao receber a primeira tarefa.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+@st.cache_resource
+def obter_pool_derivados():
+    return criar_pool_processos(max_workers=max(1, min(4, (os.cpu_count() or 2) - 1)))
+
+def encerrar_pool_derivados():
+    """Termina o pool dos derivados; o próximo uso cria outro. Os processos
+    guardam o diretório de trabalho de quando foram criados, por isso quem
+    troca de diretório (verificação de planos, testes) chama isto ao voltar"""
+    obter_pool_derivados().shutdown()
+    obter_pool_derivados.clear()
+
+@st.cache_resource
+def obter_pool_entrada():
+    """Threads para normalizar as fotos de um envio. Separado do pool dos derivados para
+    que quem está a gravar um relatório não espere atrás de gerações em segundo plano
+    (o Pillow liberta o GIL ao descodificar, reduzir e codificar)"""
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="entrada_fotos")
+
+def registrar_derivados(foto_id, caminhos):
+    with transacao() as conn:
+        conn.execute(f"UPDATE fotos_obra SET {', '.join(f'{coluna} = ?' for coluna in COLUNAS_DERIVADOS.values())} WHERE id = ?",
+                     [*(caminhos[tamanho] for tamanho in COLUNAS_DERIVADOS), foto_id])
+        marcar_alteracao("fotos_obra")
+
+def registrar_piramide(foto_id, caminho_dzi):
+    # Fotos com o mesmo conteúdo e ainda sem pirâmide passam a usar esta
+    with transacao() as conn:
+        conn.execute("""UPDATE fotos_obra SET piramide_path = ? WHERE id = ?
+                        OR (piramide_path IS NULL AND conteudo_hash = (SELECT conteudo_hash FROM fotos_obra WHERE id = ?))""",
+                     (caminho_dzi, foto_id, foto_id))
+        marcar_alteracao("fotos_obra")
+
+class TarefasDerivados:
+    """Geração de derivados no pool, sem repetir fotos que já estão na fila.
+
+    `gerar(caminho_original, diretorio)` corre no pool e o seu resultado é
+    gravado com `registrar(foto_id, resultado)`. `agendar` retorna um Future
+    que termina depois dessa gravação. Fotos cuja geração falhou ficam em
+    `falhas` e não são reagendadas até o processo reiniciar.
+    """
+
+    def __init__(self, gerar=processamento_fotos.gerar_derivados, registrar=registrar_derivados,
+                 diretorio=DIRETORIO_DERIVADOS):
+        self.gerar = gerar
+        self.registrar = registrar
+        self.diretorio = diretorio
+        self._trava = threading.Lock()
+        self._pendentes = {}
+        self.falhas = {}
+        # As gravações correm numa thread própria: os callbacks dos Futures correm na
+        # thread de gestão do pool, que não recolhe outros resultados enquanto espera pelo banco
+        self._registros = ThreadPoolExecutor(max_workers=1, thread_name_prefix="registro_derivados")
+
+    def agendar(self, foto_id, caminho_original):
+        with self._trava:
+            if foto_id in self._pendentes:
+                return self._pendentes[foto_id]
+            concluido = Future()
+            self._pendentes[foto_id] = concluido
+
+        try:
+            try:
+                futuro = obter_pool_derivados().submit(self.gerar, caminho_original, self.diretorio)
+            except BrokenExecutor:
+                # Um processo do pool morreu: descarta o pool e tenta com um novo
+                obter_pool_derivados.clear()
+                futuro = obter_pool_derivados().submit(self.gerar, caminho_original, self.diretorio)
+        except Exception as erro:
+            # Pool encerrado ou sem conserto: sem isto a foto ficava pendente para sempre
+            # (nunca reagendada) e quem espera pelo Future ficava bloqueado
+            with self._trava:
+                self._pendentes.pop(foto_id, None)
+            concluido.set_exception(erro)
+            return concluido
+        futuro.add_done_callback(functools.partial(self._registros.submit, self._concluir, foto_id, concluido))
+        return concluido
+
+    def _concluir(self, foto_id, concluido, futuro):
+        try:
+            resultado = futuro.result()
+            self.registrar(foto_id, resultado)
+        except Exception as e:
+            with self._trava:
+                self.falhas[foto_id] = str(e)
+                self._pendentes.pop(foto_id, None)
+            concluido.set_exception(e)
+        else:
+            with self._trava:
+                self._pendentes.pop(foto_id, None)
+            concluido.set_result(resultado)
+
+    def pendentes(self):
+        with self._trava:
+            return len(self._pendentes)
+
+    def pendente(self, foto_id):
+        with self._trava:
+            return foto_id in self._pendentes
+
+@st.cache_resource
+def obter_tarefas_derivados():
+    return TarefasDerivados()
+
+tarefas_derivados = obter_tarefas_derivados()
+
+@st.cache_resource
+def obter_tarefas_piramides():
+    return TarefasDerivados(processamento_fotos.gerar_piramide, registrar_piramide, DIRETORIO_PIRAMIDES)
+
+tarefas_piramides = obter_tarefas_piramides()
+
+def agendar_derivados(fotos):
+    """Agenda o que falta a cada foto (linhas com COLUNAS_AGENDAMENTO). Retorna os Futures"""
+    futuros = []
+    for foto in fotos:
+        if not foto["miniatura_path"]:
+            futuros.append(tarefas_derivados.agendar(foto["id"], foto["foto_path"]))
+        if not foto["piramide_path"]:
+            futuros.append(tarefas_piramides.agendar(foto["id"], foto["fonte_piramide"]))
+    return futuros
+
+def agendar_piramide(foto_id):
+    """Agenda a pirâmide de uma foto (p.ex. foto antiga aberta no visor antes do backfill)"""
+    foto = obter_conexao().execute(f"""SELECT {COLUNAS_AGENDAMENTO} FROM fotos_obra f
+                                       LEFT JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+                                       WHERE f.id = ?""", (foto_id,)).fetchone()
+    if foto and foto_id not in tarefas_piramides.falhas:
+        tarefas_piramides.agendar(foto["id"], foto["fonte_piramide"])
+
+def garantir_derivados(fotos):
+    """Caminhos dos derivados de `fotos` que já existem, agendando no pool os que faltam.
+
+    Retorna ({foto_id: {tamanho: caminho}}, {foto_id: erro}). Não espera pelo
+    pool: as fotos que não aparecem em nenhum dos dois estão em preparação e
+    são mostradas num rerun seguinte (ver aguardar_derivados).
+    """
+    prontos = {}
+    erros = {}
+    for foto in fotos:
+        caminhos = {tamanho: foto[coluna] for tamanho, coluna in COLUNAS_DERIVADOS.items()}
+        if all(caminhos.values()) and all(os.path.exists(caminho) for caminho in caminhos.values()):
+            prontos[foto["id"]] = caminhos
+        elif foto["id"] in tarefas_derivados.falhas:
+            erros[foto["id"]] = tarefas_derivados.falhas[foto["id"]]
+        else:
+            tarefas_derivados.agendar(foto["id"], foto["foto_path"])
+    return prontos, erros
+
+def gerar_derivados_em_falta(tamanho_lote=50):
+    """Gera os derivados e as pirâmides que faltam a todas as fotos. Retorna (gerados, falhas)"""
+    gerados = falhas = 0
+    ultimo_id = 0
+    while True:
+        fotos = obter_conexao().execute(f"""SELECT {COLUNAS_AGENDAMENTO} FROM fotos_obra f
+                                            LEFT JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+                                            WHERE f.id > ? AND (f.miniatura_path IS NULL OR f.piramide_path IS NULL)
+                                            ORDER BY f.id LIMIT ?""", (ultimo_id, tamanho_lote)).fetchall()
+        if not fotos:
+            break
+        futuros = agendar_derivados(fotos)
+        wait(futuros)
+        for futuro in futuros:
+            if futuro.exception():
+                falhas += 1
+            else:
+                gerados += 1
+        ultimo_id = fotos[-1]["id"]
+    return gerados, falhas
+
+def benchmark_envio_relatorio(quantidades=(1, 5, 10, 30), tamanho_foto=200_000, repeticoes=3):
+    """Latência de gravar um relatório com N fotos: uma transação por foto vs. transação única.
+
+    Corre num diretório temporário, com banco e pasta de fotos próprios. As fotos
+    são JPEGs de ruído com cerca de `tamanho_foto` bytes, novas a cada envio para
+    que nenhuma seja descartada como repetida.
+    Retorna {quantidade: {modo: milissegundos (mediana)}}.
+    """
+    lado = max(16, int(tamanho_foto ** 0.5))
+
+    def jpeg_ruido():
+        buffer = io.BytesIO()
+        Image.frombytes("RGB", (lado, lado), os.urandom(lado * lado * 3)).save(buffer, "JPEG", quality=90)
+        return buffer.getvalue()
+
+    caminho_anterior = CAMINHO_BANCO
+    diretorio_anterior = os.getcwd()
+    resultados = {}
+    with tempfile.TemporaryDirectory() as pasta:
+        os.chdir(pasta)
+        try:
+            usar_banco(os.path.join(pasta, "benchmark.db"))
+            projeto_id = obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+            dia = datetime.date(2000, 1, 1)
+
+            for quantidade in quantidades:
+                tempos = {"transacao_por_foto": [], "transacao_unica": []}
+                for _ in range(repeticoes):
+                    for modo, tempos_modo in tempos.items():
+                        fotos = [{"bytes": jpeg_ruido(), "descricao": f"Foto {i}"} for i in range(quantidade)]
+                        dia += datetime.timedelta(days=1)
+                        inicio = time.perf_counter()
+                        if modo == "transacao_por_foto":
+                            rel_id = salvar_relatorio(dia.isoformat(), projeto_id, 1, atividades="Benchmark")
+                            for foto in fotos:
+                                salvar_foto(rel_id, foto["bytes"], foto["descricao"])
+                        else:
+                            salvar_relatorio_com_fotos(dia.isoformat(), projeto_id, 1, fotos, atividades="Benchmark")
+                        tempos_modo.append((time.perf_counter() - inicio) * 1000)
+                resultados[quantidade] = {modo: float(np.median(t)) for modo, t in tempos.items()}
+        finally:
+            os.chdir(diretorio_anterior)
+            usar_banco(caminho_anterior)
+    return resultados
+
+def dados_pdf(rel_id):
+    """Linha do relatório com os nomes do projeto e do responsável, como dicionário (None se não existir)"""
+    c = obter_conexao().cursor()
+    c.execute("""SELECT r.*, p.nome AS nome_projeto, u.nome AS nome_usuario 
+                 FROM relatorios_diarios r
+                 JOIN projetos p ON r.projeto_id = p.id
+                 JOIN usuarios u ON r.usuario_id = u.id 
+                 WHERE r.id = ?""", (rel_id,))
+    rel = c.fetchone()
+    return dict(rel) if rel else None
+
+def gerar_pdf(rel_id):
+    """Bytes do PDF do relatório, gerado na thread atual"""
+    rel = dados_pdf(rel_id)
+    if not rel:
+        return None
+    return processamento_relatorios.pdf_relatorio(rel)
+
+def get_day_name(date_obj):
+    """Retorna o nome do dia da semana em português"""
+    days_pt = ["Segunda-feira", "Terça-feira", "Quarta-feira", "Quinta-feira", 
+               "Sexta-feira", "Sábado", "Domingo"]
+    return days_pt[date_obj.weekday()]
+
+_RE_STATUS_SUBATIVIDADE = re.compile(r"\s*\(([^()]*(?:✅|❌|conclu|feito|pendente)[^()]*)\)\s*$", re.IGNORECASE)
+
+def parse_atividades(atividades_texto):
+    """Parseia o texto de atividades em estrutura hierárquica.
+
+    Usado ao gravar relatórios sem estrutura e na migração dos relatórios
+    antigos; a exibição lê as tabelas atividades/subatividades.
+    """
+    atividades = []
+    linhas = atividades_texto.split('\n')
+    
+    for linha in linhas:
+        linha = linha.strip()
+        if not linha:
+            continue
+            
+        if ':' in linha:
+            partes = linha.split(':', 1)
+            atividade_principal = partes[0].strip()
+            subatividades_texto = partes[1].strip()
+            
+            # Parsear subatividades
+            subatividades = []
+            if subatividades_texto:
+                # Separar por vírgulas ou outros delimitadores
+                for sub in subatividades_texto.split(','):
+                    sub = sub.strip()
+                    if sub:
+                        status = _RE_STATUS_SUBATIVIDADE.search(sub)
+                        if status:
+                            # Status entre parênteses no fim, como gravado pelo formulário: "nome (✅ Concluído)"
+                            marcador = status.group(1).lower()
+                            feito = not any(negacao in marcador for negacao in ('❌', 'pendente', 'não'))
+                            nome_sub = sub[:status.start()].strip()
+                        else:
+                            # Verificar se tem indicação de status
+                            feito = '✅' in sub or 'Concluído' in sub or 'Feito' in sub
+                            # Remover indicadores de status
+                            nome_sub = sub.replace('✅', '').replace('❌', '').replace('Concluído', '').replace('Feito', '').replace('Pendente', '').strip()
+                        subatividades.append({
+                            'nome': nome_sub,
+                            'feito': feito
+                        })
+            
+            atividades.append({
+                'titulo': atividade_principal,
+                'subs': subatividades
+            })
+        else:
+            # Se não tem subatividades, é uma atividade simples
+            atividades.append({
+                'titulo': linha,
+                'subs': []
+            })
+    
+    return atividades
+
+# ============================================
+# MINIATURAS EM MEMÓRIA
+# ============================================
+# O st.image recodifica em JPEG, na thread do script e uma a uma, qualquer
+# imagem que não seja JPEG (os derivados são WEBP). As miniaturas da página
+# atual e da seguinte são preparadas em paralelo num pool de threads (o Pillow
+# liberta o GIL) e os bytes ficam num LRU partilhado, limitado em memória;
+# o st.image recebe-os já em JPEG e não volta a descodificá-los.
+MEMORIA_MINIATURAS = configuracao_inteira("MEMORIA_MINIATURAS", 64 * 1024 * 1024)
+QUALIDADE_MINIATURAS_JPEG = 85
+
+@st.cache_resource
+def obter_pool_miniaturas():
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="miniaturas")
+
+class CacheLRU:
+    """LRU de bytes, limitado a `max_bytes` no total"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_usados = 0
+        self.acertos = 0
+        self.falhas = 0
+        self._trava = threading.Lock()
+        self._entradas = OrderedDict()
+
+    def obter(self, chave):
+        with self._trava:
+            if chave in self._entradas:
+                self._entradas.move_to_end(chave)
+                self.acertos += 1
+                return self._entradas[chave]
+            self.falhas += 1
+            return None
+
+    def guardar(self, chave, dados):
+        with self._trava:
+            if len(dados) > self.max_bytes:
+                return
+            anterior = self._entradas.pop(chave, None)
+            if anterior is not None:
+                self.bytes_usados -= len(anterior)
+            self._entradas[chave] = dados
+            self.bytes_usados += len(dados)
+            self._despejar()
+
+    def _despejar(self):
+        while self.bytes_usados > self.max_bytes and self._entradas:
+            _, dados = self._entradas.popitem(last=False)
+            self.bytes_usados -= len(dados)
+
+    def definir_limite(self, max_bytes):
+        with self._trava:
+            self.max_bytes = max_bytes
+            self._despejar()
+
+    def limpar(self):
+        with self._trava:
+            self._entradas.clear()
+            self.bytes_usados = 0
+            self.acertos = self.falhas = 0
+
+    def resumo(self):
+        with self._trava:
+            return {"entradas": len(self._entradas), "bytes": self.bytes_usados, "max_bytes": self.max_bytes,
+                    "acertos": self.acertos, "falhas": self.falhas}
+
+class CacheMiniaturas(CacheLRU):
+    """LRU dos bytes das miniaturas prontas a exibir, preparadas no pool de miniaturas"""
+
+    def __init__(self, max_bytes=MEMORIA_MINIATURAS):
+        super().__init__(max_bytes)
+        self._em_curso = {}
+
+    def preparar(self, caminhos):
+        """Agenda no pool as miniaturas que não estão no cache nem a ser preparadas.
+        Retorna {caminho: Future} das que não estão no cache"""
+        novos = []
+        futuros = {}
+        with self._trava:
+            for caminho in dict.fromkeys(caminhos):
+                if caminho in self._entradas:
+                    continue
+                if caminho not in self._em_curso:
+                    self._em_curso[caminho] = Future()
+                    novos.append(caminho)
+                futuros[caminho] = self._em_curso[caminho]
+        # Submetidas fora da trava: o callback de um futuro já concluído corre logo
+        for caminho in novos:
+            try:
+                futuro = obter_pool_miniaturas().submit(processamento_fotos.miniatura_jpeg, caminho, QUALIDADE_MINIATURAS_JPEG)
+            except Exception as erro:
+                # Pool encerrado: sem isto o Future ficava pendente e carregar() esperava para sempre
+                with self._trava:
+                    concluido = self._em_curso.pop(caminho)
+                concluido.set_exception(erro)
+                continue
+            futuro.add_done_callback(functools.partial(self._concluir, caminho))
+        return futuros
+
+    def _concluir(self, caminho, futuro):
+        if not futuro.exception():
+            self.guardar(caminho, futuro.result())
+        with self._trava:
+            concluido = self._em_curso.pop(caminho)
+        if futuro.exception():
+            concluido.set_exception(futuro.exception())
+        else:
+            concluido.set_result(futuro.result())
+
+    def carregar(self, caminhos):
+        """Bytes das miniaturas de `caminhos`, preparando em paralelo as que faltam.
+        Retorna {caminho: bytes}; as que não puderam ser lidas ficam de fora"""
+        resultado = {}
+        em_falta = []
+        for caminho in caminhos:
+            dados = self.obter(caminho)
+            if dados is None:
+                em_falta.append(caminho)
+            else:
+                resultado[caminho] = dados
+        futuros = self.preparar(em_falta)
+        wait(futuros.values())
+        for caminho, futuro in futuros.items():
+            if not futuro.exception():
+                resultado[caminho] = futuro.result()
+        return resultado
+
+@st.cache_resource
+def obter_cache_miniaturas():
+    return CacheMiniaturas()
+
+cache_miniaturas = obter_cache_miniaturas()
+
+def pre_carregar_pagina(fotos):
+    """Prepara em segundo plano uma página que ainda não é exibida: miniaturas
+    existentes vão para o cache e as que faltam são agendadas, sem esperar"""
+    caminhos = []
+    for foto in fotos:
+        if foto["miniatura_path"] and os.path.exists(foto["miniatura_path"]):
+            caminhos.append(foto["miniatura_path"])
+        elif foto["id"] not in tarefas_derivados.falhas:
+            tarefas_derivados.agendar(foto["id"], foto["foto_path"])
+    cache_miniaturas.preparar(caminhos)
+
+# ============================================
+# CACHE DE PDFS
+# ============================================
+# O PDF de um relatório só muda quando o relatório muda: a chave é o id mais
+# a revisão, incrementada por salvar_relatorio (e por triggers quando muda o
+# nome do projeto ou do responsável). Os PDFs ficam num LRU em memória e em
+# DIRETORIO_PDFS/<id>/<revisão>.pdf, que sobrevive aos reinícios do servidor.
+# O disco também tem limite: passado LIMITE_DISCO_PDFS, os PDFs lidos ou
+# gravados há mais tempo (pela data de modificação) são apagados.
+DIRETORIO_PDFS = "cache_pdfs"
+MEMORIA_PDFS = configuracao_inteira("MEMORIA_PDFS", 32 * 1024 * 1024)
+LIMITE_DISCO_PDFS = configuracao_inteira("LIMITE_DISCO_PDFS", 512 * 1024 * 1024)
+
+class CachePdfs(CacheLRU):
+    """LRU dos PDFs gerados, apoiado por um armazenamento em disco"""
+
+    def __init__(self, diretorio=DIRETORIO_PDFS, max_bytes=MEMORIA_PDFS, limite_disco=LIMITE_DISCO_PDFS):
+        super().__init__(max_bytes)
+        self.diretorio = diretorio
+        self.limite_disco = limite_disco
+        self.bytes_disco = None  # medido no primeiro acesso ao disco
+        self.lidos_disco = 0
+
+    def caminho(self, rel_id, revisao):
+        return os.path.join(self.diretorio, str(rel_id), f"{revisao}.pdf").replace("\\", "/")
+
+    def ler(self, rel_id, revisao):
+        """Bytes do PDF da revisão, da memória ou do disco (None se ainda não foi gerado)"""
+        dados = self.obter((rel_id, revisao))
+        if dados is None:
+            caminho = self.caminho(rel_id, revisao)
+            try:
+                with open(caminho, "rb") as f:
+                    dados = f.read()
+                # A data de modificação marca o último uso, para o despejo do disco
+                os.utime(caminho)
+            except OSError:
+                return None
+            self.lidos_disco += 1
+            self.guardar((rel_id, revisao), dados)
+        return dados
+
+    def gravar(self, rel_id, revisao, dados):
+        """Guarda em memória e em disco e apaga do disco as revisões anteriores do relatório"""
+        self.guardar((rel_id, revisao), dados)
+        caminho = self.caminho(rel_id, revisao)
+        pasta = os.path.dirname(caminho)
+        os.makedirs(pasta, exist_ok=True)
+        with processamento_fotos.escrita_atomica(caminho, ".pdf_") as f:
+            f.write(dados)
+        variacao = len(dados)
+        for nome in os.listdir(pasta):
+            anterior, extensao = os.path.splitext(nome)
+            if extensao == ".pdf" and anterior.isdigit() and int(anterior) < revisao:
+                caminho_anterior = os.path.join(pasta, nome)
+                try:
+                    tamanho = os.path.getsize(caminho_anterior)
+                except OSError:
+                    continue
+                if apagar_arquivo(caminho_anterior):
+                    variacao -= tamanho
+        with self._trava:
+            if self.bytes_disco is not None:
+                self.bytes_disco += variacao
+            excedido = self.bytes_disco is None or self.bytes_disco > self.limite_disco
+        if excedido:
+            self.liberar_disco()
+
+    def _arquivos_disco(self):
+        """[(data de modificação, tamanho, caminho)] dos PDFs em disco"""
+        arquivos = []
+        for raiz, _, nomes in os.walk(self.diretorio):
+            for nome in nomes:
+                if nome.endswith(".pdf"):
+                    caminho = os.path.join(raiz, nome)
+                    try:
+                        estado = os.stat(caminho)
+                    except OSError:
+                        continue
+                    arquivos.append((estado.st_mtime, estado.st_size, caminho))
+        return arquivos
+
+    def liberar_disco(self):
+        """Mede o disco e, se passar do limite, apaga os PDFs usados há mais tempo
+        até ficar em 90% dele (para não ter de voltar a medir a cada gravação)"""
+        arquivos = sorted(self._arquivos_disco())
+        total = sum(tamanho for _, tamanho, _ in arquivos)
+        if total > self.limite_disco:
+            for _, tamanho, caminho in arquivos:
+                if total <= self.limite_disco * 9 // 10:
+                    break
+                if apagar_arquivo(caminho):
+                    total -= tamanho
+                    try:
+                        os.rmdir(os.path.dirname(caminho))
+                    except OSError:
+                        pass  # a pasta do relatório ainda tem outras revisões
+        with self._trava:
+            self.bytes_disco = total
+
+    def descartar(self, rel_id):
+        """Remove todas as revisões do relatório, da memória e do disco"""
+        with self._trava:
+            for chave in [chave for chave in self._entradas if chave[0] == rel_id]:
+                self.bytes_usados -= len(self._entradas.pop(chave))
+        shutil.rmtree(os.path.join(self.diretorio, str(rel_id)), ignore_errors=True)
+        with self._trava:
+            self.bytes_disco = None
+
+    def resumo(self):
+        return {**super().resumo(), "lidos_disco": self.lidos_disco, "bytes_disco": self.bytes_disco,
+                "limite_disco": self.limite_disco}
+
+@st.cache_resource
+def obter_cache_pdfs():
+    return CachePdfs()
+
+cache_pdfs = obter_cache_pdfs()
+
+def obter_pdf(rel_id):
+    """Bytes do PDF do relatório; só é gerado se a revisão atual ainda não estiver no cache"""
+    linha = obter_conexao().execute("SELECT revisao FROM relatorios_diarios WHERE id = ?", (rel_id,)).fetchone()
+    if not linha:
+        return None
+    dados = cache_pdfs.ler(rel_id, linha["revisao"])
+    if dados is None:
+        with metricas.medir("relatorios.gerar_pdf"):
+            dados = gerar_pdf(rel_id)
+        if dados is None:
+            return None
+        cache_pdfs.gravar(rel_id, linha["revisao"], dados)
+    return dados
+
+def pdf_sob_demanda(rel_id):
+    """Callable para o `data` do st.download_button: o PDF só é obtido quando o usuário clica"""
+    return lambda: obter_pdf(rel_id) or b""
+
+# ============================================
+# FILA DE PDFS
+# ============================================
+# Os PDFs são gerados num pool de processos próprio, fora da thread do script.
+# Cada pedido é uma linha de tarefas_pdf (relatório, revisão) que passa por
+# na_fila → em_curso → concluida | falhou. Como a fila está no banco, o que
+# estava na fila ou em curso quando o servidor parou volta a ser despachado
+# quando ele arranca; uma tarefa em curso há mais de PRAZO_TAREFAS_PDF segundos
+# que este processo não conhece também volta para a fila. Uma tarefa que não
+# chega a correr (pool avariado, erro ao gravar o resultado) é devolvida à
+# fila até MAX_TENTATIVAS_PDF tentativas. Com PRE_GERAR_PDFS, o PDF é posto na
+# fila logo que o relatório é gravado no formulário.
+TRABALHADORES_PDF = configuracao_inteira("TRABALHADORES_PDF", 2)
+PRE_GERAR_PDFS = True
+PRAZO_TAREFAS_PDF = 600
+MAX_TENTATIVAS_PDF = 3
+
+class FilaPdfs:
+    """Despacha as tarefas de tarefas_pdf para um pool de `trabalhadores` processos.
+
+    O despacho e a conclusão das tarefas correm numa thread própria, um de
+    cada vez: quem enfileira e os callbacks do pool só deixam lá o pedido, sem
+    esperar nem segurar travas. `_em_curso` só é usado nessa thread.
+    """
+
+    def __init__(self, trabalhadores=TRABALHADORES_PDF):
+        self.trabalhadores = trabalhadores
+        self._trava = threading.Lock()
+        self._pool = None
+        self._despachante = None
+        self._em_curso = set()
+        self._iniciada = False
+        self._fechada = False
+
+    def _obter_pool(self):
+        with self._trava:
+            if self._pool is None:
+                self._pool = criar_pool_processos(max_workers=self.trabalhadores)
+            return self._pool
+
+    def _obter_despachante(self):
+        with self._trava:
+            if self._despachante is None:
+                self._despachante = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fila_pdfs")
+            return self._despachante
+
+    def definir_trabalhadores(self, trabalhadores):
+        """Troca o pool; as tarefas já submetidas terminam no pool antigo"""
+        with self._trava:
+            anterior, self._pool = self._pool, None
+            self.trabalhadores = trabalhadores
+        if anterior is not None:
+            anterior.shutdown(wait=False)
+        self.despachar()
+
+    def enfileirar(self, rel_id):
+        """Põe na fila o PDF da revisão atual do relatório (uma tarefa concluída
+        ou que falhou volta para a fila). Retorna a revisão, ou None se o relatório não existe"""
+        with transacao() as conn:
+            linha = conn.execute("SELECT revisao FROM relatorios_diarios WHERE id = ?", (rel_id,)).fetchone()
+            if not linha:
+                return None
+            conn.execute("""INSERT INTO tarefas_pdf (relatorio_id, revisao) VALUES (?, ?)
+                            ON CONFLICT (relatorio_id, revisao) DO UPDATE SET estado = 'na_fila', erro = NULL,
+                            tentativas = 0, atualizada_em = CURRENT_TIMESTAMP WHERE estado IN ('concluida', 'falhou')""",
+                         (rel_id, linha["revisao"]))
+            apos_commit(self.despachar)
+        return linha["revisao"]
+
+    def iniciar(self):
+        """No arranque do servidor: despacha o que ficou na fila (só a primeira chamada faz trabalho).
+        As tarefas em curso de um servidor que parou voltam para a fila quando o prazo expira;
+        as de outros processos vivos continuam com eles"""
+        if not self._iniciada:
+            self._iniciada = True
+            self.despachar()
+
+    def _repor_expiradas(self):
+        """Tarefas em curso há mais de PRAZO_TAREFAS_PDF segundos, que não são deste processo, voltam para a fila"""
+        prazo = f"-{PRAZO_TAREFAS_PDF} seconds"
+        expiradas = [(linha["relatorio_id"], linha["revisao"]) for linha in obter_conexao().execute(
+            """SELECT relatorio_id, revisao FROM tarefas_pdf
+               WHERE estado = 'em_curso' AND atualizada_em < datetime('now', ?)""", (prazo,))]
+        expiradas = [chave for chave in expiradas if chave not in self._em_curso]
+        if expiradas:
+            with transacao() as conn:
+                conn.executemany("""UPDATE tarefas_pdf SET estado = 'na_fila', atualizada_em = CURRENT_TIMESTAMP
+                                    WHERE relatorio_id = ? AND revisao = ? AND estado = 'em_curso'
+                                    AND atualizada_em < datetime('now', ?)""", [(*chave, prazo) for chave in expiradas])
+
+    def despachar(self):
+        """Pede à thread de despacho que submeta as tarefas na fila, sem esperar"""
+        return self._obter_despachante().submit(self._despachar)
+
+    def _despachar(self):
+        """Submete ao pool as tarefas na fila, até ocupar todos os trabalhadores (na thread de despacho)"""
+        if self._fechada:
+            return
+        self._repor_expiradas()
+        livres = self.trabalhadores - len(self._em_curso)
+        if livres <= 0:
+            return
+        with transacao() as conn:
+            tarefas = conn.execute("""SELECT relatorio_id, revisao FROM tarefas_pdf WHERE estado = 'na_fila'
+                                      ORDER BY criada_em, relatorio_id LIMIT ?""", (livres,)).fetchall()
+            conn.executemany("""UPDATE tarefas_pdf SET estado = 'em_curso', tentativas = tentativas + 1,
+                                atualizada_em = CURRENT_TIMESTAMP WHERE relatorio_id = ? AND revisao = ?""",
+                             [(tarefa["relatorio_id"], tarefa["revisao"]) for tarefa in tarefas])
+
+        devolvidas = False
+        for tarefa in tarefas:
+            chave = (tarefa["relatorio_id"], tarefa["revisao"])
+            try:
+                rel = dados_pdf(tarefa["relatorio_id"])
+                if not rel or rel["revisao"] != tarefa["revisao"]:
+                    # O relatório foi apagado ou alterado depois de a tarefa entrar na fila
+                    with transacao() as conn:
+                        conn.execute("DELETE FROM tarefas_pdf WHERE relatorio_id = ? AND revisao = ?", chave)
+                    continue
+                futuro = self._submeter(rel)
+            except Exception as erro:
+                self._devolver(chave, erro)
+                devolvidas = True
+                continue
+            self._em_curso.add(chave)
+            futuro.add_done_callback(functools.partial(self._apos_tarefa, chave))
+        if devolvidas:
+            self.despachar()
+
+    def _submeter(self, rel):
+        pool = self._obter_pool()
+        try:
+            return pool.submit(processamento_relatorios.pdf_relatorio, rel)
+        except (BrokenExecutor, RuntimeError):
+            # Um processo do pool morreu (ou o pool foi trocado): descarta-o e tenta com um novo
+            with self._trava:
+                if self._pool is pool:
+                    self._pool = None
+            return self._obter_pool().submit(processamento_relatorios.pdf_relatorio, rel)
+
+    def _devolver(self, chave, erro):
+        """A tarefa não correu até ao fim por um problema da fila, não do relatório:
+        volta para a fila, ou fica como falhou depois de MAX_TENTATIVAS_PDF tentativas"""
+        try:
+            with transacao() as conn:
+                conn.execute("""UPDATE tarefas_pdf SET estado = CASE WHEN tentativas >= ? THEN 'falhou' ELSE 'na_fila' END,
+                                erro = ?, atualizada_em = CURRENT_TIMESTAMP WHERE relatorio_id = ? AND revisao = ?""",
+                             (MAX_TENTATIVAS_PDF, str(erro), *chave))
+        except sqlite3.Error:
+            pass  # fica em curso e volta para a fila quando passar o prazo
+
+    def _apos_tarefa(self, chave, futuro):
+        # Corre na thread do pool (ou logo no add_done_callback, se a tarefa já terminou):
+        # só passa a conclusão para a thread de despacho
+        self._obter_despachante().submit(self._concluir, chave, futuro)
+
+    def _concluir(self, chave, futuro):
+        """Grava o resultado de uma tarefa e despacha as seguintes (na thread de despacho)"""
+        rel_id, revisao = chave
+        try:
+            erro = futuro.exception()
+            if isinstance(erro, BrokenExecutor):
+                # Um processo do pool morreu a meio da tarefa: o próximo submit troca o pool
+                self._devolver(chave, erro)
+            else:
+                if erro is None:
+                    cache_pdfs.gravar(rel_id, revisao, futuro.result())
+                estado = "falhou" if erro else "concluida"
+                with transacao() as conn:
+                    conn.execute("""UPDATE tarefas_pdf SET estado = ?, erro = ?, atualizada_em = CURRENT_TIMESTAMP
+                                    WHERE relatorio_id = ? AND revisao = ?""", (estado, str(erro) if erro else None, rel_id, revisao))
+                    conn.execute("DELETE FROM tarefas_pdf WHERE relatorio_id = ? AND revisao < ?", (rel_id, revisao))
+        except Exception as erro:
+            self._devolver(chave, erro)
+        finally:
+            self._em_curso.discard(chave)
+        self._despachar()
+
+    def fechar(self):
+        """Deixa de despachar e termina o pool e a thread de despacho, esperando
+        pelas tarefas submetidas e pela gravação dos seus resultados"""
+        def parar():
+            self._fechada = True
+        # Na thread de despacho, depois dos pedidos já feitos: nenhum despacho começa a seguir
+        self._obter_despachante().submit(parar).result()
+        with self._trava:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+        with self._trava:
+            despachante, self._despachante = self._despachante, None
+        despachante.shutdown()
+
+    def contagens(self):
+        """{estado: número de tarefas}"""
+        return {linha["estado"]: linha["total"] for linha in obter_conexao().execute(
+            "SELECT estado, COUNT(*) AS total FROM tarefas_pdf GROUP BY estado")}
+
+@st.cache_resource
+def obter_fila_pdfs():
+    return FilaPdfs()
+
+fila_pdfs = obter_fila_pdfs()
+
+def pdf_preparado(rel_id):
+    """Sem bloquear: (bytes, "concluida") se o PDF da revisão atual já está no cache;
+    senão garante a tarefa na fila e retorna (None, estado da tarefa, erro)"""
+    linha = obter_conexao().execute("""SELECT r.revisao, t.estado, t.erro FROM relatorios_diarios r
+                                       LEFT JOIN tarefas_pdf t ON t.relatorio_id = r.id AND t.revisao = r.revisao
+                                       WHERE r.id = ?""", (rel_id,)).fetchone()
+    if not linha:
+        return None, None, None
+    dados = cache_pdfs.ler(rel_id, linha["revisao"])
+    if dados is not None:
+        return dados, "concluida", None
+    if linha["estado"] in (None, "concluida"):
+        # Sem tarefa, ou concluída mas o arquivo já não está no cache
+        fila_pdfs.enfileirar(rel_id)
+        return None, "na_fila", None
+    return None, linha["estado"], linha["erro"]
+
+# ============================================
+# EXPORTAÇÃO DE FOTOS
+# ============================================
+# Os ZIPs são escritos entrada a entrada num arquivo em disco e cada foto é
+# copiada em blocos, por isso a memória usada não depende do total exportado.
+# Na interface ficam em static/exportacoes/<token>/, servidos pelo Streamlit
+# diretamente do disco, em partes até TAMANHO_MAXIMO_PARTE (o servidor de
+# arquivos estáticos recusa arquivos acima de 200 MB).
+DIRETORIO_EXPORTACOES = f"{DIRETORIO_ESTATICO}/exportacoes"
+TAMANHO_MAXIMO_PARTE = 190 * 1024 * 1024
+VALIDADE_EXPORTACOES = 3600
+EXTENSOES_SEM_COMPRESSAO = {".jpg", ".jpeg", ".png", ".webp"}
+
+def iterar_fotos_exportacao(usuario_id, usuario_tipo, projeto_id=None, tamanho_lote=200):
+    """Todas as fotos visíveis ao usuário, lidas página a página sem passar pelo cache de consultas"""
+    cursor = None
+    while True:
+        with cache_consultas.ignorado():
+            fotos, cursor = obter_pagina_fotos(usuario_id, usuario_tipo, projeto_id, depois_de=cursor, limite=tamanho_lote)
+        yield from fotos
+        if not cursor:
+            break
+
+def nome_entrada_zip(foto):
+    """<atividade>/<data>_<id>.<ext>, sem caracteres que não são válidos em nomes de pasta"""
+    atividade = re.sub(r'[\\/:*?"<>|]+', "_", foto["atividade_agrupada"]).strip(" .") or "Sem atividade"
+    extensao = os.path.splitext(foto["foto_path"])[1].lower() or ".jpg"
+    return f"{atividade}/{foto['data']}_{foto['id']}{extensao}"
+
+def escrever_zip_fotos(fotos, caminho_parte, tamanho_maximo=None):
+    """Escreve as fotos em um ou mais ZIPs; `caminho_parte(n)` dá o caminho da parte n (1, 2, ...).
+
+    Imagens vão sem compressão (STORED): já estão comprimidas e assim a cópia
+    não gasta CPU. Cada parte é escrita num temporário ao lado do destino e
+    renomeada quando fica completa. Com `tamanho_maximo`, uma nova parte
+    começa antes da foto que o excederia.
+    Retorna (partes, em_falta), com partes = [{"caminho", "fotos", "bytes"}].
+    """
+    partes = []
+    em_falta = 0
+    arquivo_zip = None
+    with ExitStack() as parte:
+        def fechar_parte():
+            # Fecha o ZIP e substitui o destino pelo temporário completo
+            parte.close()
+            partes[-1]["bytes"] = os.path.getsize(partes[-1]["caminho"])
+
+        for foto in fotos:
+            if not os.path.exists(foto["foto_path"]):
+                em_falta += 1
+                continue
+            info = zipfile.ZipInfo.from_file(foto["foto_path"], nome_entrada_zip(foto))
+            sem_compressao = os.path.splitext(foto["foto_path"])[1].lower() in EXTENSOES_SEM_COMPRESSAO
+            info.compress_type = zipfile.ZIP_STORED if sem_compressao else zipfile.ZIP_DEFLATED
+
+            if arquivo_zip is None or (tamanho_maximo and arquivo_zip.fp.tell() + info.file_size > tamanho_maximo):
+                if arquivo_zip is not None:
+                    fechar_parte()
+                destino = caminho_parte(len(partes) + 1)
+                os.makedirs(os.path.dirname(destino) or ".", exist_ok=True)
+                f = parte.enter_context(processamento_fotos.escrita_atomica(destino, ".exportacao_", ".zip"))
+                arquivo_zip = parte.enter_context(zipfile.ZipFile(f, "w", allowZip64=True))
+                partes.append({"caminho": destino, "fotos": 0, "bytes": 0})
+
+            with open(foto["foto_path"], "rb") as origem, arquivo_zip.open(info, "w") as entrada:
+                shutil.copyfileobj(origem, entrada, TAMANHO_BLOCO)
+            partes[-1]["fotos"] += 1
+
+        if arquivo_zip is not None:
+            fechar_parte()
+    return partes, em_falta
+
+def limpar_exportacoes_antigas():
+    """Remove as exportações da interface com mais de VALIDADE_EXPORTACOES segundos"""
+    if not os.path.isdir(DIRETORIO_EXPORTACOES):
+        return
+    limite = time.time() - VALIDADE_EXPORTACOES
+    for nome in os.listdir(DIRETORIO_EXPORTACOES):
+        caminho = os.path.join(DIRETORIO_EXPORTACOES, nome)
+        if os.path.getmtime(caminho) < limite:
+            shutil.rmtree(caminho, ignore_errors=True)
+
+def exportar_fotos_projeto(usuario_id, usuario_tipo, projeto_id=None):
+    """Gera o ZIP das fotos para download na interface. Retorna (partes, em_falta);
+    cada parte tem também "url", relativo à página (rota app/static/)"""
+    limpar_exportacoes_antigas()
+    # Token imprevisível: os arquivos estáticos não passam pelo login
+    pasta = os.path.join(DIRETORIO_EXPORTACOES, secrets.token_urlsafe(16))
+    prefixo = f"fotos_projeto_{projeto_id or 'todos'}_{date.today().isoformat()}"
+    with metricas.medir("exportacao.zip_fotos"):
+        partes, em_falta = escrever_zip_fotos(
+            iterar_fotos_exportacao(usuario_id, usuario_tipo, projeto_id),
+            lambda numero: os.path.join(pasta, f"{prefixo}_parte{numero}.zip"),
+            TAMANHO_MAXIMO_PARTE)
+    for parte in partes:
+        parte["url"] = "app/static/" + os.path.relpath(parte["caminho"], DIRETORIO_ESTATICO).replace("\\", "/")
+    return partes, em_falta
+
+# ============================================
+# ARMAZENAMENTO FRIO
+# ============================================
+# Conteúdo usado só por fotos frias (de projetos concluídos ou de relatórios
+# com mais de DIAS_FOTOS_FRIAS dias) é movido para DIRETORIO_FRIO, que pode
+# estar num disco mais lento e barato. No quente fica uma versão reduzida,
+# que passa a ser o foto_path (galeria, exportação, PDF); o original continua
+# a ser o `caminho` de arquivos_fotos e abre-se na galeria, mais devagar.
+# Conteúdo partilhado só é movido quando todas as fotos que o usam são frias.
+DIRETORIO_FRIO = "fotos_frias"
+DIRETORIO_REDUZIDAS = "fotos_obra/reduzidas"
+DIAS_FOTOS_FRIAS = 365
+LADO_REDUZIDO = 1600
+QUALIDADE_REDUZIDA = 70
+
+_SQL_FOTO_QUENTE = """SELECT 1 FROM fotos_obra f
+                      JOIN relatorios_diarios r ON r.id = f.relatorio_id
+                      JOIN projetos p ON p.id = r.projeto_id
+                      WHERE f.conteudo_hash = a.hash AND COALESCE(p.status, '') != 'Concluído' AND r.data >= ?"""
+
+def conteudos_frios(conn, hashes=None, depois_de="", limite_data=None, tamanho_lote=50):
+    """Conteúdos ainda no quente cujas fotos são todas frias, por ordem de hash
+    (só entre `hashes`, se dados, para reconferir dentro da transação)"""
+    condicao, params = "a.hash > ?", [depois_de]
+    if hashes is not None:
+        condicao, params = f"a.hash IN ({','.join('?' * len(hashes))})", list(hashes)
+    return conn.execute(f"""SELECT a.hash, a.caminho, a.caminho_original FROM arquivos_fotos a
+                            WHERE {condicao} AND a.caminho_reduzido IS NULL AND a.referencias > 0
+                            AND NOT EXISTS ({_SQL_FOTO_QUENTE})
+                            ORDER BY a.hash LIMIT ?""", params + [limite_data, tamanho_lote]).fetchall()
+
+def _copiar_para_frio(origem, destino):
+    """Copia em blocos para um temporário ao lado do destino e renomeia"""
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    with processamento_fotos.escrita_atomica(destino, ".frio_") as f, open(origem, "rb") as entrada:
+        shutil.copyfileobj(entrada, f, TAMANHO_BLOCO)
+    shutil.copystat(origem, destino)
+
+def mover_fotos_frias(dias=DIAS_FOTOS_FRIAS, tamanho_lote=50):
+    """Move para o armazenamento frio o conteúdo das fotos frias, lote a lote.
+
+    As versões reduzidas são geradas no pool e os originais copiados para
+    DIRETORIO_FRIO antes da transação. Dentro dela cada conteúdo é reconferido
+    (um envio pode tê-lo passado a usar num projeto ativo), os caminhos de
+    arquivos_fotos e de todas as fotos que o usam são trocados, e só depois do
+    commit os arquivos quentes são apagados.
+    Retorna ({projeto_id: {"projeto", "fotos", "arquivos", "bytes_liberados"}}, falhas);
+    o espaço de um conteúdo partilhado entre projetos conta no da primeira foto.
+    """
+    limite_data = (date.today() - timedelta(days=dias)).isoformat()
+    por_projeto = {}
+    falhas = 0
+    depois_de = ""
+    while True:
+        lote = conteudos_frios(obter_conexao(), depois_de=depois_de, limite_data=limite_data, tamanho_lote=tamanho_lote)
+        if not lote:
+            break
+        depois_de = lote[-1]["hash"]
+
+        preparados = {}
+        futuros = {}
+        for conteudo in lote:
+            if not os.path.exists(conteudo["caminho"]):
+                falhas += 1
+                continue
+            reduzida = caminho_por_conteudo(conteudo["hash"], DIRETORIO_REDUZIDAS)
+            futuros[conteudo["hash"]] = obter_pool_derivados().submit(
+                processamento_fotos.reduzir_foto, conteudo["caminho"], reduzida, LADO_REDUZIDO, QUALIDADE_REDUZIDA)
+            preparados[conteudo["hash"]] = {"reduzida": reduzida, "origens": {}}
+        novos = [p["reduzida"] for p in preparados.values()]
+        descartados = set()
+        try:
+            for conteudo in lote:
+                preparado = preparados.get(conteudo["hash"])
+                if preparado is None:
+                    continue
+                for coluna, diretorio in (("caminho", DIRETORIO_FRIO), ("caminho_original", f"{DIRETORIO_FRIO}/originais")):
+                    if conteudo[coluna] and os.path.exists(conteudo[coluna]):
+                        destino = caminho_por_conteudo(conteudo["hash"], diretorio, os.path.splitext(conteudo[coluna])[1])
+                        _copiar_para_frio(conteudo[coluna], destino)
+                        novos.append(destino)
+                        preparado["origens"][coluna] = (conteudo[coluna], destino)
+            wait(futuros.values())
+            for conteudo_hash, futuro in futuros.items():
+                if futuro.exception():
+                    falhas += 1
+                    # Sem a reduzida o conteúdo fica no quente: descarta as cópias frias já feitas
+                    preparado = preparados.pop(conteudo_hash)
+                    descartados.update([preparado["reduzida"], *(destino for _, destino in preparado["origens"].values())])
+                else:
+                    preparados[conteudo_hash]["tamanho"] = futuro.result()
+
+            with transacao() as conn:
+                ainda_frios = {linha["hash"] for linha in conteudos_frios(conn, list(preparados), limite_data=limite_data,
+                                                                           tamanho_lote=len(preparados))} if preparados else set()
+                movidos = {conteudo_hash: preparado for conteudo_hash, preparado in preparados.items() if conteudo_hash in ainda_frios}
+                for conteudo_hash, preparado in movidos.items():
+                    fotos = conn.execute("""SELECT f.id, f.foto_path, r.projeto_id, p.nome FROM fotos_obra f
+                                            JOIN relatorios_diarios r ON r.id = f.relatorio_id
+                                            JOIN projetos p ON p.id = r.projeto_id
+                                            WHERE f.conteudo_hash = ? ORDER BY f.id""", (conteudo_hash,)).fetchall()
+                    origens = preparado["origens"]
+                    conn.execute("""UPDATE arquivos_fotos SET caminho = ?, caminho_original = ?, caminho_reduzido = ?,
+                                    movido_frio_em = CURRENT_TIMESTAMP WHERE hash = ?""",
+                                 (origens["caminho"][1], origens.get("caminho_original", (None, None))[1],
+                                  preparado["reduzida"], conteudo_hash))
+                    conn.execute("UPDATE fotos_obra SET foto_path = ?, tamanho_bytes = ? WHERE conteudo_hash = ?",
+                                 (preparado["reduzida"], preparado["tamanho"], conteudo_hash))
+
+                    # Os antigos caminhos quentes das fotos (iguais ao `caminho`, salvo dados antigos) e o original enviado
+                    quentes = {foto["foto_path"] for foto in fotos} | {origem for origem, _ in origens.values()}
+                    preparado["quentes"] = quentes
+                    liberados = sum(os.path.getsize(caminho) for caminho in quentes if os.path.exists(caminho)) - preparado["tamanho"]
+                    resumo = por_projeto.setdefault(fotos[0]["projeto_id"], {"projeto": fotos[0]["nome"], "fotos": 0,
+                                                                             "arquivos": 0, "bytes_liberados": 0})
+                    resumo["arquivos"] += 1
+                    resumo["bytes_liberados"] += liberados
+                    for foto in fotos:
+                        por_projeto.setdefault(foto["projeto_id"], {"projeto": foto["nome"], "fotos": 0, "arquivos": 0,
+                                                                    "bytes_liberados": 0})["fotos"] += 1
+                if movidos:
+                    marcar_alteracao("fotos_obra")
+        except BaseException:
+            for caminho in novos:
+                if os.path.exists(caminho):
+                    os.remove(caminho)
+            raise
+
+        # Já com o commit feito: apaga os arquivos quentes dos movidos e o preparado dos que deixaram de ser frios ou falharam
+        sobras = descartados
+        for conteudo_hash, preparado in preparados.items():
+            if conteudo_hash in movidos:
+                sobras.update(preparado["quentes"] - {preparado["reduzida"]})
+            else:
+                sobras.update([preparado["reduzida"], *(destino for _, destino in preparado["origens"].values())])
+        apagar_sem_referencias(sobras)
+    return por_projeto, falhas
+
+# ============================================
+# IMPORTAÇÃO DO BANCO ANTIGO
+# ============================================
+# O obra_completo.db guarda as fotos dentro do banco (fotos.foto_data BLOB),
+# ligadas à tabela relatorios. A importação lê cada BLOB aos bocados e passa-o
+# ao envio_fotos como um arquivo, sem nunca o ter inteiro em memória, e grava
+# cada lote numa transação junto com o último id antigo importado: uma
+# importação interrompida continua de onde parou. Usuários e projetos são
+# associados aos já existentes (por username/email e por nome). Um relatório
+# antigo de um projeto e dia que já tem relatório não é importado: o existente
+# fica como está e recebe as fotos do antigo. As fotos mantêm a data_upload.
+TABELAS_LEGADO = ("usuarios", "projetos", "relatorios", "fotos", "materiais")
+
+class LeitorBlob:
+    """File-like só de leitura sobre um BLOB do banco antigo.
+
+    Usa Connection.blobopen (Python 3.11+); nas versões anteriores lê cada
+    bloco com substr(), que também não traz o BLOB inteiro para o Python.
+    """
+
+    def __init__(self, conn, tabela, coluna, linha_id):
+        self.conn, self.tabela, self.coluna, self.linha_id = conn, tabela, coluna, linha_id
+        self.tamanho = conn.execute(f"SELECT length({coluna}) FROM {tabela} WHERE rowid = ?", (linha_id,)).fetchone()[0] or 0
+        self._blob = conn.blobopen(tabela, coluna, linha_id, readonly=True) if hasattr(conn, "blobopen") and self.tamanho else None
+        self.posicao = 0
+
+    def read(self, tamanho=-1):
+        if tamanho is None or tamanho < 0:
+            tamanho = self.tamanho - self.posicao
+        tamanho = min(tamanho, self.tamanho - self.posicao)
+        if tamanho <= 0:
+            return b""
+        if self._blob is not None:
+            self._blob.seek(self.posicao)
+            dados = self._blob.read(tamanho)
+        else:
+            dados = self.conn.execute(f"SELECT substr({self.coluna}, ?, ?) FROM {self.tabela} WHERE rowid = ?",
+                                      (self.posicao + 1, tamanho, self.linha_id)).fetchone()[0]
+        self.posicao += len(dados)
+        return bytes(dados)
+
+    def seek(self, posicao, origem=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.posicao, os.SEEK_END: self.tamanho}[origem]
+        self.posicao = max(0, base + posicao)
+        return self.posicao
+
+    def close(self):
+        if self._blob is not None:
+            self._blob.close()
+            self._blob = None
+
+def _progresso_legado(conn, origem, tabela):
+    linha = conn.execute("SELECT ultimo_id FROM importacao_legado WHERE origem = ? AND tabela = ?", (origem, tabela)).fetchone()
+    return linha["ultimo_id"] if linha else 0
+
+def _mapear_legado(conn, origem, tabela, ids_antigos):
+    """{id_antigo: id_novo} já importados de `tabela`"""
+    ids_antigos = list({i for i in ids_antigos if i is not None})
+    if not ids_antigos:
+        return {}
+    return {linha["id_antigo"]: linha["id_novo"] for linha in conn.execute(
+        f"""SELECT id_antigo, id_novo FROM mapa_legado WHERE origem = ? AND tabela = ?
+            AND id_antigo IN ({','.join('?' * len(ids_antigos))})""", [origem, tabela, *ids_antigos])}
+
+def _importar_linhas(conn, origem, tabela, linhas, importar_linha):
+    """Grava um lote de linhas antigas: `importar_linha(conn, linha)` retorna o id novo (ou None se a linha for ignorada)"""
+    mapeados = []
+    for linha in linhas:
+        id_novo = importar_linha(conn, linha)
+        if id_novo is not None:
+            mapeados.append((origem, tabela, linha["id"], id_novo))
+    conn.executemany("INSERT OR REPLACE INTO mapa_legado (origem, tabela, id_antigo, id_novo) VALUES (?, ?, ?, ?)", mapeados)
+    conn.execute("INSERT OR REPLACE INTO importacao_legado (origem, tabela, ultimo_id) VALUES (?, ?, ?)",
+                 (origem, tabela, linhas[-1]["id"]))
+    return len(mapeados)
+
+def _usuario_legado(conn, linha):
+    existente = conn.execute("SELECT id FROM usuarios WHERE username = ?", (linha["username"],)).fetchone()
+    if not existente and linha["email"]:
+        existente = conn.execute("SELECT id FROM usuarios WHERE email = ?", (linha["email"],)).fetchone()
+    if existente:
+        return existente["id"]
+    # O banco antigo não tem senhas: o usuário entra inativo, até um administrador definir a senha
+    return conn.execute("""INSERT INTO usuarios (username, nome, email, senha_hash, tipo, telefone, ativo)
+                           VALUES (?, ?, ?, ?, ?, ?, 0)""",
+                        (linha["username"], linha["nome"], linha["email"] or f"{linha['username']}@importado.local",
+                         hashlib.sha256(secrets.token_bytes(32)).hexdigest(), linha["tipo"], linha["telefone"])).lastrowid
+
+def _projeto_legado(conn, linha):
+    existente = conn.execute("SELECT id FROM projetos WHERE nome = ?", (linha["nome"],)).fetchone()
+    if existente:
+        return existente["id"]
+    return conn.execute("""INSERT INTO projetos (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, status)
+                           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                        (linha["nome"], linha["descricao"], linha["localizacao"], linha["orcamento_total"], linha["data_inicio"],
+                         linha["data_fim_previsto"], linha["status"] or "Em andamento")).lastrowid
+
+def importar_banco_antigo(caminho, tamanho_lote=50):
+    """Importa usuários, projetos, relatórios, fotos e materiais de um obra_completo.db.
+
+    Cada tabela é percorrida por id em lotes de `tamanho_lote`, com um commit
+    por lote; executar de novo com o mesmo arquivo continua de onde parou e
+    não duplica nada.
+    Retorna {tabela: {"importadas", "ignoradas"}} desta execução; os
+    relatórios que coincidem com um existente contam como ignorados.
+    """
+    origem = os.path.realpath(caminho)
+    antigo = sqlite3.connect(f"file:{origem}?mode=ro", uri=True)
+    antigo.row_factory = sqlite3.Row
+    resultado = {tabela: {"importadas": 0, "ignoradas": 0} for tabela in TABELAS_LEGADO}
+    try:
+        existentes = {linha["name"] for linha in antigo.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for tabela in TABELAS_LEGADO:
+            if tabela not in existentes:
+                continue
+            colunas = "id, relatorio_id, descricao, data_upload, length(foto_data) AS tamanho" if tabela == "fotos" else "*"
+            while True:
+                conn = obter_conexao()
+                linhas = antigo.execute(f"SELECT {colunas} FROM {tabela} WHERE id > ? ORDER BY id LIMIT ?",
+                                        (_progresso_legado(conn, origem, tabela), tamanho_lote)).fetchall()
+                if not linhas:
+                    break
+                importadas = (_importar_fotos_legado(antigo, origem, linhas) if tabela == "fotos"
+                              else _importar_lote_legado(origem, tabela, linhas))
+                resultado[tabela]["importadas"] += importadas
+                resultado[tabela]["ignoradas"] += len(linhas) - importadas
+    finally:
+        antigo.close()
+    return resultado
+
+def _importar_lote_legado(origem, tabela, linhas):
+    with transacao() as conn:
+        if tabela == "usuarios":
+            marcar_alteracao("usuarios")
+            return _importar_linhas(conn, origem, tabela, linhas, _usuario_legado)
+        if tabela == "projetos":
+            # Projetos novos passam a ser visíveis para os administradores
+            marcar_alteracao("projetos", "acessos")
+            return _importar_linhas(conn, origem, tabela, linhas, _projeto_legado)
+
+        projetos = _mapear_legado(conn, origem, "projetos", [linha["projeto_id"] for linha in linhas])
+        if tabela == "materiais":
+            def importar_material(conn, linha):
+                if linha["projeto_id"] not in projetos:
+                    return None
+                return conn.execute("""INSERT INTO materiais (projeto_id, material, quantidade, unidade, custo_unitario, data_entrada)
+                                       VALUES (?, ?, ?, ?, ?, ?)""",
+                                    (projetos[linha["projeto_id"]], linha["material"], linha["quantidade"], linha["unidade"],
+                                     linha["custo_unitario"], linha["data_entrada"])).lastrowid
+            return _importar_linhas(conn, origem, tabela, linhas, importar_material)
+
+        usuarios = _mapear_legado(conn, origem, "usuarios", [linha["usuario_id"] for linha in linhas])
+        administrador = conn.execute("SELECT id FROM usuarios WHERE tipo = 'admin' ORDER BY id LIMIT 1").fetchone()
+        coincidentes = []
+
+        def importar_relatorio(conn, linha):
+            if linha["projeto_id"] not in projetos:
+                return None
+            projeto_id = projetos[linha["projeto_id"]]
+            existente = conn.execute("SELECT id FROM relatorios_diarios WHERE data = ? AND projeto_id = ?",
+                                     (linha["data"], projeto_id)).fetchone()
+            if existente:
+                # Mapeado para o existente só para as fotos irem para ele; os campos do antigo ficam de fora
+                coincidentes.append(linha["id"])
+                return existente["id"]
+            ocorrencias = linha["ocorrencias"]
+            # relatorios_diarios não tem a coluna acidentes
+            if linha["acidentes"] and linha["acidentes"] != "Nenhum":
+                ocorrencias = f"{ocorrencias}\nAcidentes: {linha['acidentes']}" if ocorrencias else f"Acidentes: {linha['acidentes']}"
+            usuario_id = usuarios.get(linha["usuario_id"], administrador["id"] if administrador else 0)
+            rel_id = conn.execute("""INSERT INTO relatorios_diarios (data, projeto_id, usuario_id, temperatura, atividades, equipe,
+                                     equipamentos, ocorrencias, status, produtividade, observacoes) VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                                  (linha["data"], projeto_id, usuario_id, linha["temperatura"], linha["atividades"], linha["equipe"],
+                                   linha["equipamentos"], ocorrencias, linha["status"], int(linha["produtividade"] or 0),
+                                   linha["observacoes"])).lastrowid
+            gravar_atividades(conn, rel_id, parse_atividades(linha["atividades"] or ""))
+            return rel_id
+
+        importadas = _importar_linhas(conn, origem, tabela, linhas, importar_relatorio)
+        marcar_alteracao("relatorios_diarios")
+        return importadas - len(coincidentes)
+
+def _importar_fotos_legado(antigo, origem, linhas):
+    """Um lote de fotos: os BLOBs vão em blocos para o envio_fotos (um por relatório)
+    antes da transação, que regista as fotos e o progresso de uma só vez.
+    Se alguma foto de um relatório não for uma imagem válida, as desse relatório
+    são enviadas uma a uma e só as inválidas ficam de fora."""
+    relatorios = _mapear_legado(obter_conexao(), origem, "relatorios", [linha["relatorio_id"] for linha in linhas])
+    por_relatorio = {}
+    for linha in linhas:
+        if linha["relatorio_id"] in relatorios and linha["tamanho"]:
+            por_relatorio.setdefault(relatorios[linha["relatorio_id"]], []).append(linha)
+
+    with ExitStack() as pilha:
+        def foto_do_blob(linha):
+            leitor = pilha.enter_context(closing(LeitorBlob(antigo, "fotos", "foto_data", linha["id"])))
+            return {"arquivo": leitor, "descricao": linha["descricao"] or "", "data_upload": linha["data_upload"]}
+
+        envios = []
+        for rel_id, fotos_antigas in por_relatorio.items():
+            fotos = [foto_do_blob(linha) for linha in fotos_antigas]
+            try:
+                envios.append((rel_id, pilha.enter_context(envio_fotos(fotos)), len(fotos)))
+            except Exception:
+                for foto in fotos:
+                    try:
+                        envios.append((rel_id, pilha.enter_context(envio_fotos([foto])), 1))
+                    except Exception:
+                        pass
+        with transacao() as conn:
+            for rel_id, registrar_fotos, _ in envios:
+                registrar_fotos(conn, rel_id)
+            conn.execute("INSERT OR REPLACE INTO importacao_legado (origem, tabela, ultimo_id) VALUES (?, ?, ?)",
+                         (origem, "fotos", linhas[-1]["id"]))
+    return sum(quantidade for _, _, quantidade in envios)
+
+# ============================================
+# VERIFICAÇÃO DO ARMAZENAMENTO
+# ============================================
+# Compara as tabelas com os arquivos em disco em lotes, com o progresso de cada
+# fase em verificacao_armazenamento: uma execução faz no máximo `limite`
+# verificações e a seguinte continua de onde ela parou. Arquivos sem referência
+# ficam em arquivos_orfaos e só são apagados depois de CARENCIA_ORFAOS, porque
+# um envio em curso move o arquivo para o lugar antes do commit.
+CARENCIA_ORFAOS = 24 * 3600
+FASES_VERIFICACAO = ("contagens", "linhas", "arquivos")
+COLUNAS_CAMINHOS = {"fotos_obra": ("foto_path", *COLUNAS_DERIVADOS.values(), "zoom_path", "piramide_path"),
+                    "arquivos_fotos": ("caminho", "caminho_original", "caminho_reduzido")}
+# Temporários do envio, dos derivados e das pirâmides (sobram se o processo morrer a meio)
+PREFIXOS_TEMPORARIOS = (".envio_", ".derivado_", ".piramide_", ".reduzida_", ".frio_")
+SUFIXO_TILES = "_files"
+
+def _percorrer_pasta(pasta, depois_de):
+    try:
+        entradas = list(os.scandir(pasta))
+    except FileNotFoundError:
+        return
+    chaves = {entrada.name: f"{pasta}/{entrada.name}/" if entrada.is_dir(follow_symlinks=False) else f"{pasta}/{entrada.name}"
+              for entrada in entradas}
+    for entrada in sorted(entradas, key=lambda entrada: chaves[entrada.name]):
+        chave = chaves[entrada.name]
+        if entrada.name.startswith(".") and not entrada.name.startswith(PREFIXOS_TEMPORARIOS):
+            continue
+        if chave.endswith("/") and not entrada.name.endswith(SUFIXO_TILES) and not entrada.name.startswith("."):
+            # Uma pasta fica toda antes do cursor se a sua chave for menor e não for prefixo dele
+            if chave > depois_de or depois_de.startswith(chave):
+                yield from _percorrer_pasta(chave[:-1], depois_de)
+        elif chave > depois_de:
+            yield chave, chave.rstrip("/")
+
+def percorrer_armazenamento(raizes, depois_de=""):
+    """Itens em disco sob `raizes`, por ordem, a partir da chave `depois_de` (exclusive).
+
+    Produz (chave, caminho). A chave de uma pasta termina em "/", o que faz a
+    ordem do percurso coincidir com a ordem das chaves: retomar a meio não
+    precisa de listar as pastas que já ficaram para trás. Pastas de tiles e
+    temporárias são um item só. Outros arquivos ocultos são ignorados.
+    """
+    for raiz in sorted(raizes):
+        yield from _percorrer_pasta(raiz, depois_de)
+
+def referencia_do_item(caminho):
+    """Caminho que, guardado numa tabela, mantém o item em disco (a pasta de tiles pertence ao seu .dzi)"""
+    if caminho.endswith(SUFIXO_TILES):
+        return caminho[:-len(SUFIXO_TILES)] + ".dzi"
+    return caminho
+
+def caminhos_referenciados(conn, caminhos):
+    """Dos `caminhos`, os que alguma linha de fotos_obra ou arquivos_fotos usa"""
+    caminhos = list(caminhos)
+    if not caminhos:
+        return set()
+    marcadores = ",".join("?" * len(caminhos))
+    consultas = [f"SELECT {coluna} FROM {tabela} WHERE {coluna} IN ({marcadores})"
+                 for tabela, colunas in COLUNAS_CAMINHOS.items() for coluna in colunas]
+    return {linha[0] for linha in conn.execute(" UNION ".join(consultas), caminhos * len(consultas))}
+
+def tamanho_item(caminho):
+    """Bytes ocupados por um arquivo ou pasta, ou None se já não existir"""
+    try:
+        if os.path.isdir(caminho):
+            return sum(os.path.getsize(os.path.join(pasta, nome)) for pasta, _, nomes in os.walk(caminho) for nome in nomes)
+        return os.path.getsize(caminho)
+    except OSError:
+        return None
+
+def apagar_item(caminho):
+    try:
+        if os.path.isdir(caminho):
+            shutil.rmtree(caminho)
+        else:
+            os.remove(caminho)
+        return True
+    except OSError:
+        return False
+
+def _progresso_verificacao(conn, fase):
+    linha = conn.execute("SELECT cursor, concluida FROM verificacao_armazenamento WHERE fase = ?", (fase,)).fetchone()
+    return (linha["cursor"], bool(linha["concluida"])) if linha else ("", False)
+
+def _gravar_progresso(conn, fase, cursor, concluida=False):
+    conn.execute("INSERT OR REPLACE INTO verificacao_armazenamento (fase, cursor, concluida) VALUES (?, ?, ?)",
+                 (fase, cursor, int(concluida)))
+
+def _verificar_contagens(cursor, restante, relatorio, apenas_verificar, tamanho_lote):
+    """Confere `referencias` de arquivos_fotos com as linhas de fotos_obra; conteúdo sem
+    linhas perde o registo e os seus arquivos passam a órfãos"""
+    while restante > 0:
+        with transacao() as conn:
+            linhas = conn.execute("""SELECT a.hash, a.referencias,
+                                            (SELECT COUNT(*) FROM fotos_obra f WHERE f.conteudo_hash = a.hash) AS contagem
+                                     FROM arquivos_fotos a WHERE a.hash > ? ORDER BY a.hash LIMIT ?""",
+                                  (cursor, min(tamanho_lote, restante))).fetchall()
+            if not linhas:
+                _gravar_progresso(conn, "contagens", cursor, concluida=True)
+                return restante, True
+            divergentes = [linha for linha in linhas if linha["referencias"] != linha["contagem"] or not linha["contagem"]]
+            if not apenas_verificar:
+                conn.executemany("UPDATE arquivos_fotos SET referencias = ? WHERE hash = ?",
+                                 [(linha["contagem"], linha["hash"]) for linha in divergentes if linha["contagem"]])
+                conn.executemany("DELETE FROM arquivos_fotos WHERE hash = ?",
+                                 [(linha["hash"],) for linha in divergentes if not linha["contagem"]])
+            cursor = linhas[-1]["hash"]
+            _gravar_progresso(conn, "contagens", cursor)
+        relatorio["contagens_verificadas"] += len(linhas)
+        relatorio["contagens_corrigidas"] += len(divergentes)
+        restante -= len(linhas)
+    return restante, False
+
+def _verificar_linhas(cursor, restante, relatorio, apenas_verificar, tamanho_lote):
+    """Fotos cujo arquivo não existe são reportadas; derivados e pirâmides que
+    não existem voltam a NULL para serem gerados de novo"""
+    ultimo_id = int(cursor or 0)
+    while restante > 0:
+        with transacao() as conn:
+            linhas = conn.execute(f"""SELECT id, foto_path, {', '.join(COLUNAS_DERIVADOS.values())}, piramide_path
+                                      FROM fotos_obra WHERE id > ? ORDER BY id LIMIT ?""",
+                                  (ultimo_id, min(tamanho_lote, restante))).fetchall()
+            if not linhas:
+                _gravar_progresso(conn, "linhas", str(ultimo_id), concluida=True)
+                return restante, True
+            sem_derivados = [(linha["id"],) for linha in linhas
+                             if any(linha[coluna] and not os.path.exists(linha[coluna]) for coluna in COLUNAS_DERIVADOS.values())]
+            sem_piramide = [(linha["id"],) for linha in linhas if linha["piramide_path"] and not os.path.exists(linha["piramide_path"])]
+            relatorio["fotos_em_falta"].extend(linha["id"] for linha in linhas if not os.path.exists(linha["foto_path"]))
+            if not apenas_verificar and (sem_derivados or sem_piramide):
+                conn.executemany(f"UPDATE fotos_obra SET {', '.join(f'{coluna} = NULL' for coluna in COLUNAS_DERIVADOS.values())} WHERE id = ?",
+                                 sem_derivados)
+                conn.executemany("UPDATE fotos_obra SET piramide_path = NULL WHERE id = ?", sem_piramide)
+                marcar_alteracao("fotos_obra")
+            ultimo_id = linhas[-1]["id"]
+            _gravar_progresso(conn, "linhas", str(ultimo_id))
+        relatorio["linhas_verificadas"] += len(linhas)
+        relatorio["derivados_em_falta"] += len(sem_derivados) + len(sem_piramide)
+        restante -= len(linhas)
+    return restante, False
+
+def _verificar_arquivos(cursor, restante, relatorio, apenas_verificar, tamanho_lote):
+    """Percorre as pastas das fotos (quente e fria) e das pirâmides e regista em arquivos_orfaos o que não tem referência"""
+    itens = percorrer_armazenamento((DIRETORIO_FOTOS, DIRETORIO_FRIO, DIRETORIO_PIRAMIDES), cursor)
+    while restante > 0:
+        lote = list(itertools.islice(itens, min(tamanho_lote, restante)))
+        if not lote:
+            with transacao() as conn:
+                _gravar_progresso(conn, "arquivos", cursor, concluida=True)
+            return restante, True
+        caminhos = [caminho for _, caminho in lote]
+        referenciados = caminhos_referenciados(obter_conexao(), {referencia_do_item(caminho) for caminho in caminhos})
+        usados = {caminho for caminho in caminhos if referencia_do_item(caminho) in referenciados}
+        agora = time.time()
+        orfaos = [(caminho, tamanho, agora) for caminho in caminhos if caminho not in usados
+                  for tamanho in [tamanho_item(caminho)] if tamanho is not None]
+
+        with transacao() as conn:
+            if usados:
+                conn.execute(f"DELETE FROM arquivos_orfaos WHERE caminho IN ({','.join('?' * len(usados))})", list(usados))
+            antes = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO arquivos_orfaos (caminho, tamanho_bytes, detectado_em) VALUES (?, ?, ?)", orfaos)
+            relatorio["orfaos_detectados"] += conn.total_changes - antes
+            cursor = lote[-1][0]
+            _gravar_progresso(conn, "arquivos", cursor)
+        relatorio["arquivos_verificados"] += len(lote)
+        restante -= len(lote)
+    return restante, False
+
+VERIFICADORES = {"contagens": _verificar_contagens, "linhas": _verificar_linhas, "arquivos": _verificar_arquivos}
+
+def recolher_orfaos(carencia=CARENCIA_ORFAOS, tamanho_lote=100):
+    """Apaga os órfãos detectados há mais de `carencia` segundos.
+
+    Cada lote é reconferido com o bloqueio de escrita, para que nenhum envio
+    passe a usar o arquivo entre a verificação e a remoção. Um órfão
+    modificado durante a carência recomeça a contagem.
+    Retorna (removidos, bytes_recuperados).
+    """
+    limite = time.time() - carencia
+    removidos = bytes_recuperados = 0
+    while True:
+        with transacao() as conn:
+            linhas = conn.execute("""SELECT caminho, tamanho_bytes FROM arquivos_orfaos
+                                     WHERE detectado_em < ? ORDER BY detectado_em LIMIT ?""", (limite, tamanho_lote)).fetchall()
+            if not linhas:
+                break
+            referenciados = caminhos_referenciados(conn, {referencia_do_item(linha["caminho"]) for linha in linhas})
+            recentes = []
+            for linha in linhas:
+                caminho = linha["caminho"]
+                if referencia_do_item(caminho) in referenciados:
+                    continue
+                try:
+                    modificado = os.path.getmtime(caminho)
+                except OSError:
+                    continue
+                if modificado >= limite:
+                    recentes.append(caminho)
+                elif apagar_item(caminho):
+                    removidos += 1
+                    bytes_recuperados += linha["tamanho_bytes"]
+            conn.executemany("DELETE FROM arquivos_orfaos WHERE caminho = ?", [(linha["caminho"],) for linha in linhas])
+            conn.executemany("INSERT INTO arquivos_orfaos (caminho, tamanho_bytes, detectado_em) VALUES (?, ?, ?)",
+                             [(caminho, tamanho_item(caminho) or 0, time.time()) for caminho in recentes])
+    return removidos, bytes_recuperados
+
+def verificar_armazenamento(limite=20000, carencia=CARENCIA_ORFAOS, apenas_verificar=False, tamanho_lote=100):
+    """Faz até `limite` verificações do armazenamento das fotos, continuando a volta anterior.
+
+    As fases são, por ordem: contagens de referências de arquivos_fotos, linhas
+    de fotos_obra e arquivos em disco (ver VERIFICADORES). Quando as três
+    terminam, a volta está completa e a execução seguinte recomeça do início.
+    No fim de cada execução os órfãos com carência cumprida são apagados.
+    Com `apenas_verificar` nada é corrigido nem apagado (o progresso e a lista
+    de órfãos continuam a ser atualizados).
+    Retorna um dicionário com as contagens desta execução.
+    """
+    relatorio = {"contagens_verificadas": 0, "contagens_corrigidas": 0, "linhas_verificadas": 0, "fotos_em_falta": [],
+                 "derivados_em_falta": 0, "arquivos_verificados": 0, "orfaos_detectados": 0, "orfaos_removidos": 0,
+                 "bytes_recuperados": 0, "volta_concluida": False}
+    restante = limite
+    with metricas.medir("manutencao.verificar_armazenamento"):
+        for fase in FASES_VERIFICACAO:
+            cursor, concluida = _progresso_verificacao(obter_conexao(), fase)
+            if not concluida:
+                restante, concluida = VERIFICADORES[fase](cursor, restante, relatorio, apenas_verificar, tamanho_lote)
+            if not concluida:
+                break
+        else:
+            with transacao() as conn:
+                conn.execute("DELETE FROM verificacao_armazenamento")
+            relatorio["volta_concluida"] = True
+
+        if not apenas_verificar:
+            relatorio["orfaos_removidos"], relatorio["bytes_recuperados"] = recolher_orfaos(carencia, tamanho_lote)
+    pendentes = obter_conexao().execute("SELECT COUNT(*), COALESCE(SUM(tamanho_bytes), 0) FROM arquivos_orfaos").fetchone()
+    relatorio["orfaos_pendentes"], relatorio["bytes_pendentes"] = pendentes[0], pendentes[1]
+    return relatorio
+
+# ============================================
+# DIAGNÓSTICO DE CONSULTAS
+# ============================================
+_RE_VARREDURA_COMPLETA = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+_RE_TABELA_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_RE_LITERAIS = re.compile(r"X?'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# Tabelas de resumo têm uma linha por projeto, versoes_dados uma por chave e
+# arquivos_orfaos só os órfãos por apagar: percorrê-las inteiras é o esperado
+TABELAS_VARREDURA_PERMITIDA = {"projeto_resumo", "projeto_resumo_status", "versoes_dados", "arquivos_orfaos"}
+
+def _chamadas_representativas(conn):
+    """Chamadas a todas as funções de leitura, com ids existentes no banco"""
+    def primeiro_id(sql):
+        linha = conn.execute(sql).fetchone()
+        return linha[0] if linha else 1
+
+    usuario_id = primeiro_id("SELECT id FROM usuarios WHERE tipo = 'proprietario' ORDER BY id LIMIT 1")
+    projeto_id = primeiro_id("SELECT id FROM projetos ORDER BY id LIMIT 1")
+    relatorio_id = primeiro_id("SELECT id FROM relatorios_diarios ORDER BY id LIMIT 1")
+    foto_id = primeiro_id("SELECT id FROM fotos_obra ORDER BY id LIMIT 1")
+
+    chamadas = [
+        lambda: verificar_login("admin", "admin123"),
+        obter_projetos,
+        obter_usuarios,
+        lambda: obter_usuarios_por_tipo("fiscal"),
+        lambda: obter_usuarios_por_projeto(projeto_id),
+        lambda: obter_projetos_disponiveis_usuario(usuario_id),
+        lambda: obter_fotos_por_relatorio(relatorio_id),
+        lambda: carregar_relatorio(relatorio_id),
+        lambda: obter_atividades_relatorio(relatorio_id),
+        lambda: caminhos_referenciados(conn, [f"{DIRETORIO_FOTOS}/verificacao.jpg"]),
+        lambda: obter_fotos_semelhantes(foto_id),
+        lambda: procurar_semelhantes(conn, 0, projeto_id),
+    ]
+    for tipo in ("admin", "fiscal", "proprietario"):
+        chamadas.append(lambda tipo=tipo: obter_projetos_por_usuario(usuario_id, tipo))
+        for filtro in (None, projeto_id):
+            chamadas.extend([
+                lambda tipo=tipo, filtro=filtro: obter_relatorios_usuario(usuario_id, admin=(tipo == "admin"), projeto_id=filtro),
+                lambda tipo=tipo, filtro=filtro: obter_pagina_fotos(usuario_id, tipo, filtro),
+                lambda tipo=tipo, filtro=filtro: obter_pagina_fotos(usuario_id, tipo, filtro, "Sem atividade", "2000-01-01",
+                                                                    "2100-01-01", ("2100-01-01", 1 << 62)),
+                lambda tipo=tipo, filtro=filtro: obter_pagina_fotos(usuario_id, tipo, filtro, captura_inicio="2000-01-01",
+                                                                    captura_fim="2000-01-31", area=(-27.0, -25.0, 32.0, 33.0)),
+                lambda tipo=tipo, filtro=filtro: contar_fotos_por_atividade(filtro, usuario_id, tipo),
+                lambda tipo=tipo, filtro=filtro: obter_ultimo_relatorio(filtro, usuario_id, tipo),
+                lambda tipo=tipo, filtro=filtro: obter_agregados_relatorios(usuario_id, tipo, filtro),
+            ])
+        chamadas.append(lambda tipo=tipo: obter_resumo_projetos(usuario_id, tipo))
+        chamadas.append(lambda tipo=tipo: obter_historico_atividades(usuario_id, tipo))
+        chamadas.append(lambda tipo=tipo: obter_historico_atividades(usuario_id, tipo, projeto_id))
+    return chamadas, usuario_id, projeto_id
+
+def _jpeg_exemplo(lado=64):
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (lado, lado), os.urandom(lado * lado * 3)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def _criar_banco_legado(caminho):
+    """obra_completo.db mínimo, com uma linha por tabela, para exercitar a importação"""
+    with closing(sqlite3.connect(caminho)) as antigo, antigo:
+        antigo.executescript("""
+            CREATE TABLE usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, nome TEXT NOT NULL,
+                                   email TEXT, tipo TEXT NOT NULL, telefone TEXT);
+            CREATE TABLE projetos (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT NOT NULL, descricao TEXT, localizacao TEXT,
+                                   orcamento_total REAL, data_inicio DATE, data_fim_previsto DATE, status TEXT DEFAULT 'Em andamento');
+            CREATE TABLE relatorios (id INTEGER PRIMARY KEY AUTOINCREMENT, data DATE NOT NULL, projeto_id INTEGER, usuario_id INTEGER,
+                                     temperatura TEXT, atividades TEXT NOT NULL, equipe TEXT, equipamentos TEXT, ocorrencias TEXT,
+                                     acidentes TEXT DEFAULT 'Nenhum', status TEXT, produtividade INTEGER, observacoes TEXT);
+            CREATE TABLE fotos (id INTEGER PRIMARY KEY AUTOINCREMENT, relatorio_id INTEGER, foto_data BLOB, descricao TEXT,
+                                data_upload TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE TABLE materiais (id INTEGER PRIMARY KEY AUTOINCREMENT, projeto_id INTEGER, material TEXT NOT NULL,
+                                    quantidade REAL, unidade TEXT, custo_unitario REAL, data_entrada DATE);""")
+        antigo.execute("INSERT INTO usuarios (username, nome, email, tipo) VALUES ('legado', 'Usuário Antigo', NULL, 'fiscal')")
+        antigo.execute("INSERT INTO projetos (nome, status) VALUES ('Projeto Antigo', 'Concluído')")
+        antigo.execute("""INSERT INTO relatorios (data, projeto_id, usuario_id, atividades, acidentes, status, produtividade)
+                          VALUES ('2001-01-01', 1, 1, 'Fundação', 'Queda', 'Concluído', 100)""")
+        antigo.execute("INSERT INTO fotos (relatorio_id, foto_data, descricao) VALUES (1, ?, 'Antiga')", (_jpeg_exemplo(),))
+        antigo.execute("INSERT INTO materiais (projeto_id, material, quantidade) VALUES (1, 'Cimento', 10)")
+
+def _percorrer_escritas(pasta):
+    """Gera dados de exemplo no banco atual e passa por todos os caminhos de
+    escrita: formulários, migrações em lotes, derivados, armazenamento frio,
+    verificação do armazenamento, exportação, importação do banco antigo e fila de PDFs"""
+    conn = obter_conexao()
+    usuario_id = adicionar_usuario("verificacao", "Verificação", "verificacao@local", "verificacao", "fiscal", "")
+    projeto_id = adicionar_projeto("Verificação", "", "", 0, "2000-01-01", "2000-12-31", usuario_id, usuario_id)
+    atualizar_projeto(projeto_id, "Verificação de planos", "", "", 0, "2000-01-01", "2000-12-31", "Em andamento",
+                      usuario_id, usuario_id)
+    atualizar_usuario(usuario_id, "verificacao", "Verificação de planos", "verificacao@local", "fiscal", "", 1)
+    associar_usuario_projeto(usuario_id, projeto_id)
+
+    # Duas gravações no mesmo dia cobrem o INSERT e o UPDATE
+    fotos = lambda: [{"bytes": _jpeg_exemplo(), "descricao": "Verificação", "atividade_principal": "Fundação"}]
+    rel_id = salvar_relatorio_com_fotos("2000-01-01", projeto_id, usuario_id, fotos(), atividades="Fundação\n- Escavação")
+    salvar_relatorio_com_fotos("2000-01-01", projeto_id, usuario_id, fotos(), atividades="Fundação\n- Escavação")
+    salvar_foto(rel_id, _jpeg_exemplo(), "Avulsa")
+    outro_id = salvar_relatorio_com_fotos("2000-01-02", projeto_id, usuario_id, fotos(), atividades="Estrutura")
+
+    # Migrações em lotes sobre as linhas de exemplo (todas são idempotentes)
+    conn.execute("PRAGMA user_version = 2")
+    executar_migracoes(conn)
+    with transacao() as escrita:
+        reconstruir_resumo_projetos(escrita)
+
+    gerar_derivados_em_falta()
+    with closing(zipfile.ZipFile(os.path.join(pasta, "exportacao.zip"), "w")) as zip_fotos:
+        for foto in iterar_fotos_exportacao(usuario_id, "fiscal", projeto_id):
+            zip_fotos.writestr(nome_entrada_zip(foto), b"")
+
+    caminho_legado = os.path.join(pasta, "obra_completo.db")
+    _criar_banco_legado(caminho_legado)
+    importar_banco_antigo(caminho_legado)
+
+    mover_fotos_frias(dias=0)
+    verificar_armazenamento(carencia=0)
+
+    fila = FilaPdfs(trabalhadores=1)
+    fila.enfileirar(outro_id)
+    prazo = time.monotonic() + 60
+    while (fila.contagens().keys() & {"na_fila", "em_curso"}) and time.monotonic() < prazo:
+        time.sleep(0.1)
+    fila.fechar()
+    pdf_preparado(outro_id)
+
+    apagar_relatorio(rel_id)
+    desassociar_usuario_projeto(usuario_id, projeto_id)
+    excluir_projeto(projeto_id)
+
+def _consultas_dos_triggers(conn):
+    """(nome, instrução) de cada instrução dentro dos triggers, com NEW./OLD. trocados por parâmetros:
+    o trace callback só mostra o comentário "-- TRIGGER nome", não o que o trigger executa"""
+    instrucoes = []
+    for linha in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name"):
+        corpo = re.search(r"\bBEGIN\b(.*)\bEND\s*$", linha["sql"], re.IGNORECASE | re.DOTALL).group(1)
+        for instrucao in corpo.split(";"):
+            instrucao = re.sub(r"\b(?:NEW|OLD)\.\w+", "?", instrucao).strip()
+            if instrucao:
+                instrucoes.append((linha["name"], instrucao))
+    return instrucoes
+
+def _analisar_plano(conn, sql, consulta):
+    # Em versões do Python sem SQL expandido no trace, os parâmetros ficam por ligar
+    plano = [linha["detail"] for linha in conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?"))]
+    aliases = {alias: tabela for tabela, alias in _RE_TABELA_ALIAS.findall(sql) if alias}
+    varreduras = [aliases.get(m.group(1), m.group(1)) for m in map(_RE_VARREDURA_COMPLETA.match, plano) if m]
+    varreduras = [tabela for tabela in varreduras if tabela not in TABELAS_VARREDURA_PERMITIDA]
+    return {"consulta": consulta, "plano": plano, "varreduras": varreduras}
+
+def verificar_planos_consulta(caminho=None):
+    """Executa EXPLAIN QUERY PLAN sobre todas as consultas do módulo.
+
+    As consultas são capturadas com um trace callback num banco temporário,
+    criado do zero num diretório temporário: as funções de leitura correm com
+    argumentos representativos e os caminhos de escrita com dados de exemplo
+    (ver _percorrer_escritas). Os planos são depois pedidos ao banco
+    `caminho`, aberto só para leitura, juntamente com os das instruções dos
+    triggers; nada é executado nele. Troca o diretório de trabalho e o banco
+    do processo enquanto corre, por isso a interface chama-a noutro processo.
+    Retorna uma lista com a consulta, o plano e as tabelas lidas por varredura completa.
+    """
+    caminho_anterior = CAMINHO_BANCO
+    origem = os.path.abspath(caminho or CAMINHO_BANCO)
+    diretorio_anterior = os.getcwd()
+    capturadas = []
+    with tempfile.TemporaryDirectory() as pasta:
+        temporario = os.path.join(pasta, "verificacao.db")
+        os.chdir(pasta)
+        try:
+            obter_gerenciador_conexoes(temporario).rastreio = capturadas.append
+            usar_banco(temporario)
+            with cache_consultas.ignorado():
+                _percorrer_escritas(pasta)
+                # Os ids de exemplo são escolhidos fora do trace
+                conn = obter_conexao()
+                conn.set_trace_callback(None)
+                chamadas, _, _ = _chamadas_representativas(conn)
+                conn.set_trace_callback(capturadas.append)
+                for chamada in chamadas:
+                    chamada()
+        finally:
+            obter_gerenciador_conexoes(temporario).rastreio = None
+            encerrar_pool_derivados()
+            os.chdir(diretorio_anterior)
+            usar_banco(caminho_anterior)
+
+    resultados = []
+    vistas = set()
+    with closing(sqlite3.connect(f"file:{origem}?mode=ro", uri=True)) as conn:
+        conn.row_factory = sqlite3.Row
+        for sql in capturadas:
+            consulta = " ".join(sql.split())
+            if not re.match(r"(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", consulta, re.IGNORECASE):
+                continue
+            # O trace traz os valores ligados: consultas que só diferem neles são a mesma
+            chave = re.sub(r"\((?:\?\s*,\s*)*\?\)", "(?)", _RE_LITERAIS.sub("?", consulta))
+            if chave in vistas:
+                continue
+            vistas.add(chave)
+            resultados.append(_analisar_plano(conn, sql, consulta))
+        for nome, instrucao in _consultas_dos_triggers(conn):
+            resultados.append(_analisar_plano(conn, instrucao, f"-- {nome}: {' '.join(instrucao.split())}"))
+    return resultados
+
+def verificar_planos_em_processo(caminho):
+    """verificar_planos_consulta num processo à parte, para não trocar o diretório e o banco do servidor"""
+    saida = subprocess.run([sys.executable, os.path.abspath(__file__), "verificar-planos", "--banco", caminho, "--json"],
+                           capture_output=True, text=True)
+    if saida.returncode not in (0, 1):
+        raise RuntimeError(saida.stderr.strip().splitlines()[-1] if saida.stderr.strip() else "verificação interrompida")
+    return json.loads(saida.stdout)
+
+# ============================================
+# LINHA DE COMANDO (MANUTENÇÃO)
+# ============================================
+def executar_linha_comando(argv):
+    """Ferramentas de manutenção executadas com `python dados_obra.py <comando>`"""
+    parser = argparse.ArgumentParser(prog="dados_obra.py", description="Ferramentas de manutenção do Dashboard de Obra")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    p_bench = subparsers.add_parser("benchmark-conexoes", help="Mede a vazão com sessões concorrentes")
+    p_bench.add_argument("--sessoes", type=int, default=8)
+    p_bench.add_argument("--operacoes", type=int, default=200)
+    p_bench.add_argument("--proporcao-escrita", type=float, default=0.2)
+
+    p_planos = subparsers.add_parser("verificar-planos", help="Falha se alguma consulta fizer varredura completa de tabela")
+    p_planos.add_argument("--banco", default=CAMINHO_BANCO)
+    p_planos.add_argument("--json", action="store_true", help="Resultados em JSON (usado pela interface)")
+
+    p_envio = subparsers.add_parser("benchmark-envio", help="Mede a latência de gravar um relatório conforme o número de fotos")
+    p_envio.add_argument("--fotos", type=int, nargs="+", default=[1, 5, 10, 30])
+    p_envio.add_argument("--tamanho-kb", type=int, default=200)
+    p_envio.add_argument("--repeticoes", type=int, default=3)
+
+    p_derivados = subparsers.add_parser("gerar-derivados", help="Gera miniaturas, versões médias e pirâmides de zoom das fotos que ainda não as têm")
+    p_derivados.add_argument("--banco", default=CAMINHO_BANCO)
+
+    p_resumo = subparsers.add_parser("resumo-projetos", help="Recalcula o resumo por projeto do zero e corrige divergências")
+    p_resumo.add_argument("--banco", default=CAMINHO_BANCO)
+    p_resumo.add_argument("--verificar", action="store_true", help="Apenas verifica; falha se houver divergências")
+
+    p_armazenamento = subparsers.add_parser("verificar-armazenamento",
+                                            help="Confere fotos e arquivos em disco e apaga os órfãos depois da carência (continua onde a última execução parou)")
+    p_armazenamento.add_argument("--banco", default=CAMINHO_BANCO)
+    p_armazenamento.add_argument("--limite", type=int, default=20000, help="Máximo de linhas e arquivos verificados nesta execução")
+    p_armazenamento.add_argument("--carencia-horas", type=float, default=CARENCIA_ORFAOS / 3600)
+    p_armazenamento.add_argument("--verificar", action="store_true", help="Apenas verifica; não corrige nem apaga")
+
+    p_frias = subparsers.add_parser("mover-fotos-frias",
+                                    help="Move para o armazenamento frio as fotos de projetos concluídos ou antigas, deixando uma versão reduzida")
+    p_frias.add_argument("--banco", default=CAMINHO_BANCO)
+    p_frias.add_argument("--dias", type=int, default=DIAS_FOTOS_FRIAS, help="Idade mínima do relatório, em dias, para projetos não concluídos")
+
+    p_legado = subparsers.add_parser("importar-legado",
+                                     help="Importa relatórios, fotos (BLOBs) e materiais de um obra_completo.db (continua onde a última execução parou; "
+                                          "relatórios de um dia que já tem relatório são ignorados e as suas fotos vão para o existente)")
+    p_legado.add_argument("origem", help="Caminho do banco antigo")
+    p_legado.add_argument("--banco", default=CAMINHO_BANCO)
+    p_legado.add_argument("--lote", type=int, default=50, help="Linhas por transação")
+
+    p_exportar = subparsers.add_parser("exportar-fotos", help="Exporta as fotos num ZIP, em pastas por atividade")
+    p_exportar.add_argument("saida", help="Caminho do arquivo ZIP")
+    p_exportar.add_argument("--projeto", type=int, default=None, help="Só as fotos deste projeto (padrão: todos)")
+    p_exportar.add_argument("--banco", default=CAMINHO_BANCO)
+
+    args = parser.parse_args(argv)
+
+    if args.comando == "benchmark-conexoes":
+        resultados = benchmark_conexoes(args.sessoes, args.operacoes, args.proporcao_escrita)
+        for modo, ops in resultados.items():
+            print(f"{modo:>20}: {ops:10.1f} ops/s")
+        ganho = resultados["conexao_por_thread"] / resultados["conexao_unica"]
+        print(f"{'ganho':>20}: {ganho:10.2f}x")
+
+    elif args.comando == "verificar-planos":
+        usar_banco(args.banco)
+        resultados = verificar_planos_consulta(args.banco)
+        falhas = [r for r in resultados if r["varreduras"]]
+        if args.json:
+            print(json.dumps(resultados))
+            return 1 if falhas else 0
+        for r in falhas:
+            print(f"VARREDURA COMPLETA em {', '.join(r['varreduras'])}:\n  {r['consulta']}")
+            for linha in r["plano"]:
+                print(f"    {linha}")
+        print(f"{len(resultados)} consultas verificadas, {len(falhas)} com varredura completa")
+        return 1 if falhas else 0
+
+    elif args.comando == "benchmark-envio":
+        resultados = benchmark_envio_relatorio(args.fotos, args.tamanho_kb * 1024, args.repeticoes)
+        print(f"{'fotos':>6} {'transacao_por_foto':>20} {'transacao_unica':>17} {'ganho':>7}")
+        for quantidade, tempos in resultados.items():
+            ganho = tempos["transacao_por_foto"] / tempos["transacao_unica"]
+            print(f"{quantidade:>6} {tempos['transacao_por_foto']:>17.1f} ms {tempos['transacao_unica']:>14.1f} ms {ganho:>6.2f}x")
+
+    elif args.comando == "gerar-derivados":
+        usar_banco(args.banco)
+        gerados, falhas = gerar_derivados_em_falta()
+        for tipo, tarefas in (("derivados", tarefas_derivados), ("pirâmide", tarefas_piramides)):
+            for foto_id, erro in sorted(tarefas.falhas.items()):
+                print(f"Foto {foto_id} ({tipo}): {erro}")
+        print(f"{gerados} derivados/pirâmides gerados, {falhas} falhas")
+        return 1 if falhas else 0
+
+    elif args.comando == "resumo-projetos":
+        usar_banco(args.banco)
+        with transacao() as conn:
+            divergencias = reconstruir_resumo_projetos(conn, apenas_verificar=args.verificar)
+        for divergencia in divergencias:
+            print(divergencia)
+        if not divergencias:
+            print("Resumo dos projetos consistente")
+        elif args.verificar:
+            return 1
+        else:
+            print(f"{len(divergencias)} divergências corrigidas")
+
+    elif args.comando == "verificar-armazenamento":
+        usar_banco(args.banco)
+        relatorio = verificar_armazenamento(args.limite, args.carencia_horas * 3600, apenas_verificar=args.verificar)
+        for foto_id in relatorio["fotos_em_falta"]:
+            print(f"Foto {foto_id}: arquivo em falta")
+        print(f"{relatorio['contagens_verificadas']} contagens de referências verificadas, {relatorio['contagens_corrigidas']} divergentes")
+        print(f"{relatorio['linhas_verificadas']} fotos verificadas, {len(relatorio['fotos_em_falta'])} sem arquivo, "
+              f"{relatorio['derivados_em_falta']} com derivados ou pirâmide em falta")
+        print(f"{relatorio['arquivos_verificados']} arquivos em disco verificados, {relatorio['orfaos_detectados']} órfãos novos")
+        print(f"{relatorio['orfaos_removidos']} órfãos removidos, {relatorio['bytes_recuperados'] / 1024 / 1024:.1f} MB recuperados; "
+              f"{relatorio['orfaos_pendentes']} em carência ({relatorio['bytes_pendentes'] / 1024 / 1024:.1f} MB)")
+        print("Volta completa" if relatorio["volta_concluida"] else "Volta incompleta: a próxima execução continua daqui")
+        return 1 if relatorio["fotos_em_falta"] else 0
+
+    elif args.comando == "mover-fotos-frias":
+        usar_banco(args.banco)
+        por_projeto, falhas = mover_fotos_frias(args.dias)
+        for projeto_id, resumo in sorted(por_projeto.items()):
+            print(f"{resumo['projeto']} (#{projeto_id}): {resumo['fotos']} fotos, {resumo['arquivos']} arquivos movidos, "
+                  f"{resumo['bytes_liberados'] / 1024 / 1024:.1f} MB liberados no armazenamento quente")
+        total = sum(resumo["bytes_liberados"] for resumo in por_projeto.values())
+        print(f"{total / 1024 / 1024:.1f} MB liberados no total, {falhas} falhas")
+        return 1 if falhas else 0
+
+    elif args.comando == "importar-legado":
+        usar_banco(args.banco)
+        resultado = importar_banco_antigo(args.origem, args.lote)
+        for tabela, contagem in resultado.items():
+            print(f"{tabela:>12}: {contagem['importadas']} importadas, {contagem['ignoradas']} ignoradas")
+
+    elif args.comando == "exportar-fotos":
+        usar_banco(args.banco)
+        partes, em_falta = escrever_zip_fotos(iterar_fotos_exportacao(None, "admin", args.projeto), lambda numero: args.saida)
+        total = sum(parte["fotos"] for parte in partes)
+        print(f"{total} fotos exportadas para {args.saida}" if partes else "Nenhuma foto para exportar")
+        if em_falta:
+            print(f"{em_falta} fotos sem arquivo em disco foram ignoradas")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(executar_linha_comando(sys.argv[1:]))
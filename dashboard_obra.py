@@ -3,18 +3,37 @@ import pandas as pd
 import numpy as np
 import datetime
 from datetime import date, timedelta
-import sqlite3
-import hashlib
-import io
 import os
+import json
+from importlib.machinery import ModuleSpec
 import plotly.graph_objects as go
 import plotly.express as px
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
 from streamlit_image_zoom import image_zoom
 from PIL import Image
+import processamento_fotos
+from dados_obra import (
+    CAMINHO_BANCO, DIAS_FOTOS_FRIAS, DIRETORIO_ESTATICO, PRE_GERAR_PDFS,
+    adicionar_projeto, adicionar_usuario, agendar_piramide, agrupar_semelhantes,
+    apagar_relatorio, associar_usuario_projeto, atualizar_projeto,
+    atualizar_usuario, cache_consultas, cache_miniaturas, cache_pdfs,
+    carregar_relatorio, contar_fotos_por_atividade, desassociar_usuario_projeto,
+    excluir_projeto, exportar_fotos_projeto, fila_pdfs, garantir_derivados,
+    get_day_name, leitura_sob_demanda, metricas, obter_agregados_relatorios,
+    obter_atividades_relatorio, obter_fotos_por_relatorio,
+    obter_fotos_semelhantes, obter_historico_atividades, obter_pagina_fotos,
+    obter_projetos, obter_projetos_disponiveis_usuario,
+    obter_projetos_por_usuario, obter_relatorios_usuario, obter_resumo_projetos,
+    obter_ultimo_relatorio, obter_usuarios, obter_usuarios_por_projeto,
+    pdf_preparado, pdf_sob_demanda, pre_carregar_pagina, preparar_banco,
+    reconstruir_resumo_projetos, salvar_relatorio_com_fotos, tarefas_derivados,
+    tarefas_piramides, transacao, verificar_login, verificar_planos_em_processo
+)
+
+# O Streamlit executa esta página num módulo __main__ sem __spec__, e o spawn
+# voltaria a executá-la (login, menu, fila de PDFs) em cada processo dos
+# pools. Com um spec chamado "__main__" o filho só importa os módulos das
+# tarefas (processamento_fotos, processamento_relatorios).
+__spec__ = ModuleSpec("__main__", None)
 
 # ============================================
 # CONFIGURAÇÃO DA PÁGINA
@@ -207,605 +226,6 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# ============================================
-# FUNÇÕES AUXILIARES - ATUALIZADA
-# ============================================
-def init_database():
-    conn = sqlite3.connect('controle_obra.db', check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    # Tabela de usuários
-    c.execute("""CREATE TABLE IF NOT EXISTS usuarios (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, 
-        username TEXT UNIQUE NOT NULL, 
-        nome TEXT NOT NULL, 
-        email TEXT UNIQUE NOT NULL,
-        senha_hash TEXT NOT NULL, 
-        tipo TEXT NOT NULL, 
-        telefone TEXT, 
-        ativo INTEGER DEFAULT 1)""")
-    
-    # Tabela de projetos - ADICIONADA coluna proprietario_id
-    c.execute("""CREATE TABLE IF NOT EXISTS projetos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, 
-        nome TEXT NOT NULL, 
-        descricao TEXT, 
-        localizacao TEXT, 
-        orcamento_total REAL,
-        data_inicio DATE, 
-        data_fim_previsto DATE, 
-        status TEXT DEFAULT 'Em andamento', 
-        responsavel_id INTEGER,
-        proprietario_id INTEGER,
-        FOREIGN KEY (responsavel_id) REFERENCES usuarios (id),
-        FOREIGN KEY (proprietario_id) REFERENCES usuarios (id))""")
-    
-    # Tabela de relatórios diários
-    c.execute("""CREATE TABLE IF NOT EXISTS relatorios_diarios (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, 
-        data DATE NOT NULL, 
-        projeto_id INTEGER NOT NULL, 
-        usuario_id INTEGER NOT NULL,
-        temperatura TEXT, 
-        atividades TEXT NOT NULL, 
-        equipe TEXT, 
-        equipamentos TEXT, 
-        ocorrencias TEXT,
-        plano_amanha TEXT, 
-        status TEXT, 
-        produtividade INTEGER, 
-        observacoes TEXT,
-        FOREIGN KEY (projeto_id) REFERENCES projetos (id), 
-        FOREIGN KEY (usuario_id) REFERENCES usuarios (id))""")
-    
-    # Tabela de fotos
-    c.execute("""CREATE TABLE IF NOT EXISTS fotos_obra (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, 
-        relatorio_id INTEGER NOT NULL, 
-        foto_path TEXT NOT NULL,
-        descricao TEXT, 
-        atividade_principal TEXT,
-        data_upload DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (relatorio_id) REFERENCES relatorios_diarios (id))""")
-
-    # Tabela de acesso de usuários a projetos
-    c.execute("""CREATE TABLE IF NOT EXISTS usuarios_projetos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        usuario_id INTEGER NOT NULL,
-        projeto_id INTEGER NOT NULL,
-        data_associacao DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (usuario_id) REFERENCES usuarios (id),
-        FOREIGN KEY (projeto_id) REFERENCES projetos (id),
-        UNIQUE(usuario_id, projeto_id))""")
-
-    # VERIFICAR E ADICIONAR COLUNAS SE NECESSÁRIO
-    try:
-        c.execute("SELECT proprietario_id FROM projetos LIMIT 1")
-    except sqlite3.OperationalError:
-        # A coluna não existe, vamos adicioná-la
-        c.execute("ALTER TABLE projetos ADD COLUMN proprietario_id INTEGER")
-        conn.commit()
-
-    # Inserir usuários padrão se não existirem
-    c.execute("SELECT COUNT(*) FROM usuarios")
-    if c.fetchone()[0] == 0:
-        usuarios_padrao = [
-            ('fiscal', 'Fiscal da Obra', 'fiscal@obra.com', hashlib.sha256('fiscal123'.encode()).hexdigest(), 'fiscal', '+258840000000'),
-            ('proprietario1', 'João Silva', 'joao@obra.com', hashlib.sha256('joao123'.encode()).hexdigest(), 'proprietario', '+258841111111'),
-            ('proprietario2', 'Maria Santos', 'maria@obra.com', hashlib.sha256('maria123'.encode()).hexdigest(), 'proprietario', '+258842222222'),
-            ('proprietario3', 'Antonio Pereira', 'antonio@obra.com', hashlib.sha256('antonio123'.encode()).hexdigest(), 'proprietario', '+258843333333'),
-            ('admin', 'Administrador', 'admin@obra.com', hashlib.sha256('admin123'.encode()).hexdigest(), 'admin', '+258860000000')
-        ]
-        c.executemany("INSERT INTO usuarios (username,nome,email,senha_hash,tipo,telefone) VALUES (?,?,?,?,?,?)", usuarios_padrao)
-
-    # Inserir projeto padrão se não existir
-    c.execute("SELECT COUNT(*) FROM projetos")
-    if c.fetchone()[0] == 0:
-        projetos_padrao = [
-            ('Obra Xai-Xai', 'Requalificação com expansão', 'Xai-Xai, Gaza', 2500000.0, '2025-02-01', '2025-08-01', 1, 2),
-            ('Condomínio Maputo', 'Residencial de luxo', 'Maputo', 3500000.0, '2025-01-15', '2025-10-30', 1, 3),
-            ('Escola Gaza', 'Escola secundária', 'Gaza', 1800000.0, '2025-03-01', '2025-11-15', 1, 4)
-        ]
-        for projeto in projetos_padrao:
-            c.execute("""INSERT INTO projetos (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id)
-                      VALUES (?,?,?,?,?,?,?,?)""", projeto)
-    
-    conn.commit()
-    return conn
-
-conn = init_database()
-
-def verificar_login(username, password):
-    c = conn.cursor()
-    hash_senha = hashlib.sha256(password.encode()).hexdigest()
-    c.execute("SELECT id,username,nome,tipo FROM usuarios WHERE username=? AND senha_hash=? AND ativo=1", (username, hash_senha))
-    return c.fetchone()
-
-def obter_projetos():
-    c = conn.cursor()
-    c.execute("""SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
-                 FROM projetos p 
-                 LEFT JOIN usuarios u ON p.responsavel_id = u.id
-                 LEFT JOIN usuarios up ON p.proprietario_id = up.id
-                 ORDER BY p.data_inicio DESC""")
-    return c.fetchall()
-
-def obter_projetos_por_usuario(usuario_id, usuario_tipo):
-    """Obtém projetos que um usuário tem acesso"""
-    c = conn.cursor()
-    
-    if usuario_tipo == 'admin':
-        # Admin vê todos os projetos
-        c.execute("""
-            SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
-            FROM projetos p 
-            LEFT JOIN usuarios u ON p.responsavel_id = u.id
-            LEFT JOIN usuarios up ON p.proprietario_id = up.id
-            ORDER BY p.data_inicio DESC
-        """)
-    elif usuario_tipo == 'fiscal':
-        # Fiscal vê todos os projetos
-        c.execute("""
-            SELECT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
-            FROM projetos p 
-            LEFT JOIN usuarios u ON p.responsavel_id = u.id
-            LEFT JOIN usuarios up ON p.proprietario_id = up.id
-            ORDER BY p.data_inicio DESC
-        """)
-    else:
-        # Proprietário vê apenas seus projetos
-        c.execute("""
-            SELECT DISTINCT p.*, u.nome as responsavel_nome, up.nome as proprietario_nome 
-            FROM projetos p 
-            LEFT JOIN usuarios u ON p.responsavel_id = u.id
-            LEFT JOIN usuarios up ON p.proprietario_id = up.id
-            LEFT JOIN usuarios_projetos upr ON p.id = upr.projeto_id
-            WHERE p.proprietario_id = ? OR upr.usuario_id = ? OR p.responsavel_id = ?
-            ORDER BY p.data_inicio DESC
-        """, (usuario_id, usuario_id, usuario_id))
-    
-    return c.fetchall()
-
-def obter_usuarios():
-    c = conn.cursor()
-    c.execute("SELECT * FROM usuarios ORDER BY nome")
-    return c.fetchall()
-
-def obter_usuarios_por_tipo(tipo):
-    """Obtém usuários por tipo específico"""
-    c = conn.cursor()
-    c.execute("SELECT * FROM usuarios WHERE tipo = ? AND ativo = 1 ORDER BY nome", (tipo,))
-    return c.fetchall()
-
-def obter_usuarios_por_projeto(projeto_id):
-    """Obtém usuários que têm acesso a um projeto específico"""
-    c = conn.cursor()
-    c.execute("""
-        SELECT u.* FROM usuarios u
-        JOIN usuarios_projetos up ON u.id = up.usuario_id
-        WHERE up.projeto_id = ?
-        ORDER BY u.nome
-    """, (projeto_id,))
-    return c.fetchall()
-
-def adicionar_usuario(username, nome, email, senha, tipo, telefone):
-    c = conn.cursor()
-    try:
-        senha_hash = hashlib.sha256(senha.encode()).hexdigest()
-        c.execute("""
-            INSERT INTO usuarios (username, nome, email, senha_hash, tipo, telefone)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (username, nome, email, senha_hash, tipo, telefone))
-        conn.commit()
-        return c.lastrowid
-    except sqlite3.IntegrityError as e:
-        raise Exception(f"Erro: {str(e)}")
-
-def atualizar_usuario(usuario_id, username, nome, email, tipo, telefone, ativo):
-    c = conn.cursor()
-    try:
-        c.execute("""
-            UPDATE usuarios 
-            SET username=?, nome=?, email=?, tipo=?, telefone=?, ativo=?
-            WHERE id=?
-        """, (username, nome, email, tipo, telefone, ativo, usuario_id))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError as e:
-        raise Exception(f"Erro: {str(e)}")
-
-def adicionar_projeto(nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id):
-    c = conn.cursor()
-    try:
-        c.execute("""
-            INSERT INTO projetos (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, responsavel_id, proprietario_id))
-        projeto_id = c.lastrowid
-        
-        # Associar automaticamente o proprietário ao projeto
-        if proprietario_id:
-            associar_usuario_projeto(proprietario_id, projeto_id)
-        
-        conn.commit()
-        return projeto_id
-    except Exception as e:
-        raise Exception(f"Erro: {str(e)}")
-
-def atualizar_projeto(projeto_id, nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, status, responsavel_id, proprietario_id):
-    c = conn.cursor()
-    try:
-        c.execute("""
-            UPDATE projetos 
-            SET nome=?, descricao=?, localizacao=?, orcamento_total=?, data_inicio=?, data_fim_previsto=?, status=?, responsavel_id=?, proprietario_id=?
-            WHERE id=?
-        """, (nome, descricao, localizacao, orcamento_total, data_inicio, data_fim_previsto, status, responsavel_id, proprietario_id, projeto_id))
-        conn.commit()
-        return True
-    except Exception as e:
-        raise Exception(f"Erro: {str(e)}")
-
-def excluir_projeto(projeto_id):
-    """Exclui um projeto e todos os dados relacionados"""
-    c = conn.cursor()
-    try:
-        # Obter todas as fotos do projeto para excluir arquivos
-        c.execute("""
-            SELECT f.foto_path FROM fotos_obra f
-            JOIN relatorios_diarios r ON f.relatorio_id = r.id
-            WHERE r.projeto_id = ?
-        """, (projeto_id,))
-        
-        fotos = c.fetchall()
-        for foto in fotos:
-            caminho = foto["foto_path"]
-            if os.path.exists(caminho):
-                try:
-                    os.remove(caminho)
-                except:
-                    pass
-        
-        # Excluir dados relacionados
-        c.execute("DELETE FROM usuarios_projetos WHERE projeto_id = ?", (projeto_id,))
-        c.execute("DELETE FROM fotos_obra WHERE relatorio_id IN (SELECT id FROM relatorios_diarios WHERE projeto_id = ?)", (projeto_id,))
-        c.execute("DELETE FROM relatorios_diarios WHERE projeto_id = ?", (projeto_id,))
-        c.execute("DELETE FROM projetos WHERE id = ?", (projeto_id,))
-        
-        conn.commit()
-        return True
-    except Exception as e:
-        raise Exception(f"Erro ao excluir projeto: {str(e)}")
-
-def associar_usuario_projeto(usuario_id, projeto_id):
-    """Associa um usuário a um projeto"""
-    c = conn.cursor()
-    try:
-        c.execute("""
-            INSERT OR IGNORE INTO usuarios_projetos (usuario_id, projeto_id)
-            VALUES (?, ?)
-        """, (usuario_id, projeto_id))
-        conn.commit()
-        return True
-    except Exception as e:
-        raise Exception(f"Erro: {str(e)}")
-
-def desassociar_usuario_projeto(usuario_id, projeto_id):
-    """Remove a associação de um usuário com um projeto"""
-    c = conn.cursor()
-    try:
-        c.execute("DELETE FROM usuarios_projetos WHERE usuario_id=? AND projeto_id=?", (usuario_id, projeto_id))
-        conn.commit()
-        return True
-    except Exception as e:
-        raise Exception(f"Erro: {str(e)}")
-
-def obter_projetos_disponiveis_usuario(usuario_id):
-    """Obtém projetos disponíveis para um usuário (que ainda não tem acesso)"""
-    c = conn.cursor()
-    c.execute("""
-        SELECT p.* FROM projetos p
-        WHERE p.id NOT IN (
-            SELECT projeto_id FROM usuarios_projetos WHERE usuario_id = ?
-        )
-        AND p.id NOT IN (
-            SELECT id FROM projetos WHERE responsavel_id = ? OR proprietario_id = ?
-        )
-        ORDER BY p.nome
-    """, (usuario_id, usuario_id, usuario_id))
-    return c.fetchall()
-
-def obter_relatorios_usuario(usuario_id, admin=False, projeto_id=None):
-    c = conn.cursor()
-    
-    # Se for admin, mostra todos os relatórios
-    if admin:
-        query = """SELECT r.id, r.data, p.nome AS projeto_nome, u.nome AS usuario_nome, r.status, r.produtividade
-                   FROM relatorios_diarios r
-                   JOIN projetos p ON r.projeto_id = p.id
-                   JOIN usuarios u ON r.usuario_id = u.id"""
-        params = []
-    else:
-        # Para não-admins, mostra apenas relatórios de projetos que têm acesso
-        query = """SELECT r.id, r.data, p.nome AS projeto_nome, u.nome AS usuario_nome, r.status, r.produtividade
-                   FROM relatorios_diarios r
-                   JOIN projetos p ON r.projeto_id = p.id
-                   JOIN usuarios u ON r.usuario_id = u.id
-                   WHERE p.id IN (
-                       SELECT projeto_id FROM usuarios_projetos WHERE usuario_id = ?
-                       UNION
-                       SELECT id FROM projetos WHERE responsavel_id = ? OR proprietario_id = ?
-                   )"""
-        params = [usuario_id, usuario_id, usuario_id]
-    
-    if projeto_id and projeto_id != 0:
-        where_clause = " AND" if params else " WHERE"
-        query += f" {where_clause} r.projeto_id = ?"
-        params.append(projeto_id)
-    
-    query += " ORDER BY r.data DESC"
-    c.execute(query, params)
-    return c.fetchall()
-
-def obter_fotos_por_relatorio(relatorio_id):
-    """Obtém todas as fotos de um relatório específico"""
-    c = conn.cursor()
-    c.execute("""
-        SELECT * FROM fotos_obra 
-        WHERE relatorio_id = ?
-        ORDER BY data_upload DESC
-    """, (relatorio_id,))
-    return c.fetchall()
-
-def obter_fotos_por_atividade(projeto_id=None, usuario_id=None, usuario_tipo=None):
-    """Obtém fotos agrupadas por atividade principal"""
-    c = conn.cursor()
-    
-    query = """
-        SELECT f.*, r.data, p.nome as projeto_nome, 
-               COALESCE(f.atividade_principal, 'Sem atividade') as atividade_agrupada
-        FROM fotos_obra f
-        JOIN relatorios_diarios r ON f.relatorio_id = r.id
-        JOIN projetos p ON r.projeto_id = p.id
-    """
-    
-    params = []
-    
-    if projeto_id and projeto_id != 0:
-        query += " WHERE r.projeto_id = ?"
-        params.append(projeto_id)
-    elif usuario_tipo != "admin":
-        # Para não-admins, filtrar apenas projetos que têm acesso
-        query += """ WHERE r.projeto_id IN (
-            SELECT projeto_id FROM usuarios_projetos WHERE usuario_id = ?
-            UNION
-            SELECT id FROM projetos WHERE responsavel_id = ? OR proprietario_id = ?
-        )"""
-        params.extend([usuario_id, usuario_id, usuario_id])
-    
-    query += " ORDER BY f.atividade_principal, r.data DESC, f.data_upload DESC"
-    
-    c.execute(query, params)
-    return c.fetchall()
-
-def contar_fotos_por_atividade(projeto_id=None, usuario_id=None, usuario_tipo=None):
-    """Conta fotos por atividade principal"""
-    c = conn.cursor()
-    
-    query = """
-        SELECT 
-            COALESCE(f.atividade_principal, 'Sem atividade') as atividade,
-            COUNT(*) as total_fotos
-        FROM fotos_obra f
-        JOIN relatorios_diarios r ON f.relatorio_id = r.id
-        JOIN projetos p ON r.projeto_id = p.id
-    """
-    
-    params = []
-    
-    if projeto_id and projeto_id != 0:
-        query += " WHERE r.projeto_id = ?"
-        params.append(projeto_id)
-    elif usuario_tipo != "admin":
-        query += """ WHERE r.projeto_id IN (
-            SELECT projeto_id FROM usuarios_projetos WHERE usuario_id = ?
-            UNION
-            SELECT id FROM projetos WHERE responsavel_id = ? OR proprietario_id = ?
-        )"""
-        params.extend([usuario_id, usuario_id, usuario_id])
-    
-    query += " GROUP BY atividade ORDER BY total_fotos DESC"
-    
-    c.execute(query, params)
-    return c.fetchall()
-
-def obter_ultimo_relatorio(projeto_id=None, usuario_id=None, usuario_tipo=None):
-    """Obtém o último relatório registrado"""
-    c = conn.cursor()
-    
-    query = """
-        SELECT r.*, p.nome as projeto_nome, u.nome as usuario_nome
-        FROM relatorios_diarios r
-        JOIN projetos p ON r.projeto_id = p.id
-        JOIN usuarios u ON r.usuario_id = u.id
-    """
-    
-    params = []
-    
-    if projeto_id and projeto_id != 0:
-        query += " WHERE r.projeto_id = ?"
-        params.append(projeto_id)
-    elif usuario_tipo != "admin":
-        query += """ WHERE r.projeto_id IN (
-            SELECT projeto_id FROM usuarios_projetos WHERE usuario_id = ?
-            UNION
-            SELECT id FROM projetos WHERE responsavel_id = ? OR proprietario_id = ?
-        )"""
-        params.extend([usuario_id, usuario_id, usuario_id])
-    
-    query += " ORDER BY r.data DESC LIMIT 1"
-    
-    c.execute(query, params)
-    return c.fetchone()
-
-def carregar_relatorio(rel_id):
-    c = conn.cursor()
-    c.execute("SELECT * FROM relatorios_diarios WHERE id = ?", (rel_id,))
-    return c.fetchone()
-
-def apagar_relatorio(rel_id):
-    c = conn.cursor()
-    c.execute("SELECT foto_path FROM fotos_obra WHERE relatorio_id = ?", (rel_id,))
-    for row in c.fetchall():
-        caminho = row["foto_path"]
-        if os.path.exists(caminho):
-            os.remove(caminho)
-    
-    c.execute("DELETE FROM fotos_obra WHERE relatorio_id = ?", (rel_id,))
-    c.execute("DELETE FROM relatorios_diarios WHERE id = ?", (rel_id,))
-    conn.commit()
-
-def salvar_relatorio(data, projeto_id, usuario_id, **dados):
-    c = conn.cursor()
-    c.execute("SELECT id FROM relatorios_diarios WHERE data=? AND projeto_id=?", (data, projeto_id))
-    existente = c.fetchone()
-    produtividade = int(dados.get('produtividade', 0))
-    
-    if existente:
-        c.execute("""UPDATE relatorios_diarios SET temperatura=?, atividades=?, equipe=?, equipamentos=?, ocorrencias=?,
-                  plano_amanha=?, status=?, produtividade=?, observacoes=? WHERE id=?""",
-                  (dados.get('temperatura'), dados.get('atividades'), dados.get('equipe'), dados.get('equipamentos'),
-                   dados.get('ocorrencias'), dados.get('plano_amanha'), dados.get('status'),
-                   produtividade, dados.get('observacoes'), existente['id']))
-        rel_id = existente['id']
-    else:
-        c.execute("""INSERT INTO relatorios_diarios (data,projeto_id,usuario_id,temperatura,atividades,equipe,equipamentos,ocorrencias,
-                  plano_amanha,status,produtividade,observacoes) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)""",
-                  (data, projeto_id, usuario_id, dados.get('temperatura'), dados.get('atividades'), dados.get('equipe'),
-                   dados.get('equipamentos'), dados.get('ocorrencias'), dados.get('plano_amanha'),
-                   dados.get('status'), produtividade, dados.get('observacoes')))
-        rel_id = c.lastrowid
-    
-    conn.commit()
-    return rel_id
-
-def salvar_foto(relatorio_id, foto_bytes, descricao="", atividade_principal=""):
-    os.makedirs("fotos_obra", exist_ok=True)
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    nome = f"foto_{relatorio_id}_{timestamp}.jpg"
-    caminho = os.path.join("fotos_obra", nome)
-    
-    with open(caminho, "wb") as f:
-        f.write(foto_bytes)
-    
-    c = conn.cursor()
-    c.execute("INSERT INTO fotos_obra (relatorio_id, foto_path, descricao, atividade_principal) VALUES (?,?,?,?)", 
-              (relatorio_id, caminho, descricao, atividade_principal))
-    conn.commit()
-
-def gerar_pdf(rel_id):
-    c = conn.cursor()
-    c.execute("""SELECT r.*, p.nome AS nome_projeto, u.nome AS nome_usuario 
-                 FROM relatorios_diarios r
-                 JOIN projetos p ON r.projeto_id = p.id
-                 JOIN usuarios u ON r.usuario_id = u.id 
-                 WHERE r.id = ?""", (rel_id,))
-    rel = c.fetchone()
-    
-    if not rel:
-        return None
-
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-    elements = [Paragraph("Relatório Diário de Obra", styles['Title']), Spacer(1, 20)]
-
-    data_tabela = [
-        ["Data", str(rel["data"])],
-        ["Projeto", rel["nome_projeto"]],
-        ["Responsável", rel["nome_usuario"]],
-        ["Status", rel["status"] or "Não informado"],
-        ["Produtividade", f"{rel['produtividade'] or 0}%"],
-    ]
-    
-    t = Table(data_tabela, colWidths=[100, 400])
-    t.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#f0f0f0')),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    elements.append(t)
-    elements.append(Spacer(1, 20))
-
-    secoes = [
-        ("Clima", rel["temperatura"]),
-        ("Atividades", rel["atividades"]),
-        ("Equipe", rel["equipe"]),
-        ("Equipamentos", rel["equipamentos"]),
-        ("Ocorrências", rel["ocorrencias"]),
-        ("Plano Amanhã", rel["plano_amanha"]),
-        ("Observações", rel["observacoes"]),
-    ]
-
-    for titulo, texto in secoes:
-        if texto and str(texto).strip():
-            elements.append(Paragraph(f"<b>{titulo}:</b> {texto}", styles['Normal']))
-            elements.append(Spacer(1, 10))
-
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
-
-def get_day_name(date_obj):
-    """Retorna o nome do dia da semana em português"""
-    days_pt = ["Segunda-feira", "Terça-feira", "Quarta-feira", "Quinta-feira", 
-               "Sexta-feira", "Sábado", "Domingo"]
-    return days_pt[date_obj.weekday()]
-
-def parse_atividades(atividades_texto):
-    """Parseia o texto de atividades em estrutura hierárquica"""
-    atividades = []
-    linhas = atividades_texto.split('\n')
-    
-    for linha in linhas:
-        linha = linha.strip()
-        if not linha:
-            continue
-            
-        if ':' in linha:
-            partes = linha.split(':', 1)
-            atividade_principal = partes[0].strip()
-            subatividades_texto = partes[1].strip()
-            
-            # Parsear subatividades
-            subatividades = []
-            if subatividades_texto:
-                # Separar por vírgulas ou outros delimitadores
-                for sub in subatividades_texto.split(','):
-                    sub = sub.strip()
-                    if sub:
-                        # Verificar se tem indicação de status
-                        feito = '✅' in sub or 'Concluído' in sub or 'Feito' in sub
-                        # Remover indicadores de status
-                        nome_sub = sub.replace('✅', '').replace('❌', '').replace('Concluído', '').replace('Feito', '').replace('Pendente', '').strip()
-                        subatividades.append({
-                            'nome': nome_sub,
-                            'feito': feito
-                        })
-            
-            atividades.append({
-                'titulo': atividade_principal,
-                'subs': subatividades
-            })
-        else:
-            # Se não tem subatividades, é uma atividade simples
-            atividades.append({
-                'titulo': linha,
-                'subs': []
-            })
-    
-    return atividades
-
 # ============================================
 # FUNÇÕES PARA GRÁFICOS
 # ============================================
@@ -870,19 +290,14 @@ def criar_grafico_pizza_produtividade(atividades_parsed):
     
     return fig
 
-def criar_grafico_status_relatorios(relatorios):
-    """Cria gráfico de status dos relatórios"""
-    if not relatorios:
+def criar_grafico_status_relatorios(por_status):
+    """Cria gráfico de status dos relatórios a partir da contagem por status"""
+    if not por_status:
         return None
     
-    status_counts = {}
-    for rel in relatorios:
-        status = rel["status"] or "Não informado"
-        status_counts[status] = status_counts.get(status, 0) + 1
-    
     fig = go.Figure(data=[go.Pie(
-        labels=list(status_counts.keys()),
-        values=list(status_counts.values()),
+        labels=[linha["status"] for linha in por_status],
+        values=[linha["total"] for linha in por_status],
         hole=.2,
         marker_colors=['#10B981', '#F59E0B', '#EF4444', '#6B7280']
     )])
@@ -894,13 +309,13 @@ def criar_grafico_status_relatorios(relatorios):
     
     return fig
 
-def criar_grafico_produtividade_temporal(relatorios):
-    """Cria gráfico de linha da produtividade ao longo do tempo"""
-    if not relatorios or len(relatorios) < 2:
+def criar_grafico_produtividade_temporal(serie_diaria):
+    """Cria gráfico de linha da produtividade média diária ao longo do tempo"""
+    if not serie_diaria or len(serie_diaria) < 2:
         return None
     
-    datas = [r["data"] for r in relatorios]
-    produtividades = [r["produtividade"] for r in relatorios]
+    datas = [linha["data"] for linha in serie_diaria]
+    produtividades = [linha["produtividade"] for linha in serie_diaria]
     
     fig = go.Figure()
     
@@ -934,17 +349,23 @@ def criar_grafico_produtividade_temporal(relatorios):
     
     return fig
 
+
+# Preparação do banco: só faz trabalho no primeiro rerun do processo
+with metricas.medir("banco.preparo_por_rerun"):
+    estado_banco = preparar_banco(CAMINHO_BANCO)
+fila_pdfs.iniciar()
+
 # ============================================
 # LOGIN
 # ============================================
 if 'usuario' not in st.session_state:
     st.markdown("<h1 class='main-header'>Painel de Controle de Obra</h1>", unsafe_allow_html=True)
-    
+
     with st.form("login_form"):
         st.subheader("Login")
         user = st.text_input("Usuário")
         pwd = st.text_input("Senha", type="password")
-        
+
         if st.form_submit_button("Entrar", type="primary"):
             logado = verificar_login(user, pwd)
             if logado:
@@ -958,7 +379,7 @@ if 'usuario' not in st.session_state:
                 st.rerun()
             else:
                 st.error("Credenciais inválidas")
-    
+
     st.stop()
 
 usuario = st.session_state.usuario
@@ -996,7 +417,7 @@ with st.sidebar:
             ("🚨 Alertas", "Alertas")
         ]
     }
-    
+
     opcoes_usuario = opcoes.get(usuario["tipo"], opcoes["fiscal"])
     pagina = st.radio("Navegação", [item[1] for item in opcoes_usuario],
                       format_func=lambda x: next((i[0] for i in opcoes_usuario if i[1] == x), x))
@@ -1004,7 +425,7 @@ with st.sidebar:
     # Obter projetos baseado no tipo de usuário
     projetos = obter_projetos_por_usuario(usuario["id"], usuario["tipo"])
     projeto_dict = {p["id"]: p["nome"] for p in projetos}
-    
+
     # Verificar se há projetos disponíveis
     if projeto_dict:
         projeto_id = st.selectbox("Projeto", options=[0] + list(projeto_dict.keys()),
@@ -1027,11 +448,7 @@ def exibir_dashboard(projeto_id):
     
     projetos_lista = obter_projetos_por_usuario(usuario["id"], usuario["tipo"])
     
-    relatorios = obter_relatorios_usuario(
-        usuario["id"], 
-        admin=(usuario["tipo"] == "admin"), 
-        projeto_id=projeto_id
-    )
+    agregados = obter_agregados_relatorios(usuario["id"], usuario["tipo"], projeto_id)
     
     # Obter último relatório para análise detalhada
     ultimo_relatorio = obter_ultimo_relatorio(projeto_id, usuario["id"], usuario["tipo"])
@@ -1054,13 +471,13 @@ def exibir_dashboard(projeto_id):
         st.markdown(f"""
         <div class="card">
             <div class="card-title">📋 Relatórios</div>
-            <div class="card-value">{len(relatorios)}</div>
-            <div class="card-subtitle">Dias registrados</div>
+            <div class="card-value">{agregados['total']}</div>
+            <div class="card-subtitle">Último: {agregados['ultima_data'] or '-'}</div>
         </div>
         """, unsafe_allow_html=True)
     
     with col3:
-        prod_media = np.mean([r["produtividade"] for r in relatorios]) if relatorios else 0
+        prod_media = agregados["produtividade_media"]
         st.markdown(f"""
         <div class="card">
             <div class="card-title">📊 Produtividade Média</div>
@@ -1070,23 +487,16 @@ def exibir_dashboard(projeto_id):
         """, unsafe_allow_html=True)
     
     with col4:
-        # Contar fotos
-        if projeto_id and projeto_id != 0:
-            fotos_por_atividade = contar_fotos_por_atividade(projeto_id, usuario["id"], usuario["tipo"])
-        else:
-            fotos_por_atividade = contar_fotos_por_atividade(None, usuario["id"], usuario["tipo"])
-        total_fotos = sum(item['total_fotos'] for item in fotos_por_atividade) if fotos_por_atividade else 0
-        
         st.markdown(f"""
         <div class="card">
             <div class="card-title">📸 Total de Fotos</div>
-            <div class="card-value">{total_fotos}</div>
+            <div class="card-value">{agregados['total_fotos']}</div>
             <div class="card-subtitle">Imagens registradas</div>
         </div>
         """, unsafe_allow_html=True)
     
     # ========== SEÇÃO DE GRÁFICOS ==========
-    if relatorios or ultimo_relatorio:
+    if agregados["total"] or ultimo_relatorio:
         st.markdown("---")
         st.subheader("📊 Análise Visual de Dados")
         
@@ -1094,16 +504,16 @@ def exibir_dashboard(projeto_id):
         col_chart1, col_chart2 = st.columns(2)
         
         with col_chart1:
-            if relatorios:
+            if agregados["por_status"]:
                 # Gráfico de status dos relatórios
-                fig_status = criar_grafico_status_relatorios(relatorios)
+                fig_status = criar_grafico_status_relatorios(agregados["por_status"])
                 if fig_status:
                     st.plotly_chart(fig_status, use_container_width=True)
         
         with col_chart2:
-            if relatorios and len(relatorios) > 1:
+            if len(agregados["serie_diaria"]) > 1:
                 # Gráfico de produtividade temporal
-                fig_prod_temporal = criar_grafico_produtividade_temporal(relatorios)
+                fig_prod_temporal = criar_grafico_produtividade_temporal(agregados["serie_diaria"])
                 if fig_prod_temporal:
                     st.plotly_chart(fig_prod_temporal, use_container_width=True)
     
@@ -1112,8 +522,8 @@ def exibir_dashboard(projeto_id):
         st.markdown("---")
         st.subheader(f"📅 Último Relatório: {ultimo_relatorio['data']}")
         
-        # Parsear atividades do último relatório
-        atividades_parsed = parse_atividades(ultimo_relatorio['atividades'])
+        # Atividades do último relatório
+        atividades_parsed = obter_atividades_relatorio(ultimo_relatorio['id'])
         
         # Card de Status e Produtividade
         col_status, col_prod, col_fotos = st.columns(3)
@@ -1244,7 +654,16 @@ def exibir_dashboard(projeto_id):
     
     else:
         st.info("Nenhum relatório encontrado para o projeto selecionado.")
-    
+
+    # ========== HISTÓRICO DE ATIVIDADES ==========
+    historico = obter_historico_atividades(usuario["id"], usuario["tipo"], projeto_id)
+    if historico:
+        with st.expander("📋 Histórico de Atividades"):
+            df_historico = pd.DataFrame([dict(linha) for linha in historico])
+            df_historico["conclusao"] = (df_historico["concluidas"] / df_historico["subatividades"].where(df_historico["subatividades"] > 0) * 100).fillna(0).round(1)
+            df_historico.columns = ["Atividade", "Relatórios", "Último registro", "Subatividades", "Concluídas", "Conclusão (%)"]
+            st.dataframe(df_historico, use_container_width=True, hide_index=True)
+
     # ========== LISTA DE PROJETOS DO USUÁRIO ==========
     if projetos_lista:
         st.markdown("---")
@@ -1253,8 +672,12 @@ def exibir_dashboard(projeto_id):
         col_proj1, col_proj2, col_proj3 = st.columns(3)
         
         projetos_cols = [col_proj1, col_proj2, col_proj3]
+        resumo_projetos = obter_resumo_projetos(usuario["id"], usuario["tipo"])
         
         for idx, proj in enumerate(projetos_lista[:6]):  # Mostrar até 6 projetos
+            resumo = resumo_projetos.get(proj['id'])
+            total_relatorios = resumo['total_relatorios'] if resumo else 0
+            prod_projeto = resumo['soma_produtividade'] / resumo['contagem_produtividade'] if resumo and resumo['contagem_produtividade'] else 0
             with projetos_cols[idx % 3]:
                 status_color = {
                     'Concluído': '#10B981',
@@ -1280,6 +703,10 @@ def exibir_dashboard(projeto_id):
                             <div style="font-weight: bold;">{proj['orcamento_total']:,.0f} MT</div>
                         </div>
                     </div>
+                    <div style="font-size: 0.8rem; color: #6B7280; margin-top: 0.5rem;">
+                        📋 {total_relatorios} relatórios · 📊 {prod_projeto:.0f}% · 📸 {resumo['total_fotos'] if resumo else 0} fotos
+                        <br>📅 Último: {(resumo['ultima_data'] if resumo else None) or '-'}
+                    </div>
                 </div>
                 """, unsafe_allow_html=True)
 
@@ -1891,36 +1318,115 @@ def exibir_gerenciar_projetos_usuario(usuario_id):
 # ============================================
 # GALERIA DE FOTOS COM ZOOM - AGRUPADA POR ATIVIDADE
 # ============================================
+@st.fragment(run_every=2)
+def aguardar_derivados(foto_ids):
+    """Consulta o pool a cada 2 s e volta a executar a página quando alguma miniatura fica pronta"""
+    if any(not tarefas_derivados.pendente(foto_id) for foto_id in foto_ids):
+        st.rerun()
+    st.caption(f"⏳ {len(foto_ids)} miniatura(s) em preparação")
+
 def exibir_galeria(projeto_id):
     st.markdown("<h2 class='sub-header'>📸 Galeria de Fotos da Obra</h2>", unsafe_allow_html=True)
 
-    # Obter fotos agrupadas por atividade
-    fotos = obter_fotos_por_atividade(projeto_id, usuario["id"], usuario["tipo"])
+    # Contagem por atividade (estatísticas e opções do filtro)
+    contagens = contar_fotos_por_atividade(projeto_id, usuario["id"], usuario["tipo"])
     
-    if not fotos:
+    if not contagens:
         st.info("Nenhuma foto encontrada para o projeto selecionado.")
         return
     
     # Estatísticas
-    atividades_unicas = set(f['atividade_agrupada'] for f in fotos)
-    st.success(f"🖼️ {len(fotos)} foto(s) encontrada(s) em {len(atividades_unicas)} atividade(s)")
+    total_fotos = sum(item["total_fotos"] for item in contagens)
+    st.success(f"🖼️ {total_fotos} foto(s) encontrada(s) em {len(contagens)} atividade(s)")
+    
+    # Filtros (aplicados na consulta)
+    col_atividade, col_inicio, col_fim = st.columns([2, 1, 1])
+    with col_atividade:
+        atividades_opcoes = ["Todas as atividades"] + sorted(item["atividade"] for item in contagens)
+        atividade_selecionada = st.selectbox("Filtrar por atividade:", atividades_opcoes)
+    with col_inicio:
+        data_inicio = st.date_input("De", value=None, format="DD/MM/YYYY", key="galeria_data_inicio")
+    with col_fim:
+        data_fim = st.date_input("Até", value=None, format="DD/MM/YYYY", key="galeria_data_fim")
+    atividade = None if atividade_selecionada == "Todas as atividades" else atividade_selecionada
+    
+    # Filtros pelos metadados EXIF (data em que a foto foi tirada e local)
+    with st.expander("📷 Captura e localização"):
+        col_captura_inicio, col_captura_fim = st.columns(2)
+        with col_captura_inicio:
+            captura_inicio = st.date_input("Tirada a partir de", value=None, format="DD/MM/YYYY", key="galeria_captura_inicio")
+        with col_captura_fim:
+            captura_fim = st.date_input("Tirada até", value=None, format="DD/MM/YYYY", key="galeria_captura_fim")
+        area = None
+        if st.checkbox("Filtrar por área (GPS)", key="galeria_filtrar_area"):
+            col_lat_min, col_lat_max, col_lon_min, col_lon_max = st.columns(4)
+            with col_lat_min:
+                lat_min = st.number_input("Latitude mín.", -90.0, 90.0, -90.0, format="%.5f", key="galeria_lat_min")
+            with col_lat_max:
+                lat_max = st.number_input("Latitude máx.", -90.0, 90.0, 90.0, format="%.5f", key="galeria_lat_max")
+            with col_lon_min:
+                lon_min = st.number_input("Longitude mín.", -180.0, 180.0, -180.0, format="%.5f", key="galeria_lon_min")
+            with col_lon_max:
+                lon_max = st.number_input("Longitude máx.", -180.0, 180.0, 180.0, format="%.5f", key="galeria_lon_max")
+            area = (lat_min, lat_max, lon_min, lon_max)
+    
+    agrupar = st.checkbox("🧩 Agrupar fotos semelhantes", key="galeria_agrupar",
+                          help="Mostra só uma foto de cada grupo de fotos quase iguais da página")
+    
+    # Paginação por chave: a pilha guarda o cursor de início de cada página visitada
+    filtros = (projeto_id, atividade, data_inicio, data_fim, captura_inicio, captura_fim, area)
+    if st.session_state.get("galeria_filtros") != filtros:
+        st.session_state.galeria_filtros = filtros
+        st.session_state.galeria_cursores = [None]
+    cursores = st.session_state.galeria_cursores
+    
+    fotos_filtradas, cursor_seguinte = obter_pagina_fotos(
+        usuario["id"], usuario["tipo"], projeto_id, atividade,
+        data_inicio.isoformat() if data_inicio else None,
+        data_fim.isoformat() if data_fim else None,
+        cursores[-1],
+        captura_inicio=captura_inicio.isoformat() if captura_inicio else None,
+        captura_fim=captura_fim.isoformat() if captura_fim else None,
+        area=area
+    )
     
-    # Filtro por atividade
-    atividades_opcoes = ["Todas as atividades"] + sorted(list(atividades_unicas))
-    atividade_selecionada = st.selectbox("Filtrar por atividade:", atividades_opcoes)
+    if not fotos_filtradas:
+        st.info("Nenhuma foto encontrada para os filtros selecionados.")
+        return
     
-    if atividade_selecionada != "Todas as atividades":
-        fotos_filtradas = [f for f in fotos if f['atividade_agrupada'] == atividade_selecionada]
-    else:
-        fotos_filtradas = fotos
+    semelhantes_na_pagina = {}
+    if agrupar:
+        grupos = agrupar_semelhantes(fotos_filtradas)
+        fotos_filtradas = [representante for representante, _ in grupos]
+        semelhantes_na_pagina = {representante["id"]: len(semelhantes) for representante, semelhantes in grupos}
     
     # Agrupar fotos por atividade
     fotos_por_atividade = {}
     for foto in fotos_filtradas:
-        atividade = foto['atividade_agrupada']
-        if atividade not in fotos_por_atividade:
-            fotos_por_atividade[atividade] = []
-        fotos_por_atividade[atividade].append(foto)
+        nome_atividade = foto['atividade_agrupada']
+        if nome_atividade not in fotos_por_atividade:
+            fotos_por_atividade[nome_atividade] = []
+        fotos_por_atividade[nome_atividade].append(foto)
+    
+    # Derivados das fotos exibidas (os que faltam ficam a ser gerados em segundo plano)
+    derivados, erros_derivados = garantir_derivados(fotos_filtradas)
+    em_preparacao = [foto["id"] for foto in fotos_filtradas if foto["id"] not in derivados and foto["id"] not in erros_derivados]
+    if em_preparacao:
+        aguardar_derivados(em_preparacao)
+    with metricas.medir("galeria.miniaturas"):
+        miniaturas = cache_miniaturas.carregar([caminhos["pequena"] for caminhos in derivados.values()])
+    # A página seguinte fica a ser preparada enquanto esta é vista
+    if cursor_seguinte:
+        fotos_seguintes, _ = obter_pagina_fotos(
+            usuario["id"], usuario["tipo"], projeto_id, atividade,
+            data_inicio.isoformat() if data_inicio else None,
+            data_fim.isoformat() if data_fim else None,
+            cursor_seguinte,
+            captura_inicio=captura_inicio.isoformat() if captura_inicio else None,
+            captura_fim=captura_fim.isoformat() if captura_fim else None,
+            area=area
+        )
+        pre_carregar_pagina(fotos_seguintes)
     
     # Exibir por atividade
     for atividade, lista_fotos in fotos_por_atividade.items():
@@ -1932,40 +1438,130 @@ def exibir_galeria(projeto_id):
             for idx, foto in enumerate(lista_fotos):
                 with colunas[idx % num_colunas]:
                     with st.container(border=True):
-                        try:
-                            img = Image.open(foto["foto_path"])
-                            image_zoom(
-                                image=img, 
-                                mode="dragmove", 
-                                size=(250, 250), 
-                                zoom_factor=5.0, 
-                                keep_aspect_ratio=True
-                            )
-                        except Exception as e:
-                            st.error(f"Erro ao carregar imagem: {e}")
+                        if foto["id"] in erros_derivados:
+                            st.error(f"Erro ao carregar imagem: {erros_derivados[foto['id']]}")
+                            continue
+                        if foto["id"] not in derivados:
+                            st.info("⏳ A preparar miniatura...")
                             continue
 
+                        # A grelha usa só a miniatura (já em JPEG, do cache); o zoom abre a versão média
+                        miniatura = derivados[foto["id"]]["pequena"]
+                        st.image(miniaturas.get(miniatura, miniatura), output_format="JPEG", use_container_width=True)
+                        if st.button("🔍 Ampliar", key=f"zoom_{foto['id']}_{idx}", use_container_width=True):
+                            exibir_zoom_foto(foto, derivados[foto["id"]])
+
                         st.caption(f"**🏗️ {foto['projeto_nome']}**")
                         st.caption(f"**📅 {foto['data']}**")
+                        if semelhantes_na_pagina.get(foto["id"]):
+                            st.caption(f"🧩 +{semelhantes_na_pagina[foto['id']]} semelhante(s) nesta página")
                         
                         if foto["descricao"] and str(foto["descricao"]).strip():
                             st.caption(f"**📝 {foto['descricao'][:40]}...**")
                         
                         st.caption(f"**⏰ {str(foto['data_upload'])[:16].replace('T', ' ')}**")
+                        if foto["data_captura"]:
+                            st.caption(f"📷 {foto['data_captura'][:16]}" + (f" · {foto['camera']}" if foto["camera"] else ""))
+                        if foto["latitude"] is not None:
+                            st.caption(f"📍 {foto['latitude']:.5f}, {foto['longitude']:.5f}")
 
-                        try:
-                            with open(foto["foto_path"], "rb") as f:
-                                img_bytes = f.read()
-                            
+                        if os.path.exists(foto["foto_path"]):
+                            # Só lê o original no clique, sem rerun da galeria
                             st.download_button(
                                 "💾 Baixar", 
-                                data=img_bytes, 
+                                data=leitura_sob_demanda(foto["foto_path"]), 
                                 file_name=os.path.basename(foto["foto_path"]), 
                                 mime="image/jpeg", 
-                                key=f"dl_{foto['id']}_{idx}"
+                                key=f"dl_{foto['id']}_{idx}",
+                                on_click="ignore"
                             )
-                        except:
+                        else:
                             st.warning("Erro no download")
+                        if foto["caminho_frio"] and os.path.exists(foto["caminho_frio"]):
+                            # Acima fica a versão reduzida; o original está no armazenamento frio
+                            st.download_button(
+                                "🗄️ Original (lento)",
+                                data=leitura_sob_demanda(foto["caminho_frio"]),
+                                file_name=os.path.basename(foto["caminho_frio"]),
+                                mime="image/jpeg",
+                                key=f"dl_frio_{foto['id']}_{idx}",
+                                help="Lido do armazenamento frio, pode demorar",
+                                on_click="ignore"
+                            )
+    
+    # Controles de página
+    col_anterior, col_pagina, col_proxima = st.columns([1, 2, 1])
+    with col_anterior:
+        if len(cursores) > 1 and st.button("⬅️ Anterior", use_container_width=True):
+            cursores.pop()
+            st.rerun()
+    with col_pagina:
+        st.markdown(f"<div style='text-align: center;'>Página {len(cursores)}</div>", unsafe_allow_html=True)
+    with col_proxima:
+        if cursor_seguinte and st.button("Próxima ➡️", use_container_width=True):
+            cursores.append(cursor_seguinte)
+            st.rerun()
+
+# O OpenSeadragon é servido pelo próprio Streamlit, sem scripts de terceiros na
+# página: a pasta build/openseadragon da versão 4.1.1 (openseadragon.min.js e
+# images/) é copiada para DIRETORIO_OPENSEADRAGON. Sem ela, o zoom usa a versão média
+DIRETORIO_OPENSEADRAGON = f"{DIRETORIO_ESTATICO}/openseadragon"
+URL_OPENSEADRAGON = "app/static/openseadragon"
+
+def visor_piramide_disponivel():
+    return os.path.exists(f"{DIRETORIO_OPENSEADRAGON}/openseadragon.min.js")
+
+def exibir_visor_piramide(caminho_dzi, altura=560):
+    """Visor OpenSeadragon: o navegador pede só os tiles da área e do zoom visíveis"""
+    configuracao = processamento_fotos.ler_dzi(caminho_dzi)
+    # Caminho relativo à página: app/static/... é a rota dos arquivos de DIRETORIO_ESTATICO
+    pasta = os.path.relpath(processamento_fotos.pasta_tiles(caminho_dzi), DIRETORIO_ESTATICO).replace("\\", "/")
+    configuracao["Image"]["Url"] = f"app/static/{pasta}/"
+    st.iframe(f"""
+        <div id="visor" style="width: 100%; height: {altura}px; background: #111827;"></div>
+        <script src="{URL_OPENSEADRAGON}/openseadragon.min.js"></script>
+        <script>
+            OpenSeadragon({{
+                id: "visor",
+                prefixUrl: "{URL_OPENSEADRAGON}/images/",
+                showNavigator: true,
+                maxZoomPixelRatio: 2,
+                tileSources: {json.dumps(configuracao)}
+            }});
+        </script>""", height=altura + 10)
+
+@st.dialog("🔍 Visualizar foto", width="large")
+def exibir_zoom_foto(foto, caminhos):
+    visor = visor_piramide_disponivel()
+    if visor and foto["piramide_path"] and os.path.exists(foto["piramide_path"]):
+        exibir_visor_piramide(foto["piramide_path"])
+    else:
+        # Sem pirâmide ainda: zoom sobre a imagem média enquanto ela é gerada
+        if visor:
+            agendar_piramide(foto["id"])
+            st.caption("⏳ A preparar o zoom em alta resolução; por agora é mostrada a versão média.")
+        img = Image.open(caminhos["media"])
+        image_zoom(
+            image=img,
+            mode="dragmove",
+            size=(700, 700),
+            zoom_factor=3.0,
+            keep_aspect_ratio=True
+        )
+    st.caption(f"**🏗️ {foto['projeto_nome']}** · 📅 {foto['data']}")
+    if foto["descricao"] and str(foto["descricao"]).strip():
+        st.caption(f"📝 {foto['descricao']}")
+
+    semelhantes = [linha for linha in obter_fotos_semelhantes(foto["id"])
+                   if linha["miniatura_path"] and os.path.exists(linha["miniatura_path"])]
+    if semelhantes:
+        st.markdown(f"**🧩 {len(semelhantes)} foto(s) semelhante(s) neste projeto**")
+        miniaturas = cache_miniaturas.carregar([linha["miniatura_path"] for linha in semelhantes[:12]])
+        colunas = st.columns(6)
+        for idx, linha in enumerate(semelhantes[:12]):
+            with colunas[idx % 6]:
+                st.image(miniaturas.get(linha["miniatura_path"], linha["miniatura_path"]), caption=linha["data"],
+                         output_format="JPEG", use_container_width=True)
 
 # ============================================
 # FUNCIONALIDADES SIMPLIFICADAS
@@ -2005,7 +1601,7 @@ def exibir_alertas():
 def exibir_configuracoes():
     st.markdown("<h2 class='sub-header'>⚙️ Configurações do Sistema</h2>", unsafe_allow_html=True)
     
-    tab1, tab2, tab3 = st.tabs(["🔐 Segurança", "📧 Notificações", "🌐 Sistema"])
+    tab1, tab2, tab3, tab4 = st.tabs(["🔐 Segurança", "📧 Notificações", "🌐 Sistema", "📈 Desempenho"])
     
     with tab1:
         st.subheader("Configurações de Segurança")
@@ -2025,6 +1621,107 @@ def exibir_configuracoes():
         st.selectbox("Fuso Horário", ["GMT+2 (Maputo)", "GMT-3 (Brasília)"])
         st.number_input("Dias para retenção de dados", min_value=30, max_value=365, value=90)
 
+    with tab4:
+        st.subheader("Desempenho do Sistema")
+        if estado_banco.schema_pronto:
+            st.success(f"✅ Schema na versão {estado_banco.versao_schema}, pronto desde "
+                       f"{estado_banco.preparado_em:%d/%m/%Y %H:%M:%S} (preparado em {estado_banco.duracao_preparo * 1000:.1f} ms)")
+            if estado_banco.migracoes_aplicadas:
+                st.caption(f"Migrações aplicadas neste arranque: {', '.join(map(str, estado_banco.migracoes_aplicadas))}")
+        if st.button("🔍 Verificar planos de consulta"):
+            with st.spinner("A verificar os planos num banco temporário..."):
+                resultados = verificar_planos_em_processo(CAMINHO_BANCO)
+            falhas = [r for r in resultados if r["varreduras"]]
+            if falhas:
+                st.error(f"{len(falhas)} de {len(resultados)} consultas fazem varredura completa de tabela")
+                for r in falhas:
+                    with st.expander(f"Varredura em {', '.join(r['varreduras'])}"):
+                        st.code(r["consulta"], language="sql")
+                        st.code("\n".join(r["plano"]))
+            else:
+                st.success(f"✅ {len(resultados)} consultas verificadas, nenhuma varredura completa de tabela")
+
+        if st.button("🔁 Reconstruir resumo dos projetos"):
+            with transacao() as conn:
+                divergencias = reconstruir_resumo_projetos(conn)
+            if divergencias:
+                st.warning(f"{len(divergencias)} divergências corrigidas")
+                st.code("\n".join(divergencias))
+            else:
+                st.success("✅ Resumo dos projetos consistente")
+
+        # A mudança para o armazenamento frio copia e reduz arquivos grandes: corre fora
+        # da interface (numa tarefa agendada), para não prender a sessão durante minutos
+        st.caption(f"🗄️ Fotos frias são movidas pelo comando `python dados_obra.py mover-fotos-frias "
+                   f"--dias {DIAS_FOTOS_FRIAS}`, de preferência agendado fora do horário de uso.")
+
+        resumo_metricas = metricas.resumo()
+        if resumo_metricas:
+            st.dataframe(pd.DataFrame(resumo_metricas), use_container_width=True, hide_index=True)
+        else:
+            st.info("Nenhuma métrica registrada ainda.")
+
+        pendentes_derivados = tarefas_derivados.pendentes()
+        if pendentes_derivados:
+            st.caption(f"⏳ {pendentes_derivados} foto(s) com derivados em geração")
+        pendentes_piramides = tarefas_piramides.pendentes()
+        if pendentes_piramides:
+            st.caption(f"⏳ {pendentes_piramides} pirâmide(s) de zoom em geração")
+
+        st.markdown("#### Cache de consultas")
+        resumo_cache, entradas_cache = cache_consultas.resumo()
+        acertos = sum(linha["Acertos"] for linha in resumo_cache)
+        falhas = sum(linha["Falhas"] for linha in resumo_cache)
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Entradas", f"{entradas_cache}/{cache_consultas.max_entradas}")
+        col2.metric("Acertos", acertos)
+        col3.metric("Falhas", falhas)
+        if resumo_cache:
+            st.dataframe(pd.DataFrame(resumo_cache), use_container_width=True, hide_index=True)
+        if st.button("🧹 Limpar cache de consultas"):
+            cache_consultas.limpar()
+            st.rerun()
+
+        st.markdown("#### Cache de miniaturas")
+        resumo_miniaturas = cache_miniaturas.resumo()
+        pedidos = resumo_miniaturas["acertos"] + resumo_miniaturas["falhas"]
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Memória", f"{resumo_miniaturas['bytes'] / 1024 / 1024:.1f}/{resumo_miniaturas['max_bytes'] / 1024 / 1024:.0f} MB")
+        col2.metric("Miniaturas", resumo_miniaturas["entradas"])
+        col3.metric("Taxa de acerto", f"{resumo_miniaturas['acertos'] / pedidos:.0%}" if pedidos else "-")
+        limite_mb = st.number_input("Limite de memória das miniaturas (MB)", min_value=1, max_value=4096,
+                                    value=int(resumo_miniaturas["max_bytes"] // (1024 * 1024)))
+        if limite_mb * 1024 * 1024 != resumo_miniaturas["max_bytes"]:
+            cache_miniaturas.definir_limite(limite_mb * 1024 * 1024)
+            st.rerun()
+        if st.button("🧹 Limpar cache de miniaturas"):
+            cache_miniaturas.limpar()
+            st.rerun()
+
+        st.markdown("#### Cache de PDFs")
+        resumo_pdfs = cache_pdfs.resumo()
+        pedidos = resumo_pdfs["acertos"] + resumo_pdfs["falhas"]
+        col1, col2, col3, col4, col5 = st.columns(5)
+        col1.metric("Memória", f"{resumo_pdfs['bytes'] / 1024 / 1024:.1f}/{resumo_pdfs['max_bytes'] / 1024 / 1024:.0f} MB")
+        col2.metric("PDFs em memória", resumo_pdfs["entradas"])
+        col3.metric("Taxa de acerto", f"{resumo_pdfs['acertos'] / pedidos:.0%}" if pedidos else "-")
+        col4.metric("Lidos do disco", resumo_pdfs["lidos_disco"])
+        col5.metric("Disco", f"{(resumo_pdfs['bytes_disco'] or 0) / 1024 / 1024:.1f}/{resumo_pdfs['limite_disco'] / 1024 / 1024:.0f} MB"
+                    if resumo_pdfs["bytes_disco"] is not None else "-")
+
+        st.markdown("#### Fila de PDFs")
+        tarefas = fila_pdfs.contagens()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Na fila", tarefas.get("na_fila", 0))
+        col2.metric("Em curso", tarefas.get("em_curso", 0))
+        col3.metric("Concluídas", tarefas.get("concluida", 0))
+        col4.metric("Falharam", tarefas.get("falhou", 0))
+        trabalhadores = st.number_input("Processos para gerar PDFs", min_value=1, max_value=32,
+                                        value=fila_pdfs.trabalhadores)
+        if trabalhadores != fila_pdfs.trabalhadores:
+            fila_pdfs.definir_trabalhadores(int(trabalhadores))
+            st.rerun()
+
 # ============================================
 # REGISTRO DE RELATÓRIOS - DO CÓDIGO 2
 # ============================================
@@ -2082,7 +1779,7 @@ def exibir_registro_relatorios(usuario):
         if usuario["tipo"] == "admin":
             projetos = obter_projetos()
         else:
-            projetos = obter_projetos_por_usuario(usuario["id"])
+            projetos = obter_projetos_por_usuario(usuario["id"], usuario["tipo"])
         
         if not projetos:
             st.error("Você não tem acesso a nenhum projeto. Contacte o administrador.")
@@ -2157,12 +1854,8 @@ def exibir_registro_relatorios(usuario):
         st.markdown("### 📋 Atividades Realizadas")
         
         # Carregar atividades se estiver editando
-        if editando and "atividades" in editando and editando["atividades"]:
-            # Parsear atividades salvas
-            atividades_salvas = editando["atividades"].split('\n')
-            # Esta é uma simplificação - na implementação real você precisaria parsear melhor
-            if not st.session_state.atividades and atividades_salvas:
-                st.session_state.atividades = [{"titulo": atividade, "subs": []} for atividade in atividades_salvas]
+        if editando and not st.session_state.atividades:
+            st.session_state.atividades = obter_atividades_relatorio(editando["id"])
         
         # Botão para adicionar nova atividade (fora do formulário)
         if st.button("➕ Adicionar Nova Atividade", key="add_ativ_principal"):
@@ -2337,6 +2030,8 @@ def exibir_registro_relatorios(usuario):
                                         placeholder="Ex: Fundações concluídas, Andar 1 completo...",
                                         key=f"desc_foto_{i}")
                     fotos_com_descricao.append({"file": foto, "descricao": desc})
+            st.checkbox("🧩 Ignorar fotos quase iguais a outras deste projeto", key="ignorar_fotos_semelhantes",
+                        help="Fotos repetidas (p.ex. várias da mesma parede seguidas) não são guardadas")
 
         # Botões de ação
         col_btn1, col_btn2 = st.columns(2)
@@ -2418,19 +2113,26 @@ def processar_envio_relatorio(data_rel, projeto_id_form, usuario, temperatura, a
             "observacoes": observacoes or "Nenhuma observação adicional"
         }
 
+        # Mesma seleção do texto: atividades com título e subatividades com nome
+        lista_atividades = [{"titulo": a["titulo"], "subs": [s for s in a["subs"] if s["nome"]]}
+                            for a in st.session_state.atividades if a["titulo"]]
+
+        # Fotos só são enviadas com relatórios novos
+        fotos = []
+        if modo == "novo":
+            fotos = [{"arquivo": item["file"], "descricao": item["descricao"]} for item in fotos_com_descricao]
+
         try:
+            rel_id = salvar_relatorio_com_fotos(data_rel, projeto_id_form, usuario["id"], fotos, lista_atividades,
+                                                st.session_state.get("ignorar_fotos_semelhantes", False), **dados)
+            ignoradas = sum(1 for foto in fotos if foto.get("ignorada"))
+            if ignoradas:
+                st.toast(f"🧩 {ignoradas} foto(s) quase iguais a outras do projeto não foram guardadas")
             if modo == "edit":
-                rel_id = salvar_relatorio(data_rel, projeto_id_form, usuario["id"], **dados)
                 mensagem = f"Relatório #{rel_id} atualizado com sucesso!"
             else:
-                rel_id = salvar_relatorio(data_rel, projeto_id_form, usuario["id"], **dados)
                 mensagem = f"Novo relatório #{rel_id} criado com sucesso!"
 
-            # Salvar fotos (apenas se for novo)
-            if fotos_com_descricao and modo == "novo":
-                for item in fotos_com_descricao:
-                    salvar_foto(rel_id, item["file"].getvalue(), item["descricao"])
-
             st.success(mensagem)
             
             # Limpar estados
@@ -2439,17 +2141,38 @@ def processar_envio_relatorio(data_rel, projeto_id_form, usuario, temperatura, a
             st.session_state.efet_adic = []
             st.session_state.atividades = []
             
-            # Gerar e disponibilizar PDF
-            pdf = gerar_pdf(rel_id)
-            if pdf:
-                st.session_state.pdf_gerado = pdf
-                st.session_state.pdf_nome = f"relatorio_{data_rel}.pdf"
+            # O PDF é preparado em segundo plano; a lista mostra-o quando estiver pronto
+            if PRE_GERAR_PDFS:
+                fila_pdfs.enfileirar(rel_id)
+            st.session_state.pdf_relatorio = (rel_id, f"relatorio_{data_rel}.pdf")
             
             st.rerun()
             
         except Exception as e:
             st.error(f"Erro ao salvar relatório: {str(e)}")
 
+@st.fragment(run_every=2)
+def aguardar_pdf(rel_id):
+    """Consulta a fila a cada 2 s e volta a executar a página quando o PDF fica pronto"""
+    _, estado, _ = pdf_preparado(rel_id)
+    if estado not in ("na_fila", "em_curso"):
+        st.rerun()
+    st.info("⏳ A preparar o PDF…")
+
+def exibir_pdf_relatorio(rel_id, nome_arquivo, rotulo, chave):
+    """Botão de download do PDF do relatório ou, enquanto está na fila, o aviso de preparação"""
+    dados, estado, erro = pdf_preparado(rel_id)
+    if dados is not None:
+        st.download_button(rotulo, data=pdf_sob_demanda(rel_id), file_name=nome_arquivo, mime="application/pdf",
+                           key=chave, on_click="ignore", use_container_width=True)
+    elif estado == "falhou":
+        st.error(f"Não foi possível gerar o PDF: {erro}")
+        if st.button("🔄 Tentar de novo", key=f"{chave}_repetir"):
+            fila_pdfs.enfileirar(rel_id)
+            st.rerun()
+    elif estado is not None:
+        aguardar_pdf(rel_id)
+
 def exibir_lista_relatorios(usuario):
     """Exibe a lista de relatórios com opção para criar novo"""
     st.markdown("### 📋 Relatórios Registrados")
@@ -2494,11 +2217,8 @@ def exibir_lista_relatorios(usuario):
                     col_btn1, col_btn2, col_btn3 = st.columns(3)
                     with col_btn1:
                         if st.button("👁️ Ver", key=f"ver_{r['id']}"):
-                            pdf = gerar_pdf(r['id'])
-                            if pdf:
-                                st.session_state.pdf_gerado = pdf
-                                st.session_state.pdf_nome = f"relatorio_{r['data']}.pdf"
-                                st.rerun()
+                            st.session_state.pdf_relatorio = (r['id'], f"relatorio_{r['data']}.pdf")
+                            st.rerun()
                     with col_btn2:
                         if st.button("✏️ Editar", key=f"edit_{r['id']}"):
                             st.session_state.editando_relatorio = carregar_relatorio(r['id'])
@@ -2514,20 +2234,14 @@ def exibir_lista_relatorios(usuario):
         st.info("Nenhum relatório registrado ainda. Clique em 'Novo Relatório' para começar.")
     
     # Download do PDF se existir
-    if "pdf_gerado" in st.session_state:
+    if "pdf_relatorio" in st.session_state:
         st.markdown("---")
         st.markdown("### 📄 Relatório Gerado")
-        st.download_button(
-            label="📥 Baixar Relatório em PDF",
-            data=st.session_state.pdf_gerado,
-            file_name=st.session_state.pdf_nome,
-            mime="application/pdf",
-            use_container_width=True
-        )
+        rel_id, nome_pdf = st.session_state.pdf_relatorio
+        exibir_pdf_relatorio(rel_id, nome_pdf, "📥 Baixar Relatório em PDF", "pdf_gerado")
         
         if st.button("Fechar", use_container_width=True):
-            st.session_state.pop("pdf_gerado", None)
-            st.session_state.pop("pdf_nome", None)
+            st.session_state.pop("pdf_relatorio", None)
             st.rerun()
 
 # ============================================
@@ -2553,8 +2267,20 @@ def exibir_relatorios(projeto_id):
     col1, col2 = st.columns(2)
     
     with col1:
-        if st.button("📥 Baixar Todos (ZIP)", use_container_width=True):
-            st.info("Funcionalidade em desenvolvimento...")
+        if st.button("📥 Baixar Fotos (ZIP)", use_container_width=True):
+            with st.spinner("A preparar o ZIP das fotos..."):
+                st.session_state.exportacao_fotos = (projeto_id, *exportar_fotos_projeto(usuario["id"], usuario["tipo"], projeto_id))
+        exportacao = st.session_state.get("exportacao_fotos")
+        if exportacao and exportacao[0] == projeto_id:
+            _, partes, em_falta = exportacao
+            if not partes:
+                st.info("Nenhuma foto para exportar.")
+            for numero, parte in enumerate(partes, start=1):
+                rotulo = f"📦 Parte {numero} de {len(partes)}" if len(partes) > 1 else "📦 Baixar ZIP"
+                st.link_button(f"{rotulo} ({parte['fotos']} fotos, {parte['bytes'] / 1024 / 1024:.1f} MB)",
+                               parte["url"], use_container_width=True)
+            if em_falta:
+                st.caption(f"⚠️ {em_falta} foto(s) sem arquivo em disco ficaram de fora")
     
     with col2:
         if st.button("📊 Resumo Excel", use_container_width=True):
@@ -2562,15 +2288,7 @@ def exibir_relatorios(projeto_id):
 
     for r in rels[:5]:  # Mostrar apenas os 5 mais recentes
         with st.expander(f"Relatório #{r['id']} - {r['data']}"):
-            pdf = gerar_pdf(r['id'])
-            if pdf:
-                st.download_button(
-                    "📄 Baixar PDF", 
-                    data=pdf, 
-                    file_name=f"relatorio_{r['data']}.pdf",
-                    mime="application/pdf", 
-                    key=f"rel_pdf_{r['id']}"
-                )
+            exibir_pdf_relatorio(r['id'], f"relatorio_{r['data']}.pdf", "📄 Baixar PDF", f"rel_pdf_{r['id']}")
             st.write(f"**Projeto:** {r['projeto_nome']}")
             st.write(f"**Status:** {r['status'] or 'Não informado'}")
             st.write(f"**Produtividade:** {r['produtividade']}%")
@@ -2596,4 +2314,4 @@ elif pagina == "Configurações":
     exibir_configuracoes()
 else:
     st.markdown(f"<h2 class='sub-header'>{pagina}</h2>", unsafe_allow_html=True)
-    st.info(f"Seção {pagina} em desenvolvimento...")
\ No newline at end of file
+    st.info(f"Seção {pagina} em desenvolvimento...")
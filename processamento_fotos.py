@@ -0,0 +1,350 @@
+# ============================================
+# PROCESSAMENTO DE FOTOS
+# ============================================
+# Funções puras (sem Streamlit nem banco de dados) para poderem correr em
+# processos separados a partir do dados_obra.py.
+import datetime
+import hashlib
+import io
+import math
+import os
+import secrets
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+
+from PIL import Image, ImageOps, features
+
+# Lado maior, em pixels, de cada derivado
+TAMANHOS_DERIVADOS = {
+    "pequena": 320,   # grelha da galeria
+    "media": 1280,    # visor enquanto a pirâmide de zoom não existe
+}
+QUALIDADE_DERIVADOS = {"pequena": 70, "media": 80}
+
+ORIENTACAO_EXIF = 0x0112
+# Etiquetas EXIF lidas por extrair_metadados
+FABRICANTE_EXIF = 0x010F
+MODELO_EXIF = 0x0110
+DATA_HORA_EXIF = 0x0132
+DATA_ORIGINAL_EXIF = 0x9003
+IFD_EXIF = 0x8769
+IFD_GPS = 0x8825
+TAMANHO_BLOCO = 1024 * 1024
+
+# Hash perceptual (dHash): LADO_DHASH x LADO_DHASH bits
+LADO_DHASH = 8
+
+# Pirâmide Deep Zoom (DZI) para o visor de zoom
+TAMANHO_TILE = 256
+SOBREPOSICAO_TILE = 1
+QUALIDADE_TILES = 80
+NAMESPACE_DZI = "http://schemas.microsoft.com/deepzoom/2008"
+
+FORMATO_DERIVADOS = "WEBP" if features.check("webp") else "JPEG"
+EXTENSAO_DERIVADOS = ".webp" if FORMATO_DERIVADOS == "WEBP" else ".jpg"
+
+
+def caminho_derivado(caminho_original, tamanho, diretorio):
+    """Caminho do derivado `tamanho` de uma foto: <diretorio>/<nome>_<tamanho>.<ext>"""
+    nome = os.path.splitext(os.path.basename(caminho_original))[0]
+    return os.path.join(diretorio, f"{nome}_{tamanho}{EXTENSAO_DERIVADOS}").replace("\\", "/")
+
+
+@contextmanager
+def arquivo_temporario(diretorio, prefixo, sufixo=""):
+    """Arquivo temporário em `diretorio`, aberto para escrita: produz (arquivo, caminho).
+    Se o bloco falhar, o temporário é apagado; se terminar, fica para quem o pediu"""
+    descritor, temporario = tempfile.mkstemp(prefix=prefixo, suffix=sufixo, dir=diretorio or ".")
+    try:
+        with os.fdopen(descritor, "wb") as f:
+            yield f, temporario
+        # mkstemp cria o arquivo só com permissão do dono
+        os.chmod(temporario, 0o644)
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+
+@contextmanager
+def escrita_atomica(destino, prefixo, sufixo=""):
+    """Produz um arquivo aberto para escrita que só substitui `destino` quando o
+    bloco termina sem erro: nunca fica um arquivo pela metade no lugar dele"""
+    with arquivo_temporario(os.path.dirname(destino), prefixo, sufixo) as (f, temporario):
+        yield f
+    try:
+        os.replace(temporario, destino)
+    except BaseException:
+        os.remove(temporario)
+        raise
+
+
+def _gravar_imagem(img, caminho, qualidade):
+    with escrita_atomica(caminho, ".derivado_", EXTENSAO_DERIVADOS) as f:
+        if FORMATO_DERIVADOS == "WEBP":
+            img.save(f, "WEBP", quality=qualidade, method=2)
+        else:
+            img.save(f, "JPEG", quality=qualidade, optimize=True, progressive=True)
+
+
+def gerar_derivados(caminho_original, diretorio):
+    """Gera os derivados de uma foto e retorna {tamanho: caminho}.
+
+    A imagem é descodificada uma vez, já reduzida quando o formato permite
+    (draft do JPEG), e cada derivado é obtido do anterior, do maior para o
+    menor. A orientação EXIF é aplicada aos pixels.
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    ordem = sorted(TAMANHOS_DERIVADOS, key=TAMANHOS_DERIVADOS.get, reverse=True)
+    maior = TAMANHOS_DERIVADOS[ordem[0]]
+
+    caminhos = {}
+    with Image.open(caminho_original) as img:
+        img.draft("RGB", (maior, maior))
+        atual = img.convert("RGB") if img.mode != "RGB" else img.copy()
+        # Os limites são quadrados, por isso reduzir antes de rodar dá o mesmo
+        # resultado e roda uma imagem muito menor
+        atual.thumbnail((maior, maior), Image.LANCZOS, reducing_gap=2.0)
+        atual = ImageOps.exif_transpose(atual)
+
+        for tamanho in ordem:
+            lado = TAMANHOS_DERIVADOS[tamanho]
+            if max(atual.size) > lado:
+                atual = atual.copy()
+                atual.thumbnail((lado, lado), Image.LANCZOS, reducing_gap=2.0)
+            caminho = caminho_derivado(caminho_original, tamanho, diretorio)
+            _gravar_imagem(atual, caminho, QUALIDADE_DERIVADOS[tamanho])
+            caminhos[tamanho] = caminho
+    return caminhos
+
+
+def miniatura_jpeg(caminho, qualidade):
+    """Bytes JPEG de uma miniatura, como o navegador a recebe: um JPEG é
+    devolvido tal como está e os outros formatos são convertidos"""
+    with open(caminho, "rb") as f:
+        dados = f.read()
+    with Image.open(io.BytesIO(dados)) as img:
+        if img.format == "JPEG":
+            return dados
+        img = img.convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=qualidade)
+    return buffer.getvalue()
+
+
+def hash_do_arquivo(caminho):
+    """(SHA-256, tamanho) de um arquivo em disco, lido em blocos"""
+    sha = hashlib.sha256()
+    tamanho = 0
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(TAMANHO_BLOCO), b""):
+            sha.update(bloco)
+            tamanho += len(bloco)
+    return sha.hexdigest(), tamanho
+
+
+def normalizar_foto(caminho_bruto, diretorio, lado_maximo, qualidade):
+    """Prepara uma foto enviada para ser guardada.
+
+    JPEGs que já cabem em `lado_maximo` e não precisam de rotação ficam com os
+    bytes originais. As restantes são descodificadas já reduzidas (draft do
+    JPEG), reduzidas, rodadas conforme a orientação EXIF e regravadas como
+    JPEG progressivo num arquivo temporário em `diretorio`, mantendo os
+    outros metadados EXIF. Retorna {"caminho", "hash", "tamanho", "formato",
+    "metadados", "hash_perceptual"}, onde "formato" é o formato do arquivo enviado.
+    """
+    with Image.open(caminho_bruto) as img:
+        formato = img.format
+        if formato == "JPEG" and max(img.size) <= lado_maximo and img.getexif().get(ORIENTACAO_EXIF, 1) == 1:
+            conteudo_hash, tamanho = hash_do_arquivo(caminho_bruto)
+            return {"caminho": caminho_bruto, "hash": conteudo_hash, "tamanho": tamanho, "formato": formato,
+                    "metadados": extrair_metadados(caminho_bruto), "hash_perceptual": hash_perceptual(caminho_bruto)}
+
+        img.draft("RGB", (lado_maximo, lado_maximo))
+        atual = img.convert("RGB") if img.mode != "RGB" else img.copy()
+
+    atual.thumbnail((lado_maximo, lado_maximo), Image.LANCZOS, reducing_gap=2.0)
+    atual = ImageOps.exif_transpose(atual)
+
+    buffer = io.BytesIO()
+    atual.save(buffer, "JPEG", quality=qualidade, optimize=True, progressive=True, exif=atual.getexif())
+    conteudo = buffer.getbuffer()
+
+    with arquivo_temporario(diretorio, ".envio_", ".jpg") as (f, temporario):
+        f.write(conteudo)
+    return {"caminho": temporario, "hash": hashlib.sha256(conteudo).hexdigest(), "tamanho": len(conteudo), "formato": formato,
+            "metadados": extrair_metadados(temporario), "hash_perceptual": hash_perceptual(temporario)}
+
+
+def reduzir_foto(caminho, destino, lado_maximo, qualidade):
+    """Grava em `destino` uma versão reduzida da foto (JPEG progressivo, com os
+    metadados EXIF), para ficar no lugar de um original arquivado. Se a versão
+    reduzida não ficar menor, `destino` recebe uma cópia do original.
+    Retorna o tamanho em bytes de `destino`.
+    """
+    with Image.open(caminho) as img:
+        img.draft("RGB", (lado_maximo, lado_maximo))
+        atual = img.convert("RGB") if img.mode != "RGB" else img.copy()
+    atual.thumbnail((lado_maximo, lado_maximo), Image.LANCZOS, reducing_gap=2.0)
+    atual = ImageOps.exif_transpose(atual)
+    buffer = io.BytesIO()
+    atual.save(buffer, "JPEG", quality=qualidade, optimize=True, progressive=True, exif=atual.getexif())
+
+    os.makedirs(os.path.dirname(destino) or ".", exist_ok=True)
+    with escrita_atomica(destino, ".reduzida_", ".jpg") as f:
+        if buffer.tell() < os.path.getsize(caminho):
+            f.write(buffer.getbuffer())
+        else:
+            with open(caminho, "rb") as origem:
+                shutil.copyfileobj(origem, f, TAMANHO_BLOCO)
+    return os.path.getsize(destino)
+
+
+def hash_perceptual(caminho):
+    """dHash de 64 bits da foto: a imagem em tons de cinza reduzida a 9x8, com um
+    bit por pixel que diz se ele é mais claro que o vizinho da direita.
+
+    Fotos quase iguais (mesmo enquadramento, outra exposição ou compressão)
+    diferem em poucos bits. A descodificação é feita já reduzida (draft do
+    JPEG). Retorna um inteiro com sinal, para caber numa coluna INTEGER do SQLite.
+    """
+    with Image.open(caminho) as img:
+        img.draft("L", (LADO_DHASH * 8, LADO_DHASH * 8))
+        img = ImageOps.exif_transpose(img)
+    pixels = img.convert("L").resize((LADO_DHASH + 1, LADO_DHASH), Image.LANCZOS).tobytes()
+
+    bits = 0
+    for linha in range(LADO_DHASH):
+        for coluna in range(LADO_DHASH):
+            posicao = linha * (LADO_DHASH + 1) + coluna
+            bits = (bits << 1) | (pixels[posicao] > pixels[posicao + 1])
+    return bits - (1 << 64) if bits >= 1 << 63 else bits
+
+
+def _texto_exif(valor):
+    return str(valor).strip("\x00 ").strip() if valor is not None else ""
+
+
+def _coordenada_gps(graus_minutos_segundos, referencia):
+    """Graus decimais a partir de (graus, minutos, segundos); None se inválida"""
+    graus, minutos, segundos = (float(parte) for parte in graus_minutos_segundos)
+    valor = graus + minutos / 60 + segundos / 3600
+    if not math.isfinite(valor):
+        return None
+    return -valor if _texto_exif(referencia).upper() in ("S", "W") else valor
+
+
+def extrair_metadados(caminho):
+    """Data de captura, GPS, câmara e dimensões de uma foto, lidos só do cabeçalho.
+
+    Retorna um dicionário com as chaves das colunas de fotos_obra
+    (data_captura "AAAA-MM-DD HH:MM:SS", latitude, longitude, camera,
+    largura, altura); o que não existir ou for inválido fica None. As
+    dimensões são as de exibição, já com a orientação EXIF aplicada.
+    """
+    with Image.open(caminho) as img:
+        largura, altura = img.size
+        exif = img.getexif()
+
+    metadados = {"data_captura": None, "latitude": None, "longitude": None, "camera": None,
+                 "largura": largura, "altura": altura}
+    if exif.get(ORIENTACAO_EXIF, 1) in (5, 6, 7, 8):
+        metadados["largura"], metadados["altura"] = altura, largura
+
+    data = _texto_exif(exif.get_ifd(IFD_EXIF).get(DATA_ORIGINAL_EXIF) or exif.get(DATA_HORA_EXIF))
+    try:
+        metadados["data_captura"] = datetime.datetime.strptime(data, "%Y:%m:%d %H:%M:%S").isoformat(sep=" ")
+    except ValueError:
+        pass
+
+    gps = exif.get_ifd(IFD_GPS)
+    try:
+        latitude = _coordenada_gps(gps[2], gps.get(1))
+        longitude = _coordenada_gps(gps[4], gps.get(3))
+        if latitude is not None and longitude is not None and abs(latitude) <= 90 and abs(longitude) <= 180:
+            metadados["latitude"], metadados["longitude"] = latitude, longitude
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        pass
+
+    fabricante = _texto_exif(exif.get(FABRICANTE_EXIF))
+    modelo = _texto_exif(exif.get(MODELO_EXIF))
+    if modelo and fabricante and not modelo.lower().startswith(fabricante.split()[0].lower()):
+        modelo = f"{fabricante} {modelo}"
+    metadados["camera"] = modelo or fabricante or None
+    return metadados
+
+
+def caminho_piramide(diretorio):
+    """Descritor .dzi de uma pirâmide nova; os tiles ficam em pasta_tiles(...).
+
+    O nome é aleatório: as pirâmides são servidas como arquivos estáticos,
+    sem login, e só quem recebeu o endereço de uma foto o consegue abrir.
+    """
+    return os.path.join(diretorio, f"{secrets.token_hex(16)}.dzi").replace("\\", "/")
+
+
+def pasta_tiles(caminho_dzi):
+    return f"{os.path.splitext(caminho_dzi)[0]}_files"
+
+
+def gerar_piramide(caminho_original, diretorio):
+    """Gera a pirâmide DZI da foto (tiles JPEG de TAMANHO_TILE px) e retorna o caminho do .dzi.
+
+    O nível mais alto tem a resolução da foto e cada nível abaixo metade do
+    anterior, até 1 px. Os tiles são gravados numa pasta temporária que é
+    renomeada no fim, e o .dzi é gravado por último: se ele existe, a
+    pirâmide está completa.
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    with Image.open(caminho_original) as img:
+        atual = img.convert("RGB") if img.mode != "RGB" else img.copy()
+    atual = ImageOps.exif_transpose(atual)
+    largura, altura = atual.size
+    nivel_maximo = math.ceil(math.log2(max(largura, altura, 1)))
+
+    temporaria = tempfile.mkdtemp(prefix=".piramide_", dir=diretorio)
+    try:
+        imagem_nivel = atual
+        for nivel in range(nivel_maximo, -1, -1):
+            escala = 2 ** (nivel_maximo - nivel)
+            tamanho_nivel = (max(1, math.ceil(largura / escala)), max(1, math.ceil(altura / escala)))
+            if imagem_nivel.size != tamanho_nivel:
+                imagem_nivel = imagem_nivel.resize(tamanho_nivel, Image.LANCZOS)
+
+            pasta_nivel = os.path.join(temporaria, str(nivel))
+            os.makedirs(pasta_nivel)
+            for coluna in range(math.ceil(tamanho_nivel[0] / TAMANHO_TILE)):
+                for linha in range(math.ceil(tamanho_nivel[1] / TAMANHO_TILE)):
+                    x0 = max(0, coluna * TAMANHO_TILE - SOBREPOSICAO_TILE)
+                    y0 = max(0, linha * TAMANHO_TILE - SOBREPOSICAO_TILE)
+                    x1 = min(tamanho_nivel[0], (coluna + 1) * TAMANHO_TILE + SOBREPOSICAO_TILE)
+                    y1 = min(tamanho_nivel[1], (linha + 1) * TAMANHO_TILE + SOBREPOSICAO_TILE)
+                    imagem_nivel.crop((x0, y0, x1, y1)).save(
+                        os.path.join(pasta_nivel, f"{coluna}_{linha}.jpg"), "JPEG", quality=QUALIDADE_TILES)
+
+        caminho_dzi = caminho_piramide(diretorio)
+        tiles = pasta_tiles(caminho_dzi)
+        shutil.rmtree(tiles, ignore_errors=True)
+        os.chmod(temporaria, 0o755)
+        os.replace(temporaria, tiles)
+    except BaseException:
+        shutil.rmtree(temporaria, ignore_errors=True)
+        raise
+
+    raiz = ET.Element("Image", {"xmlns": NAMESPACE_DZI, "Format": "jpg", "Overlap": str(SOBREPOSICAO_TILE),
+                                "TileSize": str(TAMANHO_TILE)})
+    ET.SubElement(raiz, "Size", {"Width": str(largura), "Height": str(altura)})
+    with escrita_atomica(caminho_dzi, ".piramide_", ".dzi") as f:
+        ET.ElementTree(raiz).write(f, encoding="utf-8", xml_declaration=True)
+    return caminho_dzi
+
+
+def ler_dzi(caminho_dzi):
+    """Configuração de uma pirâmide DZI no formato aceite pelo OpenSeadragon (sem o Url)"""
+    raiz = ET.parse(caminho_dzi).getroot()
+    tamanho = raiz.find(f"{{{NAMESPACE_DZI}}}Size")
+    return {"Image": {"xmlns": NAMESPACE_DZI, "Format": raiz.get("Format"), "Overlap": raiz.get("Overlap"),
+                      "TileSize": raiz.get("TileSize"),
+                      "Size": {"Width": tamanho.get("Width"), "Height": tamanho.get("Height")}}}
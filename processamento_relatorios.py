@@ -0,0 +1,59 @@
+# ============================================
+# PROCESSAMENTO DE RELATÓRIOS
+# ============================================
+# Geração dos PDFs dos relatórios com o reportlab. Funções puras (sem
+# Streamlit nem banco de dados) para poderem correr em processos separados
+# a partir do dados_obra.py.
+import io
+
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib import colors
+
+SECOES_PDF = (
+    ("Clima", "temperatura"),
+    ("Atividades", "atividades"),
+    ("Equipe", "equipe"),
+    ("Equipamentos", "equipamentos"),
+    ("Ocorrências", "ocorrencias"),
+    ("Plano Amanhã", "plano_amanha"),
+    ("Observações", "observacoes"),
+)
+
+def pdf_relatorio(rel):
+    """Bytes do PDF de um relatório.
+
+    `rel` é um dicionário com as colunas de relatorios_diarios mais
+    "nome_projeto" e "nome_usuario".
+    """
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    styles = getSampleStyleSheet()
+    elements = [Paragraph("Relatório Diário de Obra", styles['Title']), Spacer(1, 20)]
+
+    data_tabela = [
+        ["Data", str(rel["data"])],
+        ["Projeto", rel["nome_projeto"]],
+        ["Responsável", rel["nome_usuario"]],
+        ["Status", rel["status"] or "Não informado"],
+        ["Produtividade", f"{rel['produtividade'] or 0}%"],
+    ]
+
+    t = Table(data_tabela, colWidths=[100, 400])
+    t.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#f0f0f0')),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]))
+
+    elements.append(t)
+    elements.append(Spacer(1, 20))
+
+    for titulo, coluna in SECOES_PDF:
+        texto = rel.get(coluna)
+        if texto and str(texto).strip():
+            elements.append(Paragraph(f"<b>{titulo}:</b> {texto}", styles['Normal']))
+            elements.append(Spacer(1, 10))
+
+    doc.build(elements)
+    return buffer.getvalue()
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dados_obra
+
+
+@pytest.fixture
+def pasta(tmp_path, monkeypatch):
+    """Diretório de trabalho temporário: fotos, derivados e caches ficam lá dentro"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def banco(pasta, monkeypatch):
+    """Banco temporário com o schema completo, usado pelas funções de acesso a dados"""
+    caminho = str(pasta / "controle_obra.db")
+    monkeypatch.setattr(dados_obra, "CAMINHO_BANCO", dados_obra.CAMINHO_BANCO)
+    monkeypatch.setattr(dados_obra, "gerenciador_conexoes", dados_obra.gerenciador_conexoes)
+    monkeypatch.setattr(dados_obra, "contadores_alteracao", dados_obra.contadores_alteracao)
+    dados_obra.cache_consultas.limpar()
+    dados_obra.usar_banco(caminho)
+    yield caminho
+    dados_obra.encerrar_pool_derivados()
+    dados_obra.obter_conexao().close()
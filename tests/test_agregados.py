@@ -0,0 +1,58 @@
+import dados_obra
+from dados_obra import adicionar_projeto, adicionar_usuario, obter_agregados_relatorios, salvar_relatorio
+
+
+def relatorio(data, projeto_id, produtividade, status):
+    return salvar_relatorio(data, projeto_id, 1, atividades="Fundação", produtividade=produtividade, status=status)
+
+
+def esperado(projetos=None):
+    """Os mesmos números calculados em Python a partir de todas as linhas"""
+    linhas = [dict(linha) for linha in dados_obra.obter_conexao().execute("SELECT * FROM relatorios_diarios")
+              if projetos is None or linha["projeto_id"] in projetos]
+    por_dia = {}
+    for linha in linhas:
+        por_dia.setdefault(linha["data"], []).append(linha["produtividade"])
+    fotos = dados_obra.obter_conexao().execute("SELECT relatorio_id FROM fotos_obra").fetchall()
+    ids = {linha["id"] for linha in linhas}
+    return {
+        "total": len(linhas),
+        "produtividade_media": sum(linha["produtividade"] for linha in linhas) / len(linhas) if linhas else 0,
+        "ultima_data": max((linha["data"] for linha in linhas), default=None),
+        "total_fotos": sum(1 for foto in fotos if foto["relatorio_id"] in ids),
+        "serie_diaria": [(data, sum(valores) / len(valores)) for data, valores in sorted(por_dia.items())],
+    }
+
+
+def comparar(agregados, calculado):
+    assert agregados["total"] == calculado["total"]
+    assert abs(agregados["produtividade_media"] - calculado["produtividade_media"]) < 1e-9
+    assert agregados["ultima_data"] == calculado["ultima_data"]
+    assert agregados["total_fotos"] == calculado["total_fotos"]
+    assert [(linha["data"], linha["produtividade"]) for linha in agregados["serie_diaria"]] == calculado["serie_diaria"]
+
+
+def test_agregados_batem_com_as_linhas(banco):
+    dono = adicionar_usuario("dono", "Dono", "dono@local", "x", "proprietario", "")
+    proprio = adicionar_projeto("Próprio", "", "", 0, "2024-01-01", "2024-12-31", None, dono)
+    alheio = adicionar_projeto("Alheio", "", "", 0, "2024-01-01", "2024-12-31", None, None)
+    relatorio("2024-03-01", proprio, 40, "Em andamento")
+    relatorio("2024-03-02", proprio, 80, "Concluído")
+    relatorio("2024-03-02", alheio, 10, "Em andamento")
+    relatorio("2024-03-05", alheio, 30, "Atrasado")
+    dados_obra.salvar_relatorio_com_fotos("2024-03-06", proprio, 1, [{"bytes": dados_obra._jpeg_exemplo()}],
+                                          atividades="Fundação", produtividade=50, status="Concluído")
+
+    comparar(obter_agregados_relatorios(1, "admin"), esperado())
+    comparar(obter_agregados_relatorios(1, "admin", alheio), esperado({alheio}))
+    agregados = obter_agregados_relatorios(dono, "proprietario")
+    comparar(agregados, esperado({proprio}))
+    assert {linha["status"]: linha["total"] for linha in agregados["por_status"]} == {"Em andamento": 1, "Concluído": 2}
+
+
+def test_usuario_sem_projetos_ve_agregados_vazios(banco):
+    adicionar_projeto("Alheio", "", "", 0, "2024-01-01", "2024-12-31", None, None)
+    sozinho = adicionar_usuario("sozinho", "Sozinho", "sozinho@local", "x", "proprietario", "")
+    agregados = obter_agregados_relatorios(sozinho, "proprietario")
+    assert (agregados["total"], agregados["total_fotos"], agregados["produtividade_media"]) == (0, 0, 0)
+    assert agregados["por_status"] == [] and agregados["serie_diaria"] == []
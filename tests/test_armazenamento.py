@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import dados_obra
+from dados_obra import apagar_relatorio, excluir_fotos, salvar_relatorio_com_fotos, transacao
+
+
+@pytest.fixture
+def projeto_id(banco):
+    return dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+
+
+def relatorio_com_foto(projeto_id, data, conteudo):
+    return salvar_relatorio_com_fotos(data, projeto_id, 1, [{"bytes": conteudo, "descricao": "Foto"}], atividades="Fundação")
+
+
+def arquivo_do_conteudo(rel_id):
+    return dados_obra.obter_conexao().execute(
+        """SELECT a.hash, a.caminho, a.referencias FROM fotos_obra f JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+           WHERE f.relatorio_id = ?""", (rel_id,)).fetchone()
+
+
+def test_referencias_contam_as_fotos_do_mesmo_conteudo(projeto_id):
+    conteudo = dados_obra._jpeg_exemplo()
+    primeiro = relatorio_com_foto(projeto_id, "2024-01-01", conteudo)
+    segundo = relatorio_com_foto(projeto_id, "2024-01-02", conteudo)
+    arquivo = arquivo_do_conteudo(primeiro)
+    assert arquivo["referencias"] == 2
+    assert arquivo_do_conteudo(segundo)["caminho"] == arquivo["caminho"]
+
+    apagar_relatorio(primeiro)
+    assert arquivo_do_conteudo(segundo)["referencias"] == 1
+    assert os.path.exists(arquivo["caminho"])
+
+    apagar_relatorio(segundo)
+    assert not os.path.exists(arquivo["caminho"])
+    assert dados_obra.obter_conexao().execute("SELECT COUNT(*) FROM arquivos_fotos WHERE hash = ?",
+                                                  (arquivo["hash"],)).fetchone()[0] == 0
+
+
+def test_arquivos_ficam_se_a_transacao_for_desfeita(projeto_id):
+    rel_id = relatorio_com_foto(projeto_id, "2024-01-01", dados_obra._jpeg_exemplo())
+    arquivo = arquivo_do_conteudo(rel_id)
+
+    with pytest.raises(RuntimeError):
+        with transacao() as conn:
+            assert excluir_fotos(conn, "relatorio_id = ?", (rel_id,)) >= 1
+            # Ainda dentro da transação: nada foi apagado do disco
+            assert os.path.exists(arquivo["caminho"])
+            raise RuntimeError("desfazer")
+
+    assert os.path.exists(arquivo["caminho"])
+    assert arquivo_do_conteudo(rel_id)["referencias"] == 1
+
+
+def test_arquivo_referenciado_de_novo_depois_do_commit_nao_e_apagado(projeto_id):
+    rel_id = relatorio_com_foto(projeto_id, "2024-01-01", dados_obra._jpeg_exemplo())
+    arquivo = arquivo_do_conteudo(rel_id)
+    assert dados_obra.apagar_sem_referencias({arquivo["caminho"]}) == 0
+    assert os.path.exists(arquivo["caminho"])
+
+
+def test_trocar_o_conteudo_de_uma_foto_move_a_referencia(projeto_id):
+    primeiro = relatorio_com_foto(projeto_id, "2024-01-01", dados_obra._jpeg_exemplo())
+    segundo = relatorio_com_foto(projeto_id, "2024-01-02", dados_obra._jpeg_exemplo())
+    antigo, novo = arquivo_do_conteudo(primeiro), arquivo_do_conteudo(segundo)
+    with transacao() as conn:
+        conn.execute("UPDATE fotos_obra SET conteudo_hash = ? WHERE relatorio_id = ?", (novo["hash"], primeiro))
+
+    referencias = dict(dados_obra.obter_conexao().execute(
+        "SELECT hash, referencias FROM arquivos_fotos WHERE hash IN (?, ?)", (antigo["hash"], novo["hash"])).fetchall())
+    assert referencias == {antigo["hash"]: 0, novo["hash"]: 2}
+
+
+def test_excluir_fotos_so_apaga_o_conteudo_sem_referencias(projeto_id):
+    partilhado = dados_obra._jpeg_exemplo()
+    primeiro = relatorio_com_foto(projeto_id, "2024-01-01", partilhado)
+    segundo = relatorio_com_foto(projeto_id, "2024-01-02", partilhado)
+    sozinho = relatorio_com_foto(projeto_id, "2024-01-03", dados_obra._jpeg_exemplo())
+    comum, proprio = arquivo_do_conteudo(primeiro), arquivo_do_conteudo(sozinho)
+
+    with transacao() as conn:
+        assert excluir_fotos(conn, "relatorio_id IN (?, ?)", (primeiro, sozinho)) >= 1
+
+    assert os.path.exists(comum["caminho"])
+    assert arquivo_do_conteudo(segundo)["referencias"] == 1
+    assert not os.path.exists(proprio["caminho"])
+    assert dados_obra.obter_conexao().execute("SELECT COUNT(*) FROM arquivos_fotos WHERE hash = ?",
+                                                  (proprio["hash"],)).fetchone()[0] == 0
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+import dados_obra
+from dados_obra import DIRETORIO_FRIO, mover_fotos_frias, salvar_relatorio_com_fotos, transacao
+
+
+@pytest.fixture
+def projeto_id(banco):
+    return dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+
+
+def relatorio_com_foto(projeto_id, data, conteudo=None):
+    conteudo = conteudo or dados_obra._jpeg_exemplo()
+    return salvar_relatorio_com_fotos(data, projeto_id, 1, [{"bytes": conteudo, "descricao": "Foto"}], atividades="Fundação")
+
+
+def arquivo_do_relatorio(rel_id):
+    return dados_obra.obter_conexao().execute(
+        """SELECT a.* FROM fotos_obra f JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+           WHERE f.relatorio_id = ?""", (rel_id,)).fetchone()
+
+
+def arquivos_frios():
+    return [os.path.join(raiz, nome) for raiz, _, nomes in os.walk(DIRETORIO_FRIO) for nome in nomes]
+
+
+def test_falha_na_reducao_descarta_as_copias_frias(projeto_id):
+    rel_id = relatorio_com_foto(projeto_id, "2020-01-01")
+    arquivo = arquivo_do_relatorio(rel_id)
+    with open(arquivo["caminho"], "wb") as f:
+        f.write(b"nao e uma imagem")
+
+    por_projeto, falhas = mover_fotos_frias()
+    assert (por_projeto, falhas) == ({}, 1)
+    assert arquivos_frios() == []
+    assert not os.path.exists(dados_obra.caminho_por_conteudo(arquivo["hash"], dados_obra.DIRETORIO_REDUZIDAS))
+    assert arquivo_do_relatorio(rel_id)["caminho"] == arquivo["caminho"]
+
+
+def test_projeto_sem_status_com_relatorio_recente_fica_no_quente(projeto_id):
+    with transacao() as conn:
+        conn.execute("UPDATE projetos SET status = NULL WHERE id = ?", (projeto_id,))
+    rel_id = relatorio_com_foto(projeto_id, dados_obra.date.today().isoformat())
+
+    assert mover_fotos_frias() == ({}, 0)
+    assert arquivo_do_relatorio(rel_id)["caminho_reduzido"] is None
+
+
+def test_mover_troca_os_caminhos_de_todas_as_fotos_do_conteudo(projeto_id):
+    conteudo = dados_obra._jpeg_exemplo(lado=2000)
+    primeiro = relatorio_com_foto(projeto_id, "2020-01-01", conteudo)
+    segundo = relatorio_com_foto(projeto_id, "2020-01-02", conteudo)
+    quente = arquivo_do_relatorio(primeiro)
+    with open(quente["caminho"], "rb") as f:
+        original = f.read()
+
+    por_projeto, falhas = mover_fotos_frias()
+    assert falhas == 0
+    assert por_projeto[projeto_id]["fotos"] == 2 and por_projeto[projeto_id]["arquivos"] == 1
+
+    movido = arquivo_do_relatorio(primeiro)
+    assert movido["caminho"].startswith(f"{DIRETORIO_FRIO}/")
+    assert movido["caminho_reduzido"].startswith(f"{dados_obra.DIRETORIO_REDUZIDAS}/")
+    assert movido["movido_frio_em"] is not None
+    with open(movido["caminho"], "rb") as f:
+        assert f.read() == original
+    assert not os.path.exists(quente["caminho"])
+
+    fotos = dados_obra.obter_conexao().execute(
+        "SELECT foto_path, tamanho_bytes FROM fotos_obra WHERE relatorio_id IN (?, ?)", (primeiro, segundo)).fetchall()
+    assert {foto["foto_path"] for foto in fotos} == {movido["caminho_reduzido"]}
+    assert all(foto["tamanho_bytes"] == os.path.getsize(movido["caminho_reduzido"]) for foto in fotos)
+
+    # Já movido: uma segunda execução não tem nada por fazer
+    assert mover_fotos_frias() == ({}, 0)
+
+
+def test_conteudo_usado_por_um_relatorio_recente_fica_no_quente(projeto_id):
+    conteudo = dados_obra._jpeg_exemplo()
+    antigo = relatorio_com_foto(projeto_id, "2020-01-01", conteudo)
+    relatorio_com_foto(projeto_id, dados_obra.date.today().isoformat(), conteudo)
+
+    assert mover_fotos_frias() == ({}, 0)
+    assert arquivo_do_relatorio(antigo)["caminho_reduzido"] is None
+    assert arquivos_frios() == []
+
+
+def test_apagar_relatorio_movido_remove_o_frio_e_a_reduzida(projeto_id):
+    rel_id = relatorio_com_foto(projeto_id, "2020-01-01")
+    mover_fotos_frias()
+    movido = arquivo_do_relatorio(rel_id)
+
+    dados_obra.apagar_relatorio(rel_id)
+    assert not os.path.exists(movido["caminho"])
+    assert not os.path.exists(movido["caminho_reduzido"])
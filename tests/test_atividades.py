@@ -0,0 +1,40 @@
+import dados_obra
+from dados_obra import (apagar_relatorio, obter_atividades_relatorio, obter_historico_atividades, parse_atividades,
+                        salvar_relatorio)
+
+
+def test_parse_le_o_texto_gravado_pelo_formulario():
+    texto = "Fundação: Escavação (✅ Concluído), Armação (❌ Pendente)\nLimpeza do terreno\n\nEstrutura:"
+    assert parse_atividades(texto) == [
+        {"titulo": "Fundação", "subs": [{"nome": "Escavação", "feito": True}, {"nome": "Armação", "feito": False}]},
+        {"titulo": "Limpeza do terreno", "subs": []},
+        {"titulo": "Estrutura", "subs": []},
+    ]
+
+
+def test_atividades_sao_gravadas_e_substituidas_com_o_relatorio(banco):
+    projeto_id = dados_obra.obter_projetos()[0]["id"]
+    atividades = [{"titulo": "Fundação", "subs": [{"nome": "Escavação", "feito": True}, {"nome": "Armação", "feito": False}]},
+                  {"titulo": "Limpeza", "subs": []}]
+    rel_id = salvar_relatorio("2024-01-01", projeto_id, 1, atividades, atividades="Fundação, Limpeza")
+    assert obter_atividades_relatorio(rel_id) == atividades
+
+    # Gravar de novo o relatório do dia troca as atividades em vez de as acumular
+    rel_id = salvar_relatorio("2024-01-01", projeto_id, 1, atividades="Estrutura: Pilares (✅ Concluído)")
+    assert obter_atividades_relatorio(rel_id) == [{"titulo": "Estrutura", "subs": [{"nome": "Pilares", "feito": True}]}]
+
+    apagar_relatorio(rel_id)
+    conn = dados_obra.obter_conexao()
+    assert conn.execute("SELECT COUNT(*) FROM atividades WHERE relatorio_id = ?", (rel_id,)).fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM subatividades").fetchone()[0] == 0
+
+
+def test_historico_agrega_por_titulo(banco):
+    projeto_id = dados_obra.obter_projetos()[0]["id"]
+    salvar_relatorio("2024-01-01", projeto_id, 1, atividades="Fundação: Escavação (✅ Concluído), Armação (❌ Pendente)")
+    salvar_relatorio("2024-01-02", projeto_id, 1, atividades="Fundação: Armação (✅ Concluído)\nEstrutura")
+
+    historico = {linha["titulo"]: dict(linha) for linha in obter_historico_atividades(1, "admin", projeto_id)}
+    assert historico["Fundação"] == {"titulo": "Fundação", "relatorios": 2, "ultima_data": "2024-01-02",
+                                     "subatividades": 3, "concluidas": 2}
+    assert historico["Estrutura"]["subatividades"] == 0
@@ -0,0 +1,54 @@
+import sqlite3
+import threading
+
+import dados_obra
+from dados_obra import marcar_alteracao, transacao, versoes_atuais
+
+
+def contar_leituras(conn):
+    leituras = []
+    conn.set_trace_callback(lambda sql: leituras.append(sql) if "FROM versoes_dados" in sql else None)
+    return leituras
+
+
+def test_versoes_sem_alteracoes_nao_voltam_ao_banco(banco):
+    conn = dados_obra.obter_conexao()
+    versoes_atuais("projetos")
+    leituras = contar_leituras(conn)
+    for _ in range(20):
+        versoes_atuais("projetos", "usuarios")
+    conn.set_trace_callback(None)
+    assert leituras == []
+
+
+def test_commit_com_marcar_alteracao_atualiza_versoes(banco):
+    antes, = versoes_atuais("projetos")
+    with transacao():
+        marcar_alteracao("projetos")
+    assert versoes_atuais("projetos") == (antes + 1,)
+
+
+def test_commit_de_outra_conexao_atualiza_versoes(banco):
+    antes, = versoes_atuais("projetos")
+    with sqlite3.connect(banco) as outra:
+        outra.execute("UPDATE versoes_dados SET versao = versao + 5 WHERE chave = 'projetos'")
+    assert versoes_atuais("projetos") == (antes + 5,)
+
+
+def test_commit_de_outra_thread_atualiza_versoes(banco):
+    antes, = versoes_atuais("usuarios")
+
+    def escrever():
+        with transacao():
+            marcar_alteracao("usuarios")
+
+    thread = threading.Thread(target=escrever)
+    thread.start()
+    thread.join()
+    assert versoes_atuais("usuarios") == (antes + 1,)
+
+
+def test_cache_de_consultas_ve_dados_novos(banco):
+    projetos = len(dados_obra.obter_projetos())
+    dados_obra.adicionar_projeto("Novo", "", "", 0, "2024-01-01", "2024-12-31", 1, 1)
+    assert len(dados_obra.obter_projetos()) == projetos + 1
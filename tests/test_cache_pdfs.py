@@ -0,0 +1,42 @@
+import os
+
+import processamento_fotos
+from dados_obra import CachePdfs
+
+
+def test_disco_apaga_os_pdfs_usados_ha_mais_tempo(pasta):
+    cache = CachePdfs(diretorio=str(pasta / "cache_pdfs"), max_bytes=0, limite_disco=3500)
+    for rel_id in (1, 2, 3):
+        cache.gravar(rel_id, 1, b"x" * 1000)
+        os.utime(cache.caminho(rel_id, 1), (rel_id, rel_id))
+    # O 1 foi lido agora: o mais antigo passa a ser o 2
+    assert cache.ler(1, 1) == b"x" * 1000
+    cache.gravar(4, 1, b"x" * 1000)
+
+    assert not os.path.exists(cache.caminho(2, 1))
+    assert all(os.path.exists(cache.caminho(rel_id, 1)) for rel_id in (1, 3, 4))
+    assert cache.bytes_disco == 3000
+
+
+def test_nova_revisao_substitui_a_anterior_no_disco(pasta):
+    cache = CachePdfs(diretorio=str(pasta / "cache_pdfs"), max_bytes=0, limite_disco=10000)
+    cache.gravar(1, 1, b"a" * 100)
+    cache.gravar(1, 2, b"b" * 300)
+    assert not os.path.exists(cache.caminho(1, 1))
+    assert cache.ler(1, 2) == b"b" * 300
+    assert cache.bytes_disco == 300
+
+
+def test_escrita_atomica_nao_deixa_arquivo_pela_metade(pasta):
+    destino = str(pasta / "foto.jpg")
+    with open(destino, "wb") as f:
+        f.write(b"antigo")
+    try:
+        with processamento_fotos.escrita_atomica(destino, ".teste_") as f:
+            f.write(b"novo")
+            raise RuntimeError("interrompida")
+    except RuntimeError:
+        pass
+    with open(destino, "rb") as f:
+        assert f.read() == b"antigo"
+    assert os.listdir(pasta) == ["foto.jpg"]
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+
+import pytest
+
+import dados_obra
+from dados_obra import GerenciadorConexoes, apos_commit, transacao
+
+
+def conexao_noutra_thread(gerenciador):
+    resultado = []
+    thread = threading.Thread(target=lambda: resultado.append(gerenciador.conexao()))
+    thread.start()
+    thread.join()
+    return resultado[0]
+
+
+def test_uma_conexao_por_thread_em_modo_wal(pasta):
+    gerenciador = GerenciadorConexoes(str(pasta / "teste.db"), busy_timeout_ms=1234)
+    conn = gerenciador.conexao()
+    assert gerenciador.conexao() is conn
+    assert conexao_noutra_thread(gerenciador) is not conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 1234
+
+
+def test_conexao_aberta_nao_abre_uma_conexao(pasta):
+    gerenciador = GerenciadorConexoes(str(pasta / "teste.db"))
+    assert gerenciador.conexao_aberta() is None
+    conn = gerenciador.conexao()
+    assert gerenciador.conexao_aberta() is conn
+
+
+def test_leitura_nao_espera_pela_escrita_de_outra_thread(pasta):
+    gerenciador = GerenciadorConexoes(str(pasta / "teste.db"), busy_timeout_ms=100)
+    escrita = gerenciador.conexao()
+    escrita.execute("CREATE TABLE t (x)")
+    escrita.commit()
+    escrita.execute("BEGIN IMMEDIATE")
+    escrita.execute("INSERT INTO t VALUES (1)")
+
+    lidas = []
+    thread = threading.Thread(target=lambda: lidas.append(gerenciador.conexao().execute("SELECT COUNT(*) FROM t").fetchone()[0]))
+    thread.start()
+    thread.join(timeout=5)
+    # O leitor vê o último commit, sem esperar pelo fim da transação
+    assert lidas == [0]
+    escrita.commit()
+
+
+def test_transacoes_aninhadas_fazem_um_so_commit(banco):
+    depois = []
+    with transacao() as conn:
+        conn.execute("INSERT INTO projetos (nome) VALUES ('Externo')")
+        with transacao() as interna:
+            assert interna is conn
+            interna.execute("INSERT INTO projetos (nome) VALUES ('Interno')")
+            apos_commit(lambda: depois.append(conn.in_transaction))
+        assert conn.in_transaction and depois == []
+    assert depois == [False]
+    nomes = {linha[0] for linha in dados_obra.obter_conexao().execute("SELECT nome FROM projetos")}
+    assert {"Externo", "Interno"} <= nomes
+
+
+def test_erro_desfaz_a_transacao_e_descarta_os_ganchos(banco):
+    depois = []
+    with pytest.raises(sqlite3.IntegrityError):
+        with transacao() as conn:
+            conn.execute("INSERT INTO projetos (nome) VALUES ('Desfeito')")
+            apos_commit(lambda: depois.append(True))
+            conn.execute("INSERT INTO usuarios (username) VALUES (NULL)")
+    assert depois == []
+    conn = dados_obra.obter_conexao()
+    assert not conn.in_transaction
+    assert conn.execute("SELECT COUNT(*) FROM projetos WHERE nome = 'Desfeito'").fetchone()[0] == 0
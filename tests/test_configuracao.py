@@ -0,0 +1,29 @@
+import pytest
+
+from dados_obra import MetricasDesempenho, configuracao_inteira
+
+
+def test_configuracao_inteira_le_o_ambiente(monkeypatch):
+    monkeypatch.delenv("OBRA_MEMORIA_TESTE", raising=False)
+    assert configuracao_inteira("MEMORIA_TESTE", 10) == 10
+    monkeypatch.setenv("OBRA_MEMORIA_TESTE", "2048")
+    assert configuracao_inteira("MEMORIA_TESTE", 10) == 2048
+    monkeypatch.setenv("OBRA_MEMORIA_TESTE", "muito")
+    with pytest.raises(ValueError):
+        configuracao_inteira("MEMORIA_TESTE", 10)
+
+
+def test_metricas_contam_chamadas_mesmo_com_erro():
+    metricas = MetricasDesempenho()
+    with metricas.medir("consulta"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metricas.medir("consulta"):
+            raise RuntimeError("falhou")
+    metricas.registrar("envio", 0.5)
+
+    resumo = {linha["Métrica"]: linha for linha in metricas.resumo()}
+    assert list(resumo) == ["consulta", "envio"]
+    assert resumo["consulta"]["Chamadas"] == 2
+    assert resumo["envio"]["Tempo total (ms)"] == 500.0
+    assert resumo["envio"]["Tempo médio (ms)"] == 500.0
@@ -0,0 +1,52 @@
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+
+import dados_obra
+from dados_obra import TarefasDerivados
+
+
+def tarefas(registradas):
+    return TarefasDerivados(gerar=lambda caminho, diretorio: {"caminho": caminho},
+                            registrar=lambda foto_id, resultado: registradas.append((foto_id, resultado)),
+                            diretorio="derivados")
+
+
+def test_agendar_grava_o_resultado(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(dados_obra, "obter_pool_derivados", lambda: pool)
+    registradas = []
+    fila = tarefas(registradas)
+
+    assert fila.agendar(1, "a.jpg").result(timeout=5) == {"caminho": "a.jpg"}
+    assert registradas == [(1, {"caminho": "a.jpg"})]
+    assert not fila.pendente(1)
+    pool.shutdown()
+
+
+def test_agendar_nao_fica_pendente_se_o_pool_recusar(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    pool.shutdown()
+    monkeypatch.setattr(dados_obra, "obter_pool_derivados", lambda: pool)
+    fila = tarefas([])
+
+    assert isinstance(fila.agendar(1, "a.jpg").exception(timeout=1), RuntimeError)
+    assert not fila.pendente(1)
+    assert 1 not in fila.falhas
+
+
+def test_agendar_nao_fica_pendente_se_o_pool_novo_tambem_falhar(monkeypatch):
+    class PoolQuebrado:
+        def submit(self, *args):
+            raise BrokenExecutor("processo do pool morreu")
+
+    descartes = []
+
+    def obter_pool():
+        return PoolQuebrado()
+
+    obter_pool.clear = lambda: descartes.append(True)
+    monkeypatch.setattr(dados_obra, "obter_pool_derivados", obter_pool)
+    fila = tarefas([])
+
+    assert isinstance(fila.agendar(1, "a.jpg").exception(timeout=1), BrokenExecutor)
+    assert descartes == [True]
+    assert fila.pendentes() == 0
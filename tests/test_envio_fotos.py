@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import dados_obra
+from dados_obra import DIRETORIO_DERIVADOS, DIRETORIO_FOTOS, salvar_relatorio_com_fotos
+
+
+def projeto():
+    return dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+
+
+def arquivos_guardados():
+    """Arquivos das fotos (sem os derivados, que são gerados à parte)"""
+    encontrados = []
+    for raiz, pastas, arquivos in os.walk(DIRETORIO_FOTOS):
+        pastas[:] = [p for p in pastas if os.path.join(raiz, p) != os.path.normpath(DIRETORIO_DERIVADOS)]
+        encontrados.extend(os.path.join(raiz, arquivo) for arquivo in arquivos)
+    return encontrados
+
+
+def contar(tabela):
+    return dados_obra.obter_conexao().execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0]
+
+
+def fotos(total):
+    return [{"bytes": dados_obra._jpeg_exemplo(), "descricao": f"Foto {i}", "atividade_principal": "Fundação"}
+            for i in range(total)]
+
+
+def test_relatorio_e_fotos_sao_gravados_juntos(banco):
+    rel_id = salvar_relatorio_com_fotos("2024-01-01", projeto(), 1, fotos(2), atividades="Fundação")
+    guardadas = dados_obra.obter_conexao().execute("SELECT foto_path FROM fotos_obra WHERE relatorio_id = ?",
+                                                   (rel_id,)).fetchall()
+    assert len(guardadas) == 2
+    assert sorted(arquivos_guardados()) == sorted(foto["foto_path"] for foto in guardadas)
+
+
+def test_foto_invalida_nao_grava_o_relatorio(banco):
+    relatorios = contar("relatorios_diarios")
+    enviadas = fotos(1) + [{"bytes": b"nao e uma imagem", "descricao": "Quebrada"}]
+    with pytest.raises(Exception):
+        salvar_relatorio_com_fotos("2024-01-01", projeto(), 1, enviadas, atividades="Fundação")
+    assert contar("relatorios_diarios") == relatorios
+    assert arquivos_guardados() == []
+
+
+def test_falha_na_transacao_apaga_os_arquivos_movidos(banco, monkeypatch):
+    relatorios = contar("relatorios_diarios")
+    marcar = dados_obra.marcar_alteracao
+
+    def marcar_alteracao(*chaves, **kwargs):
+        if "fotos_obra" in chaves:
+            raise RuntimeError("falha depois de mover os arquivos")
+        marcar(*chaves, **kwargs)
+
+    monkeypatch.setattr(dados_obra, "marcar_alteracao", marcar_alteracao)
+    with pytest.raises(RuntimeError):
+        salvar_relatorio_com_fotos("2024-01-01", projeto(), 1, fotos(2), atividades="Fundação")
+    assert contar("relatorios_diarios") == relatorios
+    assert contar("fotos_obra") == 0
+    assert arquivos_guardados() == []
+
+
+def test_falha_depois_do_commit_mantem_os_arquivos(banco, monkeypatch):
+    def agendar_derivados(linhas):
+        raise RuntimeError("pool recusou a tarefa")
+
+    monkeypatch.setattr(dados_obra, "agendar_derivados", agendar_derivados)
+    with pytest.raises(RuntimeError):
+        salvar_relatorio_com_fotos("2024-01-01", projeto(), 1, fotos(2), atividades="Fundação")
+    guardadas = [linha["foto_path"] for linha in dados_obra.obter_conexao().execute("SELECT foto_path FROM fotos_obra")]
+    assert len(guardadas) == 2
+    assert all(os.path.exists(caminho) for caminho in guardadas)
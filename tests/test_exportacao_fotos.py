@@ -0,0 +1,70 @@
+import os
+import zipfile
+
+import dados_obra
+from dados_obra import DIRETORIO_ESTATICO, escrever_zip_fotos, exportar_fotos_projeto, salvar_relatorio_com_fotos
+
+
+def foto(foto_id, caminho, atividade="Fundação", data="2024-01-01"):
+    return {"id": foto_id, "foto_path": caminho, "atividade_agrupada": atividade, "data": data}
+
+
+def gravar(caminho, tamanho):
+    with open(caminho, "wb") as f:
+        f.write(os.urandom(tamanho))
+    return caminho
+
+
+def test_fotos_ficam_em_pastas_por_atividade(pasta):
+    fotos = [foto(1, gravar("a.jpg", 100)), foto(2, gravar("b.png", 100), "Alvenaria / blocos"),
+             foto(3, gravar("c.txt", 100), "")]
+    partes, em_falta = escrever_zip_fotos(fotos, lambda numero: f"saida/parte{numero}.zip")
+
+    assert em_falta == 0
+    assert [(parte["caminho"], parte["fotos"]) for parte in partes] == [("saida/parte1.zip", 3)]
+    assert partes[0]["bytes"] == os.path.getsize("saida/parte1.zip")
+    with zipfile.ZipFile("saida/parte1.zip") as arquivo_zip:
+        entradas = {info.filename: info.compress_type for info in arquivo_zip.infolist()}
+        assert arquivo_zip.read("Fundação/2024-01-01_1.jpg") == (pasta / "a.jpg").read_bytes()
+    assert entradas == {"Fundação/2024-01-01_1.jpg": zipfile.ZIP_STORED,
+                        "Alvenaria _ blocos/2024-01-01_2.png": zipfile.ZIP_STORED,
+                        "Sem atividade/2024-01-01_3.txt": zipfile.ZIP_DEFLATED}
+    # Sem temporários deixados ao lado das partes
+    assert os.listdir("saida") == ["parte1.zip"]
+
+
+def test_nova_parte_comeca_antes_de_exceder_o_tamanho(pasta):
+    fotos = [foto(i, gravar(f"{i}.jpg", 1000)) for i in range(5)]
+    partes, em_falta = escrever_zip_fotos(fotos, lambda numero: f"parte{numero}.zip", tamanho_maximo=2500)
+
+    assert em_falta == 0
+    assert [parte["fotos"] for parte in partes] == [2, 2, 1]
+    assert all(parte["bytes"] <= 2500 + 200 for parte in partes)
+    nomes = []
+    for parte in partes:
+        with zipfile.ZipFile(parte["caminho"]) as arquivo_zip:
+            nomes.extend(arquivo_zip.namelist())
+    assert nomes == [f"Fundação/2024-01-01_{i}.jpg" for i in range(5)]
+
+
+def test_arquivos_em_falta_sao_contados(pasta):
+    fotos = [foto(1, "nao_existe.jpg"), foto(2, gravar("b.jpg", 10))]
+    partes, em_falta = escrever_zip_fotos(fotos, lambda numero: f"parte{numero}.zip")
+    assert em_falta == 1
+    assert [parte["fotos"] for parte in partes] == [1]
+
+    assert escrever_zip_fotos([foto(1, "nao_existe.jpg")], lambda numero: f"vazio{numero}.zip") == ([], 1)
+    assert not os.path.exists("vazio1.zip")
+
+
+def test_exportacao_do_projeto_gera_partes_servidas_como_estaticas(banco):
+    projeto_id = dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+    fotos = [{"bytes": dados_obra._jpeg_exemplo(), "descricao": f"Foto {i}", "atividade_principal": "Fundação"} for i in range(3)]
+    salvar_relatorio_com_fotos("2024-01-01", projeto_id, 1, fotos, atividades="Fundação")
+
+    partes, em_falta = exportar_fotos_projeto(1, "admin", projeto_id)
+    assert em_falta == 0
+    assert [parte["fotos"] for parte in partes] == [3]
+    assert partes[0]["url"] == "app/static/" + os.path.relpath(partes[0]["caminho"], DIRETORIO_ESTATICO).replace("\\", "/")
+    with zipfile.ZipFile(partes[0]["caminho"]) as arquivo_zip:
+        assert all(nome.startswith("Fundação/2024-01-01_") for nome in arquivo_zip.namelist())
@@ -0,0 +1,140 @@
+from concurrent.futures import Future
+
+import pytest
+
+import dados_obra
+from dados_obra import FilaPdfs, MAX_TENTATIVAS_PDF, salvar_relatorio_com_fotos, transacao
+
+
+@pytest.fixture
+def rel_id(banco):
+    projeto_id = dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+    return salvar_relatorio_com_fotos("2024-01-01", projeto_id, 1, [], atividades="Fundação")
+
+
+@pytest.fixture
+def fila(banco):
+    fila = FilaPdfs(trabalhadores=1)
+    yield fila
+    fila.fechar()
+    dados_obra.cache_pdfs.limpar()
+
+
+def esperar(fila):
+    """Espera que a thread de despacho fique sem pedidos (cada um pode agendar outro)"""
+    for _ in range(20):
+        fila._obter_despachante().submit(lambda: None).result(timeout=10)
+
+
+def revisao(rel_id):
+    return dados_obra.obter_conexao().execute("SELECT revisao FROM relatorios_diarios WHERE id = ?", (rel_id,)).fetchone()[0]
+
+
+def tarefa(rel_id):
+    return dados_obra.obter_conexao().execute(
+        "SELECT estado, tentativas, erro FROM tarefas_pdf WHERE relatorio_id = ?", (rel_id,)).fetchone()
+
+
+def futuro_concluido(resultado=None, erro=None):
+    futuro = Future()
+    if erro:
+        futuro.set_exception(erro)
+    else:
+        futuro.set_result(resultado)
+    return futuro
+
+
+def test_pdf_gerado_no_pool(fila, rel_id):
+    fila.enfileirar(rel_id)
+    fila.fechar()
+    assert dict(tarefa(rel_id)) == {"estado": "concluida", "tentativas": 1, "erro": None}
+    assert dados_obra.cache_pdfs.ler(rel_id, revisao(rel_id)).startswith(b"%PDF")
+
+
+def test_tarefa_ja_concluida_no_submit_nao_bloqueia_o_despacho(fila, rel_id, monkeypatch):
+    monkeypatch.setattr(fila, "_submeter", lambda rel: futuro_concluido(b"%PDF-1.4"))
+    fila.enfileirar(rel_id)
+    esperar(fila)
+    assert tarefa(rel_id)["estado"] == "concluida"
+    assert dados_obra.cache_pdfs.ler(rel_id, revisao(rel_id)) == b"%PDF-1.4"
+    assert not fila._em_curso
+
+
+def test_falha_no_submit_devolve_a_tarefa_ate_ao_limite_de_tentativas(fila, rel_id, monkeypatch):
+    def submeter(rel):
+        raise RuntimeError("pool encerrado")
+    monkeypatch.setattr(fila, "_submeter", submeter)
+    fila.enfileirar(rel_id)
+    esperar(fila)
+    assert dict(tarefa(rel_id)) == {"estado": "falhou", "tentativas": MAX_TENTATIVAS_PDF, "erro": "pool encerrado"}
+    assert not fila._em_curso
+
+
+def test_falha_ao_gravar_o_resultado_devolve_a_tarefa(fila, rel_id, monkeypatch):
+    respostas = iter([futuro_concluido(b"%PDF-1.4"), Future()])
+    monkeypatch.setattr(fila, "_submeter", lambda rel: next(respostas))
+
+    def gravar(*args):
+        raise OSError("disco cheio")
+    monkeypatch.setattr(dados_obra.cache_pdfs, "gravar", gravar)
+    fila.enfileirar(rel_id)
+    esperar(fila)
+    # Devolvida à fila e submetida de novo (a segunda tentativa fica por terminar)
+    assert dict(tarefa(rel_id)) == {"estado": "em_curso", "tentativas": 2, "erro": "disco cheio"}
+    assert len(fila._em_curso) == 1
+
+
+def test_tarefa_em_curso_ha_mais_do_que_o_prazo_volta_para_a_fila(fila, rel_id, monkeypatch):
+    with transacao() as conn:
+        conn.execute("""INSERT INTO tarefas_pdf (relatorio_id, revisao, estado, tentativas, atualizada_em)
+                        VALUES (?, ?, 'em_curso', 1, datetime('now', '-1 hour'))""", (rel_id, revisao(rel_id)))
+    monkeypatch.setattr(fila, "_submeter", lambda rel: futuro_concluido(b"%PDF-1.4"))
+    fila.despachar()
+    esperar(fila)
+    assert dict(tarefa(rel_id)) == {"estado": "concluida", "tentativas": 2, "erro": None}
+
+
+def test_tarefa_em_curso_recente_de_outro_processo_nao_e_despachada(fila, rel_id, monkeypatch):
+    with transacao() as conn:
+        conn.execute("INSERT INTO tarefas_pdf (relatorio_id, revisao, estado, tentativas) VALUES (?, ?, 'em_curso', 1)",
+                     (rel_id, revisao(rel_id)))
+    monkeypatch.setattr(fila, "_submeter", lambda rel: pytest.fail("tarefa de outro processo despachada"))
+    # Nem o arranque de outro servidor retoma a tarefa de um processo vivo
+    fila.iniciar()
+    esperar(fila)
+    assert tarefa(rel_id)["estado"] == "em_curso"
+
+
+def test_erro_ao_gerar_falha_e_volta_para_a_fila_ao_enfileirar_de_novo(fila, rel_id, monkeypatch):
+    monkeypatch.setattr(fila, "_submeter", lambda rel: futuro_concluido(erro=ValueError("relatório inválido")))
+    fila.enfileirar(rel_id)
+    esperar(fila)
+    assert dict(tarefa(rel_id)) == {"estado": "falhou", "tentativas": 1, "erro": "relatório inválido"}
+
+    monkeypatch.setattr(fila, "_submeter", lambda rel: Future())
+    fila.enfileirar(rel_id)
+    esperar(fila)
+    assert dict(tarefa(rel_id)) == {"estado": "em_curso", "tentativas": 1, "erro": None}
+
+
+def test_tarefa_de_revisao_antiga_e_descartada(fila, rel_id, monkeypatch):
+    monkeypatch.setattr(fila, "_submeter", lambda rel: pytest.fail("revisão antiga despachada"))
+    with transacao() as conn:
+        conn.execute("INSERT INTO tarefas_pdf (relatorio_id, revisao) VALUES (?, ?)", (rel_id, revisao(rel_id) - 1))
+    fila.despachar()
+    esperar(fila)
+    assert tarefa(rel_id) is None
+
+
+def test_pdf_preparado_percorre_os_estados(fila, rel_id, monkeypatch):
+    pendente = Future()
+    monkeypatch.setattr(fila, "_submeter", lambda rel: pendente)
+    monkeypatch.setattr(dados_obra, "fila_pdfs", fila)
+
+    assert dados_obra.pdf_preparado(rel_id) == (None, "na_fila", None)
+    esperar(fila)
+    assert dados_obra.pdf_preparado(rel_id) == (None, "em_curso", None)
+
+    pendente.set_result(b"%PDF-1.4")
+    esperar(fila)
+    assert dados_obra.pdf_preparado(rel_id) == (b"%PDF-1.4", "concluida", None)
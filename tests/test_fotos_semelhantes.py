@@ -0,0 +1,101 @@
+import dados_obra
+from dados_obra import (BANDAS_HASH, LIMIAR_SEMELHANCA, agrupar_semelhantes, distancia_hash, marcar_alteracao,
+                        obter_fotos_semelhantes, procurar_semelhantes, salvar_relatorio, salvar_relatorio_com_fotos,
+                        transacao)
+
+# Bit mais alto ligado: o hash gravado é negativo
+BASE = -0x0123456789ABCDEF
+
+
+def com_sinal(valor):
+    valor &= 0xFFFFFFFFFFFFFFFF
+    return valor - (1 << 64) if valor >= 1 << 63 else valor
+
+
+def trocar_bits(hash_perceptual, bandas):
+    """Troca o bit mais baixo de cada uma das `bandas`"""
+    for banda in bandas:
+        hash_perceptual ^= 1 << (8 * banda)
+    return com_sinal(hash_perceptual)
+
+
+def inserir_fotos(projeto_id, hashes):
+    rel_id = salvar_relatorio("2024-01-01", projeto_id, 1, atividades="Fundação")
+    with transacao() as conn:
+        ids = [conn.execute("INSERT INTO fotos_obra (relatorio_id, foto_path, hash_perceptual) VALUES (?, 'x.jpg', ?)",
+                            (rel_id, hash_perceptual)).lastrowid for hash_perceptual in hashes]
+        marcar_alteracao("fotos_obra")
+    return ids
+
+
+def projetos():
+    return [linha["id"] for linha in dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 2")]
+
+
+def test_distancia_conta_os_bits_diferentes_com_sinal():
+    assert distancia_hash(BASE, BASE) == 0
+    assert distancia_hash(BASE, trocar_bits(BASE, range(3))) == 3
+    assert distancia_hash(-1, 0) == 64
+    assert distancia_hash(com_sinal(1 << 63), 0) == 1
+
+
+def test_procura_encontra_so_as_proximas_do_projeto(banco):
+    projeto_id, outro_projeto = projetos()
+    perto = trocar_bits(BASE, range(LIMIAR_SEMELHANCA))
+    # Um bit diferente em cada banda: nenhuma banda em comum
+    longe = trocar_bits(BASE, range(BANDAS_HASH))
+    igual, proxima, distante = inserir_fotos(projeto_id, [BASE, perto, longe])
+    inserir_fotos(outro_projeto, [BASE])
+
+    encontradas = procurar_semelhantes(dados_obra.obter_conexao(), BASE, projeto_id)
+    assert [linha["id"] for linha in encontradas] == [igual, proxima]
+    assert procurar_semelhantes(dados_obra.obter_conexao(), BASE, projeto_id, limiar=2) == encontradas[:1]
+
+
+def test_bandas_acompanham_as_alteracoes_do_hash(banco):
+    projeto_id = projetos()[0]
+    foto_id, = inserir_fotos(projeto_id, [BASE])
+    novo = com_sinal(~BASE)
+    with transacao() as conn:
+        conn.execute("UPDATE fotos_obra SET hash_perceptual = ? WHERE id = ?", (novo, foto_id))
+    assert procurar_semelhantes(conn, BASE, projeto_id) == []
+    assert [linha["id"] for linha in procurar_semelhantes(conn, novo, projeto_id)] == [foto_id]
+
+    with transacao() as conn:
+        conn.execute("DELETE FROM fotos_obra WHERE id = ?", (foto_id,))
+    assert conn.execute("SELECT COUNT(*) FROM bandas_hash_fotos WHERE foto_id = ?", (foto_id,)).fetchone()[0] == 0
+
+
+def test_semelhantes_de_uma_foto_nao_a_incluem(banco):
+    projeto_id = projetos()[0]
+    foto_id, parecida, sem_hash = inserir_fotos(projeto_id, [BASE, trocar_bits(BASE, [0]), None])
+    assert [linha["id"] for linha in obter_fotos_semelhantes(foto_id)] == [parecida]
+    assert obter_fotos_semelhantes(sem_hash) == []
+
+
+def test_agrupar_junta_ao_primeiro_representante_proximo():
+    fotos = [{"id": 1, "hash_perceptual": BASE},
+             {"id": 2, "hash_perceptual": com_sinal(~BASE)},
+             {"id": 3, "hash_perceptual": trocar_bits(BASE, [1, 2])},
+             {"id": 4, "hash_perceptual": None},
+             {"id": 5, "hash_perceptual": trocar_bits(~BASE, [7])}]
+    grupos = agrupar_semelhantes(fotos)
+    assert [(representante["id"], [foto["id"] for foto in semelhantes]) for representante, semelhantes in grupos] == \
+        [(1, [3]), (2, [5]), (4, [])]
+
+
+def test_envio_pode_ignorar_fotos_semelhantes(banco):
+    projeto_id = projetos()[0]
+    repetida = dados_obra._jpeg_exemplo()
+    salvar_relatorio_com_fotos("2024-01-01", projeto_id, 1, [{"bytes": repetida, "descricao": "Primeira"}],
+                               atividades="Fundação")
+
+    fotos = [{"bytes": repetida, "descricao": "Igual à anterior"},
+             {"bytes": dados_obra._jpeg_exemplo(), "descricao": "Nova"}]
+    fotos.append(dict(fotos[1], descricao="Repetida no mesmo envio"))
+    rel_id = salvar_relatorio_com_fotos("2024-01-02", projeto_id, 1, fotos, ignorar_semelhantes=True, atividades="Fundação")
+
+    assert [foto.get("ignorada", False) for foto in fotos] == [True, False, True]
+    descricoes = [linha["descricao"] for linha in dados_obra.obter_conexao().execute(
+        "SELECT descricao FROM fotos_obra WHERE relatorio_id = ?", (rel_id,))]
+    assert descricoes == ["Nova"]
@@ -0,0 +1,83 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+import dados_obra
+from dados_obra import importar_banco_antigo
+
+
+@pytest.fixture
+def legado(banco, pasta):
+    caminho = str(pasta / "obra_completo.db")
+    dados_obra._criar_banco_legado(caminho)
+    with closing(sqlite3.connect(caminho)) as antigo, antigo:
+        for dia in range(2, 6):
+            antigo.execute("""INSERT INTO relatorios (data, projeto_id, usuario_id, atividades)
+                              VALUES (?, 1, 1, 'Estrutura')""", (f"2001-01-0{dia}",))
+        for rel_id in (2, 3, 4):
+            antigo.execute("INSERT INTO fotos (relatorio_id, foto_data, descricao) VALUES (?, ?, 'Antiga')",
+                           (rel_id, dados_obra._jpeg_exemplo()))
+    return caminho
+
+
+def importados(tabela):
+    return dados_obra.obter_conexao().execute(
+        "SELECT COUNT(*) FROM mapa_legado WHERE tabela = ?", (tabela,)).fetchone()[0]
+
+
+def fotos_importadas():
+    return dados_obra.obter_conexao().execute(
+        """SELECT COUNT(*) FROM fotos_obra f JOIN mapa_legado m ON m.tabela = 'relatorios' AND m.id_novo = f.relatorio_id""").fetchone()[0]
+
+
+def test_importacao_interrompida_continua_sem_duplicar(legado, monkeypatch):
+    original = dados_obra._importar_fotos_legado
+    lotes = []
+
+    def interromper_no_segundo_lote(*args):
+        lotes.append(args)
+        if len(lotes) == 2:
+            raise RuntimeError("interrompida")
+        return original(*args)
+    monkeypatch.setattr(dados_obra, "_importar_fotos_legado", interromper_no_segundo_lote)
+
+    with pytest.raises(RuntimeError):
+        importar_banco_antigo(legado, tamanho_lote=2)
+    assert importados("relatorios") == 5
+    assert fotos_importadas() == 2
+
+    monkeypatch.setattr(dados_obra, "_importar_fotos_legado", original)
+    resultado = importar_banco_antigo(legado, tamanho_lote=2)
+    assert resultado["relatorios"]["importadas"] == 0
+    assert resultado["fotos"]["importadas"] == 2
+    assert resultado["materiais"]["importadas"] == 1
+    assert fotos_importadas() == 4
+
+    # Tudo importado: uma nova execução não faz nada
+    resultado = importar_banco_antigo(legado, tamanho_lote=2)
+    assert all(contagem == {"importadas": 0, "ignoradas": 0} for contagem in resultado.values())
+    assert (importados("usuarios"), importados("projetos"), importados("relatorios")) == (1, 1, 5)
+    assert fotos_importadas() == 4
+
+
+def test_consultas_em_cache_veem_usuarios_e_projetos_importados(legado):
+    usuarios = len(dados_obra.obter_usuarios())
+    projetos = len(dados_obra.obter_projetos())
+    importar_banco_antigo(legado)
+    assert len(dados_obra.obter_usuarios()) == usuarios + 1
+    assert len(dados_obra.obter_projetos()) == projetos + 1
+
+
+def test_fotos_mantem_a_data_e_relatorio_coincidente_fica_como_esta(legado):
+    with closing(sqlite3.connect(legado)) as antigo, antigo:
+        antigo.execute("UPDATE fotos SET data_upload = '2001-01-01 08:30:00' WHERE relatorio_id = 1")
+    projeto_id = dados_obra.adicionar_projeto("Projeto Antigo", "", "", 0, "2001-01-01", "2001-12-31", 1, 1)
+    existente = dados_obra.salvar_relatorio_com_fotos("2001-01-01", projeto_id, 1, [], atividades="Alvenaria")
+
+    resultado = importar_banco_antigo(legado)
+    assert resultado["relatorios"] == {"importadas": 4, "ignoradas": 1}
+    conn = dados_obra.obter_conexao()
+    assert conn.execute("SELECT atividades FROM relatorios_diarios WHERE id = ?", (existente,)).fetchone()[0] == "Alvenaria"
+    fotos = conn.execute("SELECT data_upload FROM fotos_obra WHERE relatorio_id = ?", (existente,)).fetchall()
+    assert [foto["data_upload"] for foto in fotos] == ["2001-01-01 08:30:00"]
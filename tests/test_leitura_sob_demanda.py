@@ -0,0 +1,27 @@
+import pytest
+
+from dados_obra import leitura_sob_demanda
+
+
+def test_arquivo_so_e_lido_quando_chamado(pasta):
+    ler = leitura_sob_demanda("foto.jpg")
+    # Criar o botão não abre o arquivo, nem exige que ele já exista
+    with open("foto.jpg", "wb") as f:
+        f.write(b"conteudo da foto")
+    assert ler() == b"conteudo da foto"
+
+
+def test_cada_clique_le_o_arquivo_atual(pasta):
+    with open("foto.jpg", "wb") as f:
+        f.write(b"primeira")
+    ler = leitura_sob_demanda("foto.jpg")
+    assert ler() == b"primeira"
+    with open("foto.jpg", "wb") as f:
+        f.write(b"segunda")
+    assert ler() == b"segunda"
+
+
+def test_arquivo_em_falta_so_falha_no_clique(pasta):
+    ler = leitura_sob_demanda("nao_existe.jpg")
+    with pytest.raises(FileNotFoundError):
+        ler()
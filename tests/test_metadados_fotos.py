@@ -0,0 +1,89 @@
+import io
+import os
+
+from PIL import Image
+
+import dados_obra
+import processamento_fotos
+from dados_obra import executar_migracoes, salvar_relatorio_com_fotos
+
+GPS_SAO_PAULO = {1: "S", 2: (23.0, 33.0, 0.0), 3: "W", 4: (46.0, 37.0, 48.0)}
+
+
+def jpeg_com_exif(largura=64, altura=48, **tags):
+    exif = Image.Exif()
+    for tag, valor in tags.items():
+        exif[getattr(processamento_fotos, tag)] = valor
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (largura, altura), os.urandom(largura * altura * 3)).save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def gravar(caminho, conteudo):
+    with open(caminho, "wb") as f:
+        f.write(conteudo)
+    return caminho
+
+
+def test_extrai_data_gps_e_camera(pasta):
+    caminho = gravar("foto.jpg", jpeg_com_exif(DATA_HORA_EXIF="2024:01:02 10:00:00", FABRICANTE_EXIF="Canon",
+                                               MODELO_EXIF="EOS 80D", IFD_GPS=GPS_SAO_PAULO))
+    metadados = processamento_fotos.extrair_metadados(caminho)
+    assert metadados["data_captura"] == "2024-01-02 10:00:00"
+    assert metadados["camera"] == "Canon EOS 80D"
+    assert metadados["latitude"] == -23.55
+    assert round(metadados["longitude"], 4) == -46.63
+    assert (metadados["largura"], metadados["altura"]) == (64, 48)
+
+
+def test_modelo_que_ja_tem_o_fabricante_nao_o_repete(pasta):
+    caminho = gravar("foto.jpg", jpeg_com_exif(FABRICANTE_EXIF="Canon", MODELO_EXIF="Canon EOS 80D"))
+    assert processamento_fotos.extrair_metadados(caminho)["camera"] == "Canon EOS 80D"
+
+
+def test_valores_invalidos_ficam_vazios(pasta):
+    caminho = gravar("foto.jpg", jpeg_com_exif(DATA_HORA_EXIF="0000:00:00 00:00:00",
+                                               IFD_GPS={1: "N", 2: (95.0, 0.0, 0.0), 3: "E", 4: (10.0, 0.0, 0.0)}))
+    metadados = processamento_fotos.extrair_metadados(caminho)
+    assert metadados["data_captura"] is None
+    assert metadados["latitude"] is None and metadados["longitude"] is None
+    assert metadados["camera"] is None
+
+
+def test_dimensoes_seguem_a_orientacao(pasta):
+    caminho = gravar("foto.jpg", jpeg_com_exif(80, 40, ORIENTACAO_EXIF=6))
+    metadados = processamento_fotos.extrair_metadados(caminho)
+    assert (metadados["largura"], metadados["altura"]) == (40, 80)
+
+
+def test_envio_grava_os_metadados_nas_colunas(banco):
+    projeto_id = dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+    foto = {"bytes": jpeg_com_exif(DATA_HORA_EXIF="2024:01:02 10:00:00", MODELO_EXIF="Pixel 8", IFD_GPS=GPS_SAO_PAULO),
+            "descricao": "Com EXIF"}
+    rel_id = salvar_relatorio_com_fotos("2024-01-05", projeto_id, 1, [foto], atividades="Fundação")
+    linha = dados_obra.obter_conexao().execute("""SELECT data_captura, latitude, longitude, camera, largura, altura
+                                                  FROM fotos_obra WHERE relatorio_id = ?""", (rel_id,)).fetchone()
+    assert linha["data_captura"] == "2024-01-02 10:00:00"
+    assert linha["camera"] == "Pixel 8"
+    assert linha["latitude"] == -23.55
+    assert (linha["largura"], linha["altura"]) == (64, 48)
+
+
+def test_migracao_preenche_as_fotos_antigas(banco):
+    projeto_id = dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+    rel_id = salvar_relatorio_com_fotos("2024-01-05", projeto_id, 1,
+                                        [{"bytes": jpeg_com_exif(DATA_HORA_EXIF="2024:01:02 10:00:00"), "descricao": "Antiga"}],
+                                        atividades="Fundação")
+    conn = dados_obra.obter_conexao()
+    conn.execute("UPDATE fotos_obra SET data_captura = NULL, largura = NULL, altura = NULL WHERE relatorio_id = ?", (rel_id,))
+    # Arquivo em falta: a foto fica sem metadados e a migração continua
+    conn.execute("INSERT INTO fotos_obra (relatorio_id, foto_path) VALUES (?, 'nao_existe.jpg')", (rel_id,))
+    conn.execute("PRAGMA user_version = 11")
+    conn.execute("DELETE FROM schema_migracoes WHERE versao >= 12")
+    conn.commit()
+
+    assert executar_migracoes(conn)[0] == 12
+    linhas = conn.execute("SELECT foto_path, data_captura, largura FROM fotos_obra WHERE relatorio_id = ? ORDER BY id",
+                          (rel_id,)).fetchall()
+    assert (linhas[0]["data_captura"], linhas[0]["largura"]) == ("2024-01-02 10:00:00", 64)
+    assert (linhas[1]["data_captura"], linhas[1]["largura"]) == (None, None)
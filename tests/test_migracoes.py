@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import dados_obra
+from dados_obra import Migracao, executar_em_lotes, executar_migracoes, versao_schema
+
+VERSAO_ATUAL = max(m.versao for m in dados_obra.MIGRACOES)
+
+
+def conectar(caminho):
+    conn = sqlite3.connect(caminho, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def inserir_projetos(conn, total):
+    conn.executemany("INSERT INTO projetos (nome) VALUES (?)", [(f"Projeto {i}",) for i in range(total)])
+    conn.commit()
+    return [r[0] for r in conn.execute("SELECT id FROM projetos ORDER BY id")]
+
+
+def migracao_em_lotes(processados, falhar_no_lote=None, pausa=0):
+    """Migração de teste que percorre `projetos` em lotes de 2 e anota os ids"""
+    lotes = []
+
+    def processar(conn, ids):
+        lotes.append(ids)
+        if len(lotes) == falhar_no_lote:
+            raise RuntimeError("interrompida")
+        time.sleep(pausa)
+        processados.extend(ids)
+
+    return Migracao(VERSAO_ATUAL + 1, "Teste em lotes",
+                    lambda conn: executar_em_lotes(conn, VERSAO_ATUAL + 1, "projetos", processar, tamanho_lote=2),
+                    em_lotes=True)
+
+
+def test_banco_novo_recebe_todas_as_migracoes(banco):
+    conn = conectar(banco)
+    assert versao_schema(conn) == VERSAO_ATUAL
+    registadas = [r["versao"] for r in conn.execute("SELECT versao FROM schema_migracoes ORDER BY versao")]
+    assert registadas == sorted(m.versao for m in dados_obra.MIGRACOES)
+    assert conn.execute("SELECT COUNT(*) FROM migracoes_lotes").fetchone()[0] == 0
+    assert executar_migracoes(conn) == []
+
+
+def test_migracao_em_lotes_retoma_depois_de_interrompida(banco, monkeypatch):
+    conn = conectar(banco)
+    ids = inserir_projetos(conn, 7)
+    processados = []
+    monkeypatch.setattr(dados_obra, "MIGRACOES",
+                        dados_obra.MIGRACOES + [migracao_em_lotes(processados, falhar_no_lote=3)])
+
+    with pytest.raises(RuntimeError):
+        executar_migracoes(conn)
+    assert versao_schema(conn) == VERSAO_ATUAL
+    assert processados == ids[:4]
+    progresso = conn.execute("SELECT ultimo_id FROM migracoes_lotes WHERE versao = ?", (VERSAO_ATUAL + 1,)).fetchone()
+    assert progresso["ultimo_id"] == ids[3]
+
+    monkeypatch.setattr(dados_obra, "MIGRACOES",
+                        dados_obra.MIGRACOES[:-1] + [migracao_em_lotes(processados)])
+    assert executar_migracoes(conn) == [VERSAO_ATUAL + 1]
+    assert processados == ids
+    assert versao_schema(conn) == VERSAO_ATUAL + 1
+    assert conn.execute("SELECT COUNT(*) FROM migracoes_lotes").fetchone()[0] == 0
+
+
+def test_lotes_param_quando_outro_processo_concluiu(banco):
+    conn = conectar(banco)
+    inserir_projetos(conn, 5)
+    outro = conectar(banco)
+    outro.execute(f"PRAGMA user_version = {VERSAO_ATUAL + 1}")
+    outro.commit()
+
+    processados = []
+    executar_em_lotes(conn, VERSAO_ATUAL + 1, "projetos", lambda c, ids: processados.extend(ids))
+    assert processados == []
+    assert not conn.in_transaction
+
+
+def test_lotes_relem_o_progresso_de_outro_processo(banco):
+    conn = conectar(banco)
+    ids = inserir_projetos(conn, 6)
+    outro = conectar(banco)
+    outro.execute("INSERT INTO migracoes_lotes (versao, ultimo_id) VALUES (?, ?)", (VERSAO_ATUAL + 1, ids[3]))
+    outro.commit()
+
+    processados = []
+    executar_em_lotes(conn, VERSAO_ATUAL + 1, "projetos", lambda c, ids: processados.extend(ids), tamanho_lote=2)
+    assert processados == ids[4:]
+    # Sem mais lotes, a transação fica aberta para registar a versão
+    assert conn.in_transaction
+    conn.rollback()
+
+
+def test_dois_processos_nao_repetem_lotes(banco, monkeypatch):
+    ids = inserir_projetos(conectar(banco), 9)
+    processados = []
+    monkeypatch.setattr(dados_obra, "MIGRACOES",
+                        dados_obra.MIGRACOES + [migracao_em_lotes(processados, pausa=0.01)])
+
+    aplicadas = []
+    erros = []
+
+    def iniciar():
+        try:
+            aplicadas.extend(executar_migracoes(conectar(banco)))
+        except Exception as erro:
+            erros.append(erro)
+
+    threads = [threading.Thread(target=iniciar) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert erros == []
+    assert sorted(processados) == ids
+    assert aplicadas == [VERSAO_ATUAL + 1]
+    assert versao_schema(conectar(banco)) == VERSAO_ATUAL + 1
+
+
+def test_migracoes_noutro_banco_nao_tocam_a_conexao_da_thread(banco, tmp_path):
+    viva = dados_obra.obter_conexao()
+    versoes = dict(viva.execute("SELECT chave, versao FROM versoes_dados").fetchall())
+
+    outro = conectar(str(tmp_path / "outro.db"))
+    executar_migracoes(outro)
+    assert versao_schema(outro) == VERSAO_ATUAL
+    assert outro.execute("SELECT versao FROM versoes_dados WHERE chave = 'projeto_resumo'").fetchone() is not None
+
+    assert not viva.in_transaction
+    assert dict(viva.execute("SELECT chave, versao FROM versoes_dados").fetchall()) == versoes
+
+
+def test_funcao_do_lote_corre_depois_do_commit(banco):
+    conn = conectar(banco)
+    ids = inserir_projetos(conn, 4)
+    outro = conectar(banco)
+    vistos = []
+
+    def processar(c, lote):
+        if lote[0] == ids[2]:
+            raise RuntimeError("lote falhou")
+        # O progresso do lote só é visível noutra conexão depois do commit
+        return lambda: vistos.append(outro.execute("SELECT ultimo_id FROM migracoes_lotes WHERE versao = ?",
+                                                   (VERSAO_ATUAL + 1,)).fetchone()["ultimo_id"])
+
+    with pytest.raises(RuntimeError):
+        executar_em_lotes(conn, VERSAO_ATUAL + 1, "projetos", processar, tamanho_lote=2)
+    assert vistos == [ids[1]]
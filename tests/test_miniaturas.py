@@ -0,0 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import dados_obra
+from dados_obra import CacheMiniaturas
+
+
+def test_carregar_nao_espera_se_o_pool_recusar_a_tarefa(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    pool.shutdown()
+    monkeypatch.setattr(dados_obra, "obter_pool_miniaturas", lambda: pool)
+    cache = CacheMiniaturas(max_bytes=1024)
+
+    futuros = cache.preparar(["a.webp"])
+    assert isinstance(futuros["a.webp"].exception(timeout=1), RuntimeError)
+    assert cache.carregar(["a.webp"]) == {}
+    assert not cache._em_curso
+
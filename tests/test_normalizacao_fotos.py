@@ -0,0 +1,71 @@
+import io
+import os
+
+from PIL import Image
+
+import dados_obra
+import processamento_fotos
+from dados_obra import DIRETORIO_ORIGINAIS, salvar_relatorio_com_fotos
+
+
+def gravar_imagem(caminho, largura, altura, formato="JPEG", exif=None):
+    imagem = Image.frombytes("RGB", (largura, altura), os.urandom(largura * altura * 3))
+    imagem.save(caminho, formato, **({"exif": exif} if exif is not None else {}))
+    return caminho
+
+
+def test_jpeg_pequeno_fica_com_os_bytes_originais(pasta):
+    bruto = gravar_imagem("bruto.jpg", 80, 60)
+    preparada = processamento_fotos.normalizar_foto(bruto, ".", 100, 85)
+    assert preparada["caminho"] == bruto
+    assert preparada["hash"] == processamento_fotos.hash_do_arquivo(bruto)[0]
+    assert preparada["tamanho"] == os.path.getsize(bruto)
+
+
+def test_foto_grande_e_reduzida_ao_lado_maximo(pasta):
+    bruto = gravar_imagem("bruto.jpg", 400, 200)
+    preparada = processamento_fotos.normalizar_foto(bruto, ".", 100, 85)
+    assert preparada["caminho"] != bruto
+    with Image.open(preparada["caminho"]) as img:
+        assert img.format == "JPEG"
+        assert img.size == (100, 50)
+    assert (preparada["metadados"]["largura"], preparada["metadados"]["altura"]) == (100, 50)
+    assert preparada["tamanho"] == os.path.getsize(preparada["caminho"])
+
+
+def test_png_e_regravado_em_jpeg(pasta):
+    bruto = gravar_imagem("bruto.png", 40, 30, "PNG")
+    preparada = processamento_fotos.normalizar_foto(bruto, ".", 100, 85)
+    assert preparada["formato"] == "PNG"
+    with Image.open(preparada["caminho"]) as img:
+        assert img.format == "JPEG" and img.size == (40, 30)
+
+
+def test_orientacao_exif_e_aplicada(pasta):
+    exif = Image.Exif()
+    exif[processamento_fotos.ORIENTACAO_EXIF] = 6
+    bruto = gravar_imagem("bruto.jpg", 80, 40, exif=exif)
+    preparada = processamento_fotos.normalizar_foto(bruto, ".", 100, 85)
+    with Image.open(preparada["caminho"]) as img:
+        assert img.size == (40, 80)
+        assert img.getexif().get(processamento_fotos.ORIENTACAO_EXIF, 1) == 1
+
+
+def test_envio_reduz_e_arquiva_o_original(banco, monkeypatch):
+    monkeypatch.setattr(dados_obra, "LADO_MAXIMO_FOTOS", 100)
+    monkeypatch.setattr(dados_obra, "ARQUIVAR_ORIGINAIS", True)
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (300, 150), os.urandom(300 * 150 * 3)).save(buffer, "PNG")
+    projeto_id = dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+
+    rel_id = salvar_relatorio_com_fotos("2024-01-01", projeto_id, 1, [{"bytes": buffer.getvalue(), "descricao": "Grande"}],
+                                        atividades="Fundação")
+    foto = dados_obra.obter_conexao().execute("""SELECT f.foto_path, f.largura, f.altura, a.caminho_original
+                                                 FROM fotos_obra f JOIN arquivos_fotos a ON a.hash = f.conteudo_hash
+                                                 WHERE f.relatorio_id = ?""", (rel_id,)).fetchone()
+    with Image.open(foto["foto_path"]) as img:
+        assert img.format == "JPEG" and img.size == (100, 50)
+    assert (foto["largura"], foto["altura"]) == (100, 50)
+    assert foto["caminho_original"].startswith(DIRETORIO_ORIGINAIS) and foto["caminho_original"].endswith(".png")
+    with open(foto["caminho_original"], "rb") as f:
+        assert f.read() == buffer.getvalue()
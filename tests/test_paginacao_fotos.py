@@ -0,0 +1,63 @@
+import dados_obra
+from dados_obra import marcar_alteracao, obter_pagina_fotos, salvar_relatorio, transacao
+
+
+def inserir_fotos(projeto_id, por_dia):
+    """Fotos sem arquivo (só as linhas): {data: [(atividade, data_captura, latitude, longitude)]}"""
+    ids = []
+    for data, fotos in por_dia.items():
+        rel_id = salvar_relatorio(data, projeto_id, 1, atividades="Fundação")
+        with transacao() as conn:
+            for atividade, captura, latitude, longitude in fotos:
+                ids.append(conn.execute("""INSERT INTO fotos_obra (relatorio_id, foto_path, atividade_principal, data_captura,
+                                           latitude, longitude) VALUES (?, 'x.jpg', ?, ?, ?, ?)""",
+                                        (rel_id, atividade, captura, latitude, longitude)).lastrowid)
+            marcar_alteracao("fotos_obra")
+    return ids
+
+
+def todas_as_paginas(limite, **filtros):
+    paginas = []
+    cursor = None
+    while True:
+        fotos, cursor = obter_pagina_fotos(1, "admin", depois_de=cursor, limite=limite, **filtros)
+        paginas.append([foto["id"] for foto in fotos])
+        if cursor is None:
+            return paginas
+
+
+def test_paginas_percorrem_todas_as_fotos_por_data_e_id(banco):
+    projeto_id = dados_obra.obter_projetos()[0]["id"]
+    fotos = [("Fundação", None, None, None)] * 3
+    ids = inserir_fotos(projeto_id, {"2024-01-01": fotos, "2024-01-03": fotos, "2024-01-02": fotos[:1]})
+
+    paginas = todas_as_paginas(2, projeto_id=projeto_id)
+    assert [len(pagina) for pagina in paginas] == [2, 2, 2, 1]
+    # Mais recente primeiro; no mesmo dia, o id maior primeiro
+    assert sum(paginas, []) == ids[3:6][::-1] + ids[6:7] + ids[0:3][::-1]
+
+
+def test_cursor_nao_muda_com_fotos_novas_antes_dele(banco):
+    projeto_id = dados_obra.obter_projetos()[0]["id"]
+    ids = inserir_fotos(projeto_id, {"2024-01-01": [("Fundação", None, None, None)] * 4})
+    primeira, cursor = obter_pagina_fotos(1, "admin", projeto_id, limite=2)
+    assert [foto["id"] for foto in primeira] == [ids[3], ids[2]]
+
+    inserir_fotos(projeto_id, {"2024-02-01": [("Fundação", None, None, None)] * 2})
+    segunda, cursor = obter_pagina_fotos(1, "admin", projeto_id, depois_de=cursor, limite=2)
+    assert [foto["id"] for foto in segunda] == [ids[1], ids[0]]
+    assert cursor is None
+
+
+def test_filtros_sao_aplicados_em_todas_as_paginas(banco):
+    projeto_id = dados_obra.obter_projetos()[0]["id"]
+    ids = inserir_fotos(projeto_id, {
+        "2024-01-01": [("Fundação", "2024-01-01 10:00:00", -23.5, -46.6), ("Estrutura", "2024-01-01 11:00:00", -23.5, -46.6)],
+        "2024-01-02": [("Fundação", "2024-01-02 09:00:00", -22.9, -43.2), ("", None, None, None)],
+    })
+
+    assert sum(todas_as_paginas(1, projeto_id=projeto_id, atividade="Fundação"), []) == [ids[2], ids[0]]
+    assert sum(todas_as_paginas(1, projeto_id=projeto_id, atividade="Sem atividade"), []) == [ids[3]]
+    assert sum(todas_as_paginas(1, projeto_id=projeto_id, data_inicio="2024-01-02"), []) == [ids[3], ids[2]]
+    assert sum(todas_as_paginas(1, projeto_id=projeto_id, captura_fim="2024-01-01"), []) == [ids[1], ids[0]]
+    assert sum(todas_as_paginas(1, projeto_id=projeto_id, area=(-24, -23, -47, -46)), []) == [ids[1], ids[0]]
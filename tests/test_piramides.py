@@ -0,0 +1,85 @@
+import os
+import re
+
+import pytest
+
+import dados_obra
+import processamento_fotos
+from dados_obra import DIRETORIO_PIRAMIDES, executar_migracoes, salvar_relatorio_com_fotos, transacao
+
+NOME_ALEATORIO = re.compile(r"[0-9a-f]{32}\.dzi")
+
+
+def foto_com_piramide(data, caminho_dzi):
+    projeto_id = dados_obra.obter_conexao().execute("SELECT id FROM projetos ORDER BY id LIMIT 1").fetchone()["id"]
+    rel_id = salvar_relatorio_com_fotos(data, projeto_id, 1, [{"bytes": dados_obra._jpeg_exemplo(), "descricao": "Foto"}],
+                                        atividades="Fundação")
+    with transacao() as conn:
+        foto_id = conn.execute("SELECT id FROM fotos_obra WHERE relatorio_id = ?", (rel_id,)).fetchone()["id"]
+        conn.execute("UPDATE fotos_obra SET piramide_path = ? WHERE id = ?", (caminho_dzi, foto_id))
+    return foto_id
+
+
+def test_piramides_novas_tem_nome_aleatorio(banco):
+    foto_id = foto_com_piramide("2024-01-01", None)
+    foto = dados_obra.obter_conexao().execute("SELECT foto_path FROM fotos_obra WHERE id = ?", (foto_id,)).fetchone()
+    os.makedirs(DIRETORIO_PIRAMIDES, exist_ok=True)
+    primeira = processamento_fotos.gerar_piramide(foto["foto_path"], DIRETORIO_PIRAMIDES)
+    segunda = processamento_fotos.gerar_piramide(foto["foto_path"], DIRETORIO_PIRAMIDES)
+    assert NOME_ALEATORIO.fullmatch(os.path.basename(primeira))
+    assert primeira != segunda
+    assert os.path.isdir(processamento_fotos.pasta_tiles(primeira))
+
+
+def test_migracao_renomeia_piramides_com_o_nome_da_foto(banco):
+    os.makedirs(DIRETORIO_PIRAMIDES, exist_ok=True)
+    antiga = f"{DIRETORIO_PIRAMIDES}/foto_1.dzi"
+    with open(antiga, "w") as f:
+        f.write("<Image/>")
+    os.makedirs(processamento_fotos.pasta_tiles(antiga))
+    com_arquivos = foto_com_piramide("2024-01-01", antiga)
+    sem_arquivos = foto_com_piramide("2024-01-02", f"{DIRETORIO_PIRAMIDES}/foto_2.dzi")
+
+    conn = dados_obra.obter_conexao()
+    conn.execute("PRAGMA user_version = 20")
+    conn.execute("DELETE FROM schema_migracoes WHERE versao = 21")
+    assert executar_migracoes(conn) == [21]
+
+    nova = conn.execute("SELECT piramide_path FROM fotos_obra WHERE id = ?", (com_arquivos,)).fetchone()[0]
+    assert NOME_ALEATORIO.fullmatch(os.path.basename(nova))
+    assert os.path.exists(nova) and os.path.isdir(processamento_fotos.pasta_tiles(nova))
+    assert not os.path.exists(antiga)
+    # Sem os arquivos, a pirâmide volta a ser gerada quando a foto for aberta
+    assert conn.execute("SELECT piramide_path FROM fotos_obra WHERE id = ?", (sem_arquivos,)).fetchone()[0] is None
+
+
+def test_migracao_desfeita_mantem_as_piramides_antigas(banco, monkeypatch):
+    os.makedirs(DIRETORIO_PIRAMIDES, exist_ok=True)
+    antigas = {}
+    for numero in (1, 2):
+        antiga = f"{DIRETORIO_PIRAMIDES}/foto_{numero}.dzi"
+        with open(antiga, "w") as f:
+            f.write("<Image/>")
+        os.makedirs(processamento_fotos.pasta_tiles(antiga))
+        antigas[foto_com_piramide(f"2024-01-0{numero}", antiga)] = antiga
+
+    caminho_piramide = processamento_fotos.caminho_piramide
+    chamadas = []
+
+    def falhar_na_segunda(diretorio):
+        chamadas.append(diretorio)
+        if len(chamadas) == 2:
+            raise RuntimeError("lote interrompido")
+        return caminho_piramide(diretorio)
+
+    monkeypatch.setattr(processamento_fotos, "caminho_piramide", falhar_na_segunda)
+    conn = dados_obra.obter_conexao()
+    conn.execute("PRAGMA user_version = 20")
+    conn.execute("DELETE FROM schema_migracoes WHERE versao = 21")
+    conn.commit()
+    with pytest.raises(RuntimeError):
+        executar_migracoes(conn)
+
+    for foto_id, antiga in antigas.items():
+        assert conn.execute("SELECT piramide_path FROM fotos_obra WHERE id = ?", (foto_id,)).fetchone()[0] == antiga
+        assert os.path.exists(antiga) and os.path.isdir(processamento_fotos.pasta_tiles(antiga))
@@ -0,0 +1,25 @@
+import dados_obra
+
+
+def test_nenhuma_consulta_faz_varredura_completa(banco):
+    resultados = dados_obra.verificar_planos_consulta(banco)
+    falhas = {r["consulta"]: r["plano"] for r in resultados if r["varreduras"]}
+    assert falhas == {}
+
+
+def test_verificacao_cobre_escritas_lotes_e_triggers(banco):
+    consultas = [r["consulta"] for r in dados_obra.verificar_planos_consulta(banco)]
+    for trecho in ("migracoes_lotes", "tarefas_pdf", "mapa_legado", "movido_frio_em", "verificacao_armazenamento",
+                   "-- trg_revisao_usuario_nome"):
+        assert any(trecho in consulta for consulta in consultas), trecho
+
+
+def test_verificacao_nao_escreve_no_banco(banco):
+    conn = dados_obra.obter_conexao()
+    antes = conn.execute("SELECT COUNT(*) FROM relatorios_diarios").fetchone()[0], \
+        conn.execute("SELECT COUNT(*) FROM usuarios").fetchone()[0]
+    dados_obra.verificar_planos_consulta(banco)
+    depois = conn.execute("SELECT COUNT(*) FROM relatorios_diarios").fetchone()[0], \
+        conn.execute("SELECT COUNT(*) FROM usuarios").fetchone()[0]
+    assert antes == depois
+    assert dados_obra.CAMINHO_BANCO == banco
@@ -0,0 +1,23 @@
+import pytest
+
+import dados_obra
+from dados_obra import preparar_banco, versao_schema
+
+
+def test_preparar_banco_so_migra_na_primeira_chamada(banco, monkeypatch):
+    estado = preparar_banco(banco)
+    assert estado.schema_pronto
+    assert estado.versao_schema == versao_schema(dados_obra.obter_conexao())
+
+    monkeypatch.setattr(dados_obra, "executar_migracoes", lambda conn: pytest.fail("migrações num rerun"))
+    for _ in range(3):
+        assert preparar_banco(banco) is estado
+
+
+def test_cada_banco_e_preparado_uma_vez(banco, pasta):
+    outro = str(pasta / "outro.db")
+    estado = preparar_banco(outro)
+    assert estado is not preparar_banco(banco)
+    assert estado.caminho == outro
+    assert estado.migracoes_aplicadas == sorted(m.versao for m in dados_obra.MIGRACOES)
+    assert preparar_banco(outro) is estado
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+
+import dados_obra
+from dados_obra import (adicionar_projeto, adicionar_usuario, associar_usuario_projeto, atualizar_projeto,
+                        desassociar_usuario_projeto, projetos_visiveis)
+
+
+@pytest.fixture
+def sessao(banco, monkeypatch):
+    """Simula uma sessão do Streamlit e conta as resoluções no banco"""
+    monkeypatch.setattr(dados_obra, "get_script_run_ctx", lambda: object())
+    monkeypatch.setattr(dados_obra, "st", SimpleNamespace(session_state={}))
+    resolucoes = []
+    resolver = dados_obra.resolver_projetos_visiveis
+
+    def contar(usuario_id):
+        resolucoes.append(usuario_id)
+        return resolver(usuario_id)
+
+    monkeypatch.setattr(dados_obra, "resolver_projetos_visiveis", contar)
+    return resolucoes
+
+
+def projeto(nome, responsavel_id=None, proprietario_id=None):
+    return adicionar_projeto(nome, "", "", 0, "2024-01-01", "2024-12-31", responsavel_id, proprietario_id)
+
+
+def test_visiveis_por_associacao_responsavel_e_proprietario(banco):
+    dono = adicionar_usuario("dono", "Dono", "dono@local", "x", "proprietario", "")
+    outro = adicionar_usuario("outro", "Outro", "outro@local", "x", "proprietario", "")
+    responsavel = projeto("Responsável", responsavel_id=dono)
+    proprio = projeto("Próprio", proprietario_id=dono)
+    associado = projeto("Associado")
+    projeto("Alheio", proprietario_id=outro)
+    associar_usuario_projeto(dono, associado)
+
+    assert projetos_visiveis(dono, "proprietario") == {responsavel, proprio, associado}
+    assert projetos_visiveis(dono, "admin") is None
+
+
+def test_sessao_reaproveita_o_conjunto_ate_os_acessos_mudarem(sessao):
+    dono = adicionar_usuario("dono", "Dono", "dono@local", "x", "proprietario", "")
+    proprio = projeto("Próprio", proprietario_id=dono)
+    outro = projeto("Outro")
+
+    for _ in range(3):
+        assert projetos_visiveis(dono, "proprietario") == {proprio}
+    assert sessao == [dono]
+
+    associar_usuario_projeto(dono, outro)
+    assert projetos_visiveis(dono, "proprietario") == {proprio, outro}
+    desassociar_usuario_projeto(dono, outro)
+    assert projetos_visiveis(dono, "proprietario") == {proprio}
+    atualizar_projeto(outro, "Outro", "", "", 0, "2024-01-01", "2024-12-31", "Em andamento", dono, None)
+    assert projetos_visiveis(dono, "proprietario") == {proprio, outro}
+    assert len(sessao) == 4
@@ -0,0 +1,55 @@
+import dados_obra
+from dados_obra import (adicionar_projeto, apagar_relatorio, excluir_projeto, reconstruir_resumo_projetos,
+                        salvar_relatorio, salvar_relatorio_com_fotos, transacao)
+
+
+def divergencias():
+    with transacao() as conn:
+        return reconstruir_resumo_projetos(conn, apenas_verificar=True)
+
+
+def resumo(projeto_id):
+    return dados_obra.obter_conexao().execute("SELECT * FROM projeto_resumo WHERE projeto_id = ?", (projeto_id,)).fetchone()
+
+
+def test_triggers_mantem_o_resumo_igual_ao_calculado(banco):
+    projeto_id = adicionar_projeto("Resumo", "", "", 0, "2024-01-01", "2024-12-31", None, None)
+    assert resumo(projeto_id)["total_relatorios"] == 0
+
+    primeiro = salvar_relatorio("2024-01-01", projeto_id, 1, atividades="Fundação", produtividade=40, status="Em andamento")
+    segundo = salvar_relatorio_com_fotos("2024-01-02", projeto_id, 1, [{"bytes": dados_obra._jpeg_exemplo()}],
+                                         atividades="Estrutura", produtividade=60, status="Concluído")
+    # Atualizar o relatório do dia troca a contribuição antiga pela nova
+    salvar_relatorio("2024-01-01", projeto_id, 1, atividades="Fundação", produtividade=90, status="Concluído")
+    linha = resumo(projeto_id)
+    assert (linha["total_relatorios"], linha["soma_produtividade"], linha["total_fotos"]) == (2, 150, 1)
+    assert linha["ultimo_relatorio_id"] == segundo
+    assert divergencias() == []
+
+    apagar_relatorio(segundo)
+    linha = resumo(projeto_id)
+    assert (linha["total_relatorios"], linha["total_fotos"], linha["ultimo_relatorio_id"]) == (1, 0, primeiro)
+    assert divergencias() == []
+
+    excluir_projeto(projeto_id)
+    assert resumo(projeto_id) is None
+    assert divergencias() == []
+
+
+def test_reconstruir_corrige_um_resumo_divergente(banco):
+    projeto_id = adicionar_projeto("Resumo", "", "", 0, "2024-01-01", "2024-12-31", None, None)
+    salvar_relatorio("2024-01-01", projeto_id, 1, atividades="Fundação", produtividade=40, status="Em andamento")
+    with transacao() as conn:
+        conn.execute("UPDATE projeto_resumo SET total_relatorios = 7 WHERE projeto_id = ?", (projeto_id,))
+        conn.execute("DELETE FROM projeto_resumo_status WHERE projeto_id = ?", (projeto_id,))
+
+    encontradas = divergencias()
+    assert any("total_relatorios = 7, esperado 1" in texto for texto in encontradas)
+    assert any("status 'Em andamento' = 0, esperado 1" in texto for texto in encontradas)
+
+    versao, = dados_obra.versoes_atuais("projeto_resumo")
+    with transacao() as conn:
+        assert reconstruir_resumo_projetos(conn) == encontradas
+    assert divergencias() == []
+    assert resumo(projeto_id)["total_relatorios"] == 1
+    assert dados_obra.versoes_atuais("projeto_resumo") == (versao + 1,)
@@ -0,0 +1,81 @@
+import os
+import time
+
+import pytest
+
+import dados_obra
+from dados_obra import CARENCIA_ORFAOS, DIRETORIO_FOTOS, recolher_orfaos, transacao, verificar_armazenamento
+
+
+@pytest.fixture
+def orfao(banco):
+    os.makedirs(DIRETORIO_FOTOS, exist_ok=True)
+    caminho = f"{DIRETORIO_FOTOS}/perdida.jpg"
+    with open(caminho, "wb") as f:
+        f.write(b"x" * 100)
+    return caminho
+
+
+def detectado_em(caminho):
+    linha = dados_obra.obter_conexao().execute(
+        "SELECT detectado_em FROM arquivos_orfaos WHERE caminho = ?", (caminho,)).fetchone()
+    return linha and linha["detectado_em"]
+
+
+def envelhecer(caminho):
+    """Simula a passagem da carência: detetado e modificado há mais de CARENCIA_ORFAOS"""
+    antigo = time.time() - 2 * CARENCIA_ORFAOS
+    with transacao() as conn:
+        conn.execute("UPDATE arquivos_orfaos SET detectado_em = ? WHERE caminho = ?", (antigo, caminho))
+    os.utime(caminho, (antigo, antigo))
+
+
+def test_orfao_so_e_apagado_depois_da_carencia(orfao):
+    relatorio = verificar_armazenamento()
+    assert relatorio["orfaos_detectados"] == 1
+    assert relatorio["orfaos_removidos"] == 0
+    assert os.path.exists(orfao) and detectado_em(orfao)
+
+    envelhecer(orfao)
+    assert recolher_orfaos() == (1, 100)
+    assert not os.path.exists(orfao)
+    assert detectado_em(orfao) is None
+
+
+def test_orfao_referenciado_durante_a_carencia_nao_e_apagado(orfao):
+    verificar_armazenamento()
+    envelhecer(orfao)
+    # Um envio passa a usar o arquivo entre a deteção e a recolha
+    with transacao() as conn:
+        conn.execute("INSERT INTO arquivos_fotos (hash, caminho, tamanho_bytes) VALUES ('abc', ?, 100)", (orfao,))
+
+    assert recolher_orfaos() == (0, 0)
+    assert os.path.exists(orfao)
+    assert detectado_em(orfao) is None
+
+
+def test_orfao_modificado_durante_a_carencia_recomeca_a_contagem(orfao):
+    verificar_armazenamento()
+    envelhecer(orfao)
+    os.utime(orfao)
+
+    assert recolher_orfaos() == (0, 0)
+    assert os.path.exists(orfao)
+    assert detectado_em(orfao) > time.time() - 60
+
+
+def test_verificacao_retoma_onde_parou(orfao):
+    for indice in range(5):
+        with open(f"{DIRETORIO_FOTOS}/perdida_{indice}.jpg", "wb") as f:
+            f.write(b"x")
+    primeira = verificar_armazenamento(limite=3, tamanho_lote=1)
+    assert not primeira["volta_concluida"]
+
+    detectados = primeira["orfaos_detectados"]
+    while True:
+        relatorio = verificar_armazenamento(limite=3, tamanho_lote=1)
+        detectados += relatorio["orfaos_detectados"]
+        if relatorio["volta_concluida"]:
+            break
+    assert detectados == 6
+    assert relatorio["orfaos_pendentes"] == 6